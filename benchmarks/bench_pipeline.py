@@ -0,0 +1,201 @@
+import sys
+import json
+import time
+import resource
+import subprocess
+import numpy as np
+from pathlib import Path
+from datetime import datetime
+from argparse import Namespace, ArgumentParser
+
+import rasterio
+from rasterio.windows import Window
+from rasterio.transform import from_origin
+from transformers import SegformerConfig, SegformerImageProcessor, SegformerForSemanticSegmentation
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+import inference
+from src.inference.TileManager import TileManager
+from src.inference.ModelManager import ModelManager
+from src.inference.EngineManager import ENGINES, ENGINE_EAGER
+from src.inference.MosaicManager import MosaicManager
+from src.inference.JournalManager import JournalManager
+from src.inference.PathRasterManager import PathRasterManager
+from src.utils.mosaic_tools import BLENDING_VOTE, BLENDING_SOFT, WINDOW_NONE
+
+SYNTHETIC_ROWS = 1024 # Rows of the synthetic ortho written at once.
+
+
+def parse_args() -> Namespace:
+
+    parser = ArgumentParser(prog="Inference pipeline benchmark", description="Time the stages of the inference of one raster on a synthetic ortho with a random tiny Segformer.")
+
+    # Synthetic data.
+    parser.add_argument("--width", type=int, default=4096, help="Width in pixels of the synthetic ortho.")
+    parser.add_argument("--height", type=int, default=4096, help="Height in pixels of the synthetic ortho.")
+    parser.add_argument("--crs", default="EPSG:2975", help="CRS of the synthetic ortho.")
+    parser.add_argument("--resolution", type=float, default=0.2, help="Pixel size in CRS units of the synthetic ortho.")
+    parser.add_argument("--nodata_fraction", type=float, default=0.1, help="Fraction of the ortho columns, on the left, filled with black nodata pixels.")
+    parser.add_argument("-nc", "--num_classes", type=int, default=5, help="Number of classes of the random model.")
+    parser.add_argument("--seed", type=int, default=42, help="Seed of the synthetic ortho and of the random model.")
+
+    # Inference parameters, same as inference.py.
+    parser.add_argument("-ts", "--tile_size", type=int, default=256, help="Split Orthophoto into tiles.")
+    parser.add_argument("-ho", "--horizontal_overlap", type=float, default=0.75, help="Horizontal overlap between tiles.")
+    parser.add_argument("-vo", "--vertical_overlap", type=float, default=0.75, help="Vertical overlap between tiles.")
+    parser.add_argument("-bs", "--batch_size", type=int, default=16, help="Number of tiles by forward pass.")
+    parser.add_argument("-eng", "--engine", choices=ENGINES, default=ENGINE_EAGER, help="CPU options of the forward pass, auto keeps the fastest engine on the host.")
+    parser.add_argument("--num_threads", type=int, default=0, help="Number of intra-op threads of torch, 0 keeps the torch default.")
+    parser.add_argument("--num_interop_threads", type=int, default=0, help="Number of inter-op threads of torch, 0 keeps the torch default.")
+    parser.add_argument("-bl", "--blending", choices=[BLENDING_VOTE, BLENDING_SOFT], default=BLENDING_VOTE, help="Blending of the mosaic.")
+    parser.add_argument("--num_mosaic_workers", type=int, default=4, help="Number of processes voting the slices of the final raster.")
+    parser.add_argument("--max_pixels_by_slice_of_rasters", type=int, default=800000000, help="Max pixels number into intermediate rasters.")
+
+    # Output.
+    parser.add_argument("-po", "--path_output", default="./output/bench", help="Folder of the synthetic data and of the intermediate files.")
+    parser.add_argument("-pr", "--path_results", default="./output/bench/bench_pipeline.jsonl", help="One json line by run is appended to this file.")
+
+    return parser.parse_args()
+
+
+def create_synthetic_ortho(opt: Namespace, ortho_path: Path) -> None:
+    """ Write a 3 bands uint8 ortho of smooth random texture, the left columns are black nodata. """
+    rng = np.random.default_rng(opt.seed)
+    nodata_cols = int(opt.width * opt.nodata_fraction)
+    profile = {
+        "driver": "GTiff", "width": opt.width, "height": opt.height, "count": 3, "dtype": "uint8",
+        "crs": opt.crs, "transform": from_origin(340000, 7670000, opt.resolution, opt.resolution),
+        "tiled": True, "blockxsize": 512, "blockysize": 512, "compress": "lzw"
+    }
+
+    xx = np.arange(opt.width)
+    with rasterio.open(ortho_path, "w", **profile) as dst:
+        for row_off in range(0, opt.height, SYNTHETIC_ROWS):
+            rows = min(SYNTHETIC_ROWS, opt.height - row_off)
+            yy = np.arange(row_off, row_off + rows)[:, None]
+
+            data = rng.integers(20, 60, size=(3, rows, opt.width), dtype=np.uint8)
+            data[0] += (80 + 60 * np.sin(xx / 97.0) * np.cos(yy / 61.0)).astype(np.uint8)
+            data[1] += (80 + 60 * np.cos(xx / 53.0 + yy / 89.0)).astype(np.uint8)
+            data[:, :, :nodata_cols] = 0
+
+            dst.write(data, window=Window(0, row_off, opt.width, rows))
+
+
+def create_random_model(opt: Namespace, model_path: Path) -> None:
+    """
+        Save a randomly initialised Segformer, smaller than mit-b0, with the number of classes of the benchmark. The
+        processor of mit-b0 is saved with it, so the benchmark runs offline.
+    """
+    # Class ids start at 1 like the trained models, 0 is the nodata of the rasters.
+    id2label = {i + 1: f"class_{i + 1}" for i in range(opt.num_classes)}
+    config = SegformerConfig(
+        num_labels=opt.num_classes, id2label=id2label, label2id={label: i for i, label in id2label.items()},
+        hidden_sizes=[16, 32, 64, 128], num_attention_heads=[1, 2, 2, 4], depths=[1, 1, 1, 1], decoder_hidden_size=64
+    )
+    model = SegformerForSemanticSegmentation(config)
+    model.save_pretrained(model_path)
+    SegformerImageProcessor(size={"height": 512, "width": 512}).save_pretrained(model_path)
+
+
+def get_folder_stats(folder: Path) -> tuple[int, int]:
+    """ Return the number of files and their size in bytes. """
+    files = [f for f in folder.iterdir() if f.is_file()]
+    return len(files), sum(f.stat().st_size for f in files)
+
+
+def get_peak_rss_mb() -> float:
+    """ Peak RSS since the start of the benchmark, of this process and of the largest terminated worker. """
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024
+
+
+def get_git_revision() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=Path(__file__).parent, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def time_stage(name: str, stage_fn, num_tiles_fn, input_bytes: int) -> dict:
+    """ Run the stage and return its time, throughputs and the peak RSS so far, the peak is monotonic over the stages. """
+    print(f"\n*\t Stage {name}.")
+    t_start = time.perf_counter()
+    stage_fn()
+    duration = time.perf_counter() - t_start
+
+    num_tiles = num_tiles_fn()
+    return {
+        "seconds": round(duration, 3),
+        "tiles": num_tiles,
+        "tiles_by_s": round(num_tiles / duration, 2),
+        "input_mb": round(input_bytes / 1024**2, 2),
+        "mb_by_s": round(input_bytes / 1024**2 / duration, 2),
+        "peak_rss_mb": round(get_peak_rss_mb(), 1),
+    }
+
+
+def main(opt: Namespace) -> None:
+
+    path_output = Path(opt.path_output)
+    ortho_path, model_path = Path(path_output, "synthetic_ortho.tif"), Path(path_output, "synthetic_model")
+    path_output.mkdir(exist_ok=True, parents=True)
+
+    print(f"*\t Create a synthetic ortho of {opt.width}x{opt.height} pixels and a random model of {opt.num_classes} classes.")
+    create_synthetic_ortho(opt, ortho_path)
+    create_random_model(opt, model_path)
+
+    inference_opt = inference.parse_args([
+        "--enable_session", "-psm", str(model_path), "-ppr", str(model_path), "-po", str(path_output),
+        "-ts", str(opt.tile_size), "-ho", str(opt.horizontal_overlap), "-vo", str(opt.vertical_overlap), "-bs", str(opt.batch_size),
+        "-eng", opt.engine, "--num_threads", str(opt.num_threads), "--num_interop_threads", str(opt.num_interop_threads), "-bl", opt.blending
+    ])
+    # The synthetic ortho is outside the geojson areas, --path_geojson can't be emptied on the command line.
+    inference_opt.path_geojson = []
+    tile_manager = TileManager(inference_opt)
+    model_manager = ModelManager(inference_opt)
+
+    path_manager = PathRasterManager(str(path_output), ortho_path)
+    path_manager.clean_raster()
+    journal = JournalManager(path_manager.journal_file)
+    mosaic_manager = None
+
+    def build_raster():
+        nonlocal mosaic_manager
+        mosaic_manager = MosaicManager(path_manager, model_manager.get_id2label(), opt.max_pixels_by_slice_of_rasters, opt.blending, WINDOW_NONE, False, opt.num_mosaic_workers)
+        mosaic_manager.build_raster()
+
+    stages = {}
+    stages["split_ortho_into_tiles"] = time_stage("split_ortho_into_tiles", lambda: tile_manager.split_ortho_into_tiles(path_manager, journal),
+        lambda: get_folder_stats(path_manager.cropped_ortho_folder)[0], 3 * opt.width * opt.height)
+    stages["convert_tiff_tiles_into_png"] = time_stage("convert_tiff_tiles_into_png", lambda: tile_manager.convert_tiff_tiles_into_png(path_manager, journal),
+        lambda: get_folder_stats(path_manager.cropped_ortho_img_folder)[0], get_folder_stats(path_manager.cropped_ortho_folder)[1])
+    stages["inference"] = time_stage("inference", lambda: model_manager.inference(path_manager, journal),
+        lambda: get_folder_stats(path_manager.predictions_tiff_folder)[0], get_folder_stats(path_manager.cropped_ortho_img_folder)[1])
+    stages["build_raster"] = time_stage("build_raster", build_raster,
+        lambda: len(mosaic_manager.predictions_tiff_files), get_folder_stats(path_manager.predictions_tiff_folder)[1])
+
+    results = {
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "revision": get_git_revision(),
+        "params": vars(opt),
+        "total_seconds": round(sum(stage["seconds"] for stage in stages.values()), 3),
+        "stages": stages,
+    }
+
+    print("\n*\t Results:")
+    for name, stage in stages.items():
+        print(f"*\t {name:<28} {stage['seconds']:>8.2f}s {stage['tiles_by_s']:>9.1f} tiles/s {stage['mb_by_s']:>8.1f} MB/s, peak RSS {stage['peak_rss_mb']:.0f} MB")
+
+    path_results = Path(opt.path_results)
+    path_results.parent.mkdir(exist_ok=True, parents=True)
+    with open(path_results, "a") as f:
+        f.write(json.dumps(results) + "\n")
+    print(f"*\t Results appended to {path_results}.")
+
+    path_manager.raster_disk_optimize()
+
+
+if __name__ == "__main__":
+    opt = parse_args()
+    main(opt)
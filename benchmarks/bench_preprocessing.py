@@ -0,0 +1,60 @@
+import sys
+import time
+import torch
+import numpy as np
+from pathlib import Path
+from argparse import Namespace, ArgumentParser
+from transformers import AutoImageProcessor
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from src.inference.ModelManager import preprocess_tiles
+
+def parse_args() -> Namespace:
+
+    parser = ArgumentParser(prog="Preprocessing benchmark", description="Compare the HF processor by image with the batched tensor preprocessing on synthetic tiles.")
+
+    parser.add_argument("-nt", "--num_tiles", type=int, default=256, help="Number of synthetic tiles.")
+    parser.add_argument("-ts", "--tile_size", type=int, default=256, help="Size of the tiles.")
+    parser.add_argument("-bs", "--batch_size", type=int, default=16, help="Number of tiles preprocessed at once.")
+    parser.add_argument("--processor", default="nvidia/mit-b0", help="Processor used by the inference.")
+    parser.add_argument("--tolerance", type=float, default=1e-5, help="Max absolute difference allowed with the HF processor.")
+    parser.add_argument("--seed", type=int, default=42, help="Seed of the random tiles.")
+
+    return parser.parse_args()
+
+
+def main(opt: Namespace) -> None:
+
+    processor = AutoImageProcessor.from_pretrained(opt.processor, do_reduce_labels=False, use_fast=False)
+
+    # Smooth tiles like orthos, noise only would hide the interpolation differences.
+    rng = np.random.default_rng(opt.seed)
+    tiles = rng.integers(0, 256, size=(opt.num_tiles, opt.tile_size // 8, opt.tile_size // 8, 3), dtype=np.uint8)
+    tiles = np.repeat(np.repeat(tiles, 8, axis=1), 8, axis=2)
+    tiles = np.clip(tiles.astype(np.int16) + rng.integers(-8, 9, size=tiles.shape), 0, 255).astype(np.uint8)
+    batches = [tiles[i:i + opt.batch_size] for i in range(0, opt.num_tiles, opt.batch_size)]
+
+    print(f"*\t {opt.num_tiles} tiles of {opt.tile_size} pixels by batch of {opt.batch_size}, resized to {processor.size}.")
+
+    t_start = time.perf_counter()
+    reference = [processor(list(batch), return_tensors="pt")["pixel_values"] for batch in batches]
+    time_processor = time.perf_counter() - t_start
+
+    t_start = time.perf_counter()
+    pixel_values = [preprocess_tiles(torch.from_numpy(batch).permute(0, 3, 1, 2), processor) for batch in batches]
+    time_batched = time.perf_counter() - t_start
+
+    max_difference = max((a - b).abs().max().item() for a, b in zip(reference, pixel_values))
+
+    print(f"*\t HF processor: {time_processor:.2f}s ({1e3 * time_processor / opt.num_tiles:.2f} ms by tile).")
+    print(f"*\t Batched tensors: {time_batched:.2f}s ({1e3 * time_batched / opt.num_tiles:.2f} ms by tile), speedup x{time_processor / time_batched:.2f}.")
+    print(f"*\t Max absolute difference: {max_difference:.2e}.")
+
+    if max_difference > opt.tolerance:
+        raise ValueError(f"The batched preprocessing differs from the HF processor by {max_difference:.2e}, more than {opt.tolerance:.0e}.")
+
+
+if __name__ == "__main__":
+    opt = parse_args()
+    main(opt)
@@ -0,0 +1,82 @@
+import sys
+import time
+import numpy as np
+from pathlib import Path
+from argparse import Namespace, ArgumentParser
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from src.utils.mosaic_tools import add_tiles_votes, create_mosaic_buffer, get_tile_crop, get_most_common_values, BLENDING_VOTE, MAX_VOTES_UINT16
+
+def parse_args() -> Namespace:
+
+    parser = ArgumentParser(prog="Vote kernel benchmark", description="Compare the per class vote loop with the one pass vote kernel on a synthetic mosaic.")
+
+    parser.add_argument("-nt", "--num_tiles", type=int, default=10000, help="Number of tiles of the synthetic mosaic, laid out on a square grid.")
+    parser.add_argument("-ts", "--tile_size", type=int, default=256, help="Size of the tiles.")
+    parser.add_argument("-tst", "--tile_step", type=int, default=64, help="Step between two tiles, 64 is an overlap of 0.75 for tiles of 256.")
+    parser.add_argument("-nc", "--num_classes", type=int, default=5, help="Number of classes.")
+    parser.add_argument("--num_distinct_tiles", type=int, default=64, help="Number of random tiles reused over the mosaic to limit memory.")
+    parser.add_argument("--seed", type=int, default=42, help="Seed of the random tiles.")
+
+    return parser.parse_args()
+
+
+def add_tile_votes_by_class(count_buffer: np.ndarray, tile_data: np.ndarray, row_off: int, col_off: int, global_min: int, global_max: int) -> None:
+    """ Reference kernel, one pass over the tile by class. """
+
+    crop = get_tile_crop(tile_data.shape, row_off, col_off, count_buffer.shape[1:])
+    if crop == None: return
+    (buffer_rows, buffer_cols), (tile_rows, tile_cols) = crop
+
+    tile_data = tile_data[tile_rows, tile_cols]
+    for value in range(global_min, global_max + 1):
+        count_buffer[value - global_min, buffer_rows, buffer_cols] += (tile_data == value)
+
+
+def main(opt: Namespace) -> None:
+
+    grid_size = int(np.ceil(np.sqrt(opt.num_tiles)))
+    mosaic_size = (grid_size - 1) * opt.tile_step + opt.tile_size
+    global_min, global_max = 1, opt.num_classes
+
+    rng = np.random.default_rng(opt.seed)
+    tiles = rng.integers(global_min, global_max + 1, size=(opt.num_distinct_tiles, opt.tile_size, opt.tile_size), dtype=np.uint8)
+    origins = [(i * opt.tile_step, j * opt.tile_step) for i in range(grid_size) for j in range(grid_size)][:opt.num_tiles]
+
+    print(f"*\t Mosaic of {len(origins)} tiles of {opt.tile_size} pixels with a step of {opt.tile_step}, buffer of {(opt.num_classes, mosaic_size, mosaic_size)}.")
+
+    count_buffer = np.zeros((opt.num_classes, mosaic_size, mosaic_size), dtype=np.uint16)
+    t_start = time.perf_counter()
+    for k, (row_off, col_off) in enumerate(origins):
+        add_tile_votes_by_class(count_buffer, tiles[k % len(tiles)], row_off, col_off, global_min, global_max)
+    time_by_class = time.perf_counter() - t_start
+    reference = get_most_common_values(count_buffer, global_min)
+    reference_sum = count_buffer.sum(axis=(1, 2))
+
+    # The uint16 buffer gets the votes by row band, the uint8 buffer directly when the overlap fits into it.
+    max_votes = (-(-opt.tile_size // opt.tile_step) + 1) ** 2
+    times_one_pass, same = {}, True
+    for max_votes_buffer in [MAX_VOTES_UINT16, max_votes]:
+        count_buffer = create_mosaic_buffer(BLENDING_VOTE, opt.num_classes, mosaic_size, mosaic_size, max_votes_buffer)
+        t_start = time.perf_counter()
+        for row_off in sorted({row_off for row_off, _ in origins}):
+            band = [(k, col_off) for k, (r, col_off) in enumerate(origins) if r == row_off]
+            add_tiles_votes(count_buffer, [tiles[k % len(tiles)] for k, _ in band], row_off, [col_off for _, col_off in band], global_min, global_max)
+        times_one_pass[count_buffer.dtype.name] = time.perf_counter() - t_start
+
+        same &= np.array_equal(reference, get_most_common_values(count_buffer, global_min)) and np.array_equal(reference_sum, count_buffer.sum(axis=(1, 2)))
+        del count_buffer
+
+    print(f"*\t Vote by class:  {time_by_class:.2f}s ({1e6 * time_by_class / len(origins):.0f} µs by tile).")
+    for dtype, time_one_pass in times_one_pass.items():
+        print(f"*\t One pass into {dtype}: {time_one_pass:.2f}s ({1e6 * time_one_pass / len(origins):.0f} µs by tile), speedup x{time_by_class / time_one_pass:.2f}.")
+    print(f"*\t Same votes: {same}.")
+
+    if not same:
+        raise ValueError("The one pass kernel doesn't give the same votes as the reference kernel.")
+
+
+if __name__ == "__main__":
+    opt = parse_args()
+    main(opt)
@@ -0,0 +1,182 @@
+import sys
+import json
+import time
+import torch
+from pathlib import Path
+from datetime import datetime
+from argparse import Namespace, ArgumentParser
+from torch.utils.flop_counter import FlopCounterMode
+
+import rasterio
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+import inference
+from bench_pipeline import create_synthetic_ortho, create_random_model, get_git_revision, get_peak_rss_mb
+from src.inference.TileManager import TileManager
+from src.inference.ModelManager import ModelManager
+from src.inference.EngineManager import ENGINE_EAGER, ENGINE_OPTIONS
+from src.inference.PathRasterManager import PathRasterManager
+from src.inference.StreamMosaicManager import StreamMosaicManager
+from src.utils.mosaic_tools import BLENDING_VOTE, WINDOW_NONE
+from src.utils.raster_constants import NO_DATA_VALUE
+
+MODE_TILES = "tiles"
+MODE_WINDOWS = "windows"
+
+
+def parse_args() -> Namespace:
+
+    parser = ArgumentParser(prog="Window inference benchmark", description="Compare the FLOPs, the wall time and the labels of the streaming inference by overlapping tiles and by windows with a halo on the same raster.")
+
+    # Raster and model, a synthetic ortho and a random tiny Segformer by default.
+    parser.add_argument("-pr", "--path_raster", default=None, help="Path to the raster, default is a synthetic ortho.")
+    parser.add_argument("-psm", "--path_segmentation_model", default=None, help="Path to the segmentation model, default is a random tiny Segformer. Agreement is only meaningful with a trained model.")
+    parser.add_argument("-ppr", "--path_processor", default="nvidia/mit-b0", help="Image processor of a trained model, the random model uses the one saved with it.")
+    parser.add_argument("--width", type=int, default=4096, help="Width in pixels of the synthetic ortho.")
+    parser.add_argument("--height", type=int, default=4096, help="Height in pixels of the synthetic ortho.")
+    parser.add_argument("--crs", default="EPSG:2975", help="CRS of the synthetic ortho.")
+    parser.add_argument("--resolution", type=float, default=0.2, help="Pixel size in CRS units of the synthetic ortho.")
+    parser.add_argument("--nodata_fraction", type=float, default=0.1, help="Fraction of the ortho columns, on the left, filled with black nodata pixels.")
+    parser.add_argument("-nc", "--num_classes", type=int, default=5, help="Number of classes of the random model.")
+    parser.add_argument("--seed", type=int, default=42, help="Seed of the synthetic ortho and of the random model.")
+
+    # Inference parameters, same as inference.py.
+    parser.add_argument("-ts", "--tile_size", type=int, default=256, help="Size of the tiles.")
+    parser.add_argument("-ho", "--horizontal_overlap", type=float, default=0.75, help="Horizontal overlap between tiles.")
+    parser.add_argument("-vo", "--vertical_overlap", type=float, default=0.75, help="Vertical overlap between tiles.")
+    parser.add_argument("-ws", "--window_size", type=int, default=1024, help="Size of the windows.")
+    parser.add_argument("--window_halo", type=int, default=64, help="Context pixels around each window.")
+    parser.add_argument("-bs", "--batch_size", type=int, default=16, help="Number of tiles by forward pass, capped by --memory_budget_mb for the windows.")
+    parser.add_argument("--memory_budget_mb", type=int, default=2048, help="Memory budget in MB of one forward pass of windows.")
+    parser.add_argument("-eng", "--engine", choices=list(ENGINE_OPTIONS), default=ENGINE_EAGER, help="CPU options of the forward pass, the ONNX exports have the input size of the tiles.")
+    parser.add_argument("--num_threads", type=int, default=0, help="Number of intra-op threads of torch, 0 keeps the torch default.")
+
+    # Output.
+    parser.add_argument("-po", "--path_output", default="./output/bench_windows", help="Folder of the synthetic data and of the final rasters of both modes.")
+    parser.add_argument("--path_results", default="./output/bench_windows/bench_windows.jsonl", help="One json line by run is appended to this file.")
+
+    return parser.parse_args()
+
+
+def count_forward_flops(model_manager: ModelManager, input_size: tuple[int, int]) -> int:
+    """ FLOPs of the forward pass of one image of input_size, upsampling and argmax excluded. """
+    pixel_values = torch.zeros(1, 3, *input_size, device=model_manager.device)
+    with torch.inference_mode(), FlopCounterMode(display=False) as flop_counter:
+        model_manager.model(pixel_values=pixel_values)
+
+    return flop_counter.get_total_flops()
+
+
+def run_mode(mode: str, opt: Namespace, raster_path: Path, model_path: Path, path_processor: str) -> tuple[dict, Path]:
+    """ Stream the raster in one mode and return its stats and the path of its final raster. """
+    print(f"\n*\t Mode {mode}.")
+    inference_opt = inference.parse_args([
+        "--enable_session", "--streaming", "-psm", str(model_path), "-ppr", path_processor, "-po", str(Path(opt.path_output, mode)),
+        "-ts", str(opt.tile_size), "-ho", str(opt.horizontal_overlap), "-vo", str(opt.vertical_overlap),
+        "-ws", str(opt.window_size if mode == MODE_WINDOWS else 0), "--window_halo", str(opt.window_halo),
+        "-bs", str(opt.batch_size), "--memory_budget_mb", str(opt.memory_budget_mb), "--num_writer_workers", "1",
+        "-eng", opt.engine, "--num_threads", str(opt.num_threads)
+    ])
+    # The synthetic ortho is outside the geojson areas, --path_geojson can't be emptied on the command line.
+    inference_opt.path_geojson = []
+    tile_manager = TileManager(inference_opt)
+    model_manager = ModelManager(inference_opt)
+
+    path_manager = PathRasterManager(inference_opt.path_output, raster_path)
+    path_manager.create_final_path()
+
+    # Forward passes counted by image, from the tiles or windows sent to the model.
+    num_images = 0
+    def count_images(read_fn):
+        def read_and_count(strip):
+            nonlocal num_images
+            images = read_fn(strip)
+            num_images += len(images)
+            return images
+        return read_and_count
+
+    t_start = time.perf_counter()
+    if mode == MODE_WINDOWS:
+        mosaic_manager = StreamMosaicManager(path_manager, model_manager.get_id2label(), opt.window_size, BLENDING_VOTE, WINDOW_NONE, 1)
+        model_manager.inference_windows(tile_manager.get_window_strips(path_manager, model_manager.batch_size), count_images(tile_manager.read_window_strip), mosaic_manager)
+        input_size = model_manager.window_input_size
+    else:
+        mosaic_manager = StreamMosaicManager(path_manager, model_manager.get_id2label(), opt.tile_size, BLENDING_VOTE, WINDOW_NONE, tile_manager.get_max_tiles_by_pixel())
+        model_manager.inference_stream(tile_manager.get_strips(path_manager, model_manager.batch_size), count_images(tile_manager.read_strip), mosaic_manager)
+        input_size = model_manager.processor.size["height"]
+    duration = time.perf_counter() - t_start
+
+    flops_by_image = count_forward_flops(model_manager, (input_size, input_size))
+    stats = {
+        "seconds": round(duration, 3),
+        "images": num_images,
+        "input_size": input_size,
+        "batch_size": model_manager.batch_size,
+        "gflops_by_image": round(flops_by_image / 1e9, 3),
+        "gflops": round(num_images * flops_by_image / 1e9, 1),
+        "peak_rss_mb": round(get_peak_rss_mb(), 1),
+    }
+    return stats, path_manager.final_merged_tiff_file
+
+
+def get_agreement(tiles_raster: Path, windows_raster: Path) -> dict:
+    """ Share of the pixels with the same label in both rasters, on the pixels labelled by both. """
+    with rasterio.open(tiles_raster) as tiles_src, rasterio.open(windows_raster) as windows_src:
+        tiles_labels, windows_labels = tiles_src.read(1), windows_src.read(1)
+
+    tiles_valid, windows_valid = tiles_labels != NO_DATA_VALUE, windows_labels != NO_DATA_VALUE
+    both_valid = tiles_valid & windows_valid
+    return {
+        "agreement": round(float((tiles_labels[both_valid] == windows_labels[both_valid]).mean()), 5) if both_valid.any() else None,
+        "labelled_pixels_tiles": int(tiles_valid.sum()),
+        "labelled_pixels_windows": int(windows_valid.sum()),
+        "labelled_pixels_both": int(both_valid.sum()),
+    }
+
+
+def main(opt: Namespace) -> None:
+
+    path_output = Path(opt.path_output)
+    path_output.mkdir(exist_ok=True, parents=True)
+
+    raster_path = Path(opt.path_raster) if opt.path_raster != None else Path(path_output, "synthetic_ortho.tif")
+    model_path = Path(opt.path_segmentation_model) if opt.path_segmentation_model != None else Path(path_output, "synthetic_model")
+    path_processor = opt.path_processor if opt.path_segmentation_model != None else str(model_path)
+    if opt.path_raster == None:
+        print(f"*\t Create a synthetic ortho of {opt.width}x{opt.height} pixels.")
+        create_synthetic_ortho(opt, raster_path)
+    if opt.path_segmentation_model == None:
+        print(f"*\t Create a random model of {opt.num_classes} classes.")
+        create_random_model(opt, model_path)
+
+    modes = {}
+    modes[MODE_TILES], tiles_raster = run_mode(MODE_TILES, opt, raster_path, model_path, path_processor)
+    modes[MODE_WINDOWS], windows_raster = run_mode(MODE_WINDOWS, opt, raster_path, model_path, path_processor)
+    agreement = get_agreement(tiles_raster, windows_raster)
+
+    results = {
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "revision": get_git_revision(),
+        "params": vars(opt),
+        "modes": modes,
+        "speedup": round(modes[MODE_TILES]["seconds"] / modes[MODE_WINDOWS]["seconds"], 2),
+        "flops_ratio": round(modes[MODE_TILES]["gflops"] / max(modes[MODE_WINDOWS]["gflops"], 1e-9), 2),
+        **agreement,
+    }
+
+    print("\n*\t Results:")
+    for mode, stats in modes.items():
+        print(f"*\t {mode:<8} {stats['seconds']:>8.2f}s {stats['images']:>6} images of {stats['input_size']} pixels, {stats['gflops']:>9.1f} GFLOPs, peak RSS {stats['peak_rss_mb']:.0f} MB")
+    print(f"*\t Speedup x{results['speedup']}, FLOPs ratio x{results['flops_ratio']}, agreement {results['agreement']} on {agreement['labelled_pixels_both']} pixels.")
+
+    path_results = Path(opt.path_results)
+    path_results.parent.mkdir(exist_ok=True, parents=True)
+    with open(path_results, "a") as f:
+        f.write(json.dumps(results) + "\n")
+    print(f"*\t Results appended to {path_results}.")
+
+
+if __name__ == "__main__":
+    opt = parse_args()
+    main(opt)
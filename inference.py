@@ -5,10 +5,16 @@ from argparse import Namespace, ArgumentParser
 from src.inference.TileManager import TileManager
 from src.inference.ModelManager import ModelManager
 from src.inference.MosaicManager import MosaicManager
+from src.inference.StreamMosaicManager import StreamMosaicManager
 from src.inference.PathRasterManager import PathRasterManager
+from src.inference.SchedulerManager import SchedulerManager
+from src.inference.EngineManager import ENGINES, ENGINE_EAGER, ONNX_ENGINES
+from src.inference.JournalManager import JournalManager, JOURNAL_TILES, JOURNAL_PNG, JOURNAL_PREDICTIONS
 from src.utils.lib_tools import get_list_rasters
+from src.utils.perf_tools import PerfReport
+from src.utils.mosaic_tools import BLENDING_VOTE, BLENDING_SOFT, BLENDING_LOGITS, WINDOW_NONE, WINDOW_GAUSSIAN, WINDOW_COSINE
 
-def parse_args() -> Namespace:
+def parse_args(args: list[str] | None = None) -> Namespace:
 
     parser = ArgumentParser(prog="Segmentation Inference", description="Workflow to perform segmentation inference on UAV orthophoto.")
 
@@ -25,11 +31,28 @@ def parse_args() -> Namespace:
 
     # Model arguments.
     parser.add_argument("-psm", "--path_segmentation_model", default="./models/SegIGNCoral-b0-2025_09_30_55357-bs16", help="Path to semgentation model, currently only in local.")
+    parser.add_argument("-ppr", "--path_processor", default="nvidia/mit-b0", help="Image processor of the model, a hub name or a local folder saved with save_pretrained.")
+    parser.add_argument("-bs", "--batch_size", type=int, default=16, help="Number of tiles by forward pass. Use 0 to fit the batch into --memory_budget_mb.")
+    parser.add_argument("--memory_budget_mb", type=int, default=2048, help="Memory budget in MB of one forward pass when batch size is 0.")
+    parser.add_argument("--num_reader_workers", type=int, default=4, help="Number of threads reading and preprocessing tiles for the model.")
+    parser.add_argument("--num_writer_workers", type=int, default=2, help="Number of threads writing predictions.")
+    parser.add_argument("--queue_depth", type=int, default=4, help="Max number of read tasks and predicted batches waiting between the pipeline stages. A read task is at most --batch_size tiles, a batch of images or a strip of tiles in --streaming, so at most about (2 x queue_depth + 1) x batch_size tiles are in memory.")
+    parser.add_argument("-eng", "--engine", choices=ENGINES, default=ENGINE_EAGER, help="CPU options of the forward pass: channels last layout, bf16 autocast and torch.compile, or ONNX Runtime with an export cached next to the model. auto benchmarks the engines available on the host and keeps the fastest, bf16 engines are checked against eager on a random batch, not on the rasters. Ignored on GPU.")
+    parser.add_argument("--num_threads", type=int, default=0, help="Number of intra-op threads of torch, 0 keeps the torch default.")
+    parser.add_argument("--num_interop_threads", type=int, default=0, help="Number of inter-op threads of torch, 0 keeps the torch default.")
     parser.add_argument("-pgeo", "--path_geojson", type=list, default=["./configs/emprise_lagoon.geojson"], help="Path to geojson to crop ortho inside area. We can use multiple geojson")
     
     parser.add_argument("-ho", "--horizontal_overlap", type=float, default=0.75, help="Horizontal overlap between tiles.")
     parser.add_argument("-vo", "--vertical_overlap", type=float, default=0.75, help="Vertical overlap between tiles.")
     parser.add_argument("-ts", "--tile_size", type=int, default=256, help="Split Orthophoto into tiles.")
+    parser.add_argument("-bl", "--blending", choices=[BLENDING_VOTE, BLENDING_SOFT, BLENDING_LOGITS], default=BLENDING_VOTE, help="Merge overlapping tiles by majority vote on labels or by accumulating class probabilities. Soft blending allows a lower overlap, like 0.5. Logits blending accumulates the logits at the 1/4 resolution of the model and upsamples them once by block of rows, only with --streaming.")
+    parser.add_argument("-bw", "--blending_window", choices=[WINDOW_NONE, WINDOW_GAUSSIAN, WINDOW_COSINE], default=WINDOW_NONE, help="Weight the probabilities or logits of the tile pixels in soft and logits blending, edges count less.")
+    parser.add_argument("-st", "--streaming", action="store_true", help="Stream tiles from the ortho to the model and the mosaic without writing intermediate files.")
+    parser.add_argument("--dedup_tiles", action="store_true", help="Predict identical tiles once and share the prediction. Uniform tiles, like open water, are matched by color, the other tiles by a hash of their pixels.")
+    parser.add_argument("--dedup_cache_mb", type=int, default=256, help="Memory of the predictions cached by --dedup_tiles, the least recently used are evicted. A prediction is a mask, or one float16 band by class in soft blending.")
+    parser.add_argument("--uniform_tolerance", type=int, default=0, help="Max range in levels of each band of a uniform tile, 0 only shares the predictions of constant tiles and keeps the labels unchanged. Above 0, nearly uniform tiles of one color bucket share the prediction of the first one, which can change their labels.")
+    parser.add_argument("-ws", "--window_size", type=int, default=0, help="With --streaming, predict windows of this size side by side in one forward pass each instead of overlapping tiles, like 1024. 0 keeps the tiles. Each pixel is predicted once, so --blending is not used. Windows and their halo are resized like the tiles, by the model input size over --tile_size, so 1024 with a halo of 64 and 256 pixel tiles for a 512 pixel model gives (1024 + 2 x 64) x 2 = 2304x2304 inputs. The batch size is capped by --memory_budget_mb, a warning is printed if one window is over it.")
+    parser.add_argument("--window_halo", type=int, default=64, help="Context pixels around each window, predicted and cropped away.")
 
     # Output.
     parser.add_argument("-po" , "--path_output", default="./output", help="Path of output")
@@ -38,8 +61,27 @@ def parse_args() -> Namespace:
     parser.add_argument("-is", "--index_start", default="0", help="Choose from which index to start")
     parser.add_argument("-c", "--clean", action="store_true", help="Delete all previous file")
     parser.add_argument("--max_pixels_by_slice_of_rasters", type=int, default=800000000, help="Max pixels number into intermediate rasters to avoid RAM overload.")
-
-    return parser.parse_args()
+    parser.add_argument("--num_mosaic_workers", type=int, default=4, help="Number of processes voting the slices of the final raster, they share --max_pixels_by_slice_of_rasters.")
+    parser.add_argument("--memmap_vote_buffer", action="store_true", help="Back the vote buffers with scratch files in the tmp folder, the raster is then built in one slice by mosaic worker, ceil(height / --num_mosaic_workers) rows each, and --max_pixels_by_slice_of_rasters only bounds the RAM of the blocks resolved at once.")
+
+    # Pipeline of rasters.
+    parser.add_argument("-pl", "--pipeline", action="store_true", help="Overlap the tiling of the next raster, the inference of the current raster and the mosaic of the previous one. Not used with --streaming.")
+    parser.add_argument("--disk_budget_gb", type=float, default=50, help="With --pipeline, the next raster is tiled only when the intermediate files of the rasters in progress are under this size.")
+    parser.add_argument("--mosaic_memory_budget_mb", type=int, default=8192, help="With --pipeline, memory of the vote buffers of the mosaic running along the model, it caps --max_pixels_by_slice_of_rasters.")
+
+    opt = parser.parse_args(args)
+    if opt.blending == BLENDING_LOGITS and not opt.streaming:
+        parser.error(f"--blending {BLENDING_LOGITS} needs --streaming.")
+    if opt.window_size > 0 and not opt.streaming:
+        parser.error("--window_size needs --streaming.")
+    if opt.window_size > 0 and not 0 <= opt.window_halo < opt.window_size:
+        parser.error("--window_halo must be positive and smaller than --window_size.")
+    if opt.window_size > 0 and opt.engine in ONNX_ENGINES:
+        parser.error(f"--window_size can't use the {opt.engine} engine, the ONNX export has the input size of the tiles.")
+    if opt.window_size > 0 and opt.dedup_tiles:
+        parser.error("--dedup_tiles can't be used with --window_size, windows are not deduplicated.")
+
+    return opt
 
 def main_raster(opt: Namespace) -> None:
 
@@ -53,38 +95,70 @@ def main_raster(opt: Namespace) -> None:
     index_start = int(opt.index_start) if opt.index_start.isnumeric() and int(opt.index_start) < len(list_rasters) else 0
     list_rasters = list_rasters[index_start:]
     rasters_fail = []
-    for i, raster_path in enumerate(list_rasters):
-        # Filter all files who are not rasters files
-        if not raster_path.is_file() or raster_path.suffix != ".tif": continue
-
-        print(f"\n\n--- {i+1}/{len(list_rasters)} - Working with {raster_path.stem}")        
-        t_start = datetime.now()
-        path_manager = PathRasterManager(opt.path_output, raster_path)
-
-        # Clean if needed
-        path_manager.clean() if opt.clean else path_manager.create_path()
-
-        try:
-            if opt.clean or path_manager.is_empty_cropped_folder():
-                tile_manager.split_ortho_into_tiles(path_manager)
-
-            if opt.clean or path_manager.is_empty_cropped_img_folder():
-                tile_manager.convert_tiff_tiles_into_png(path_manager)
-
-            if opt.clean or path_manager.is_empty_predictions_tiff_folder():
-                model_manager.inference(path_manager)
-            
-            mosaic_manager = MosaicManager(path_manager, model_manager.get_id2label(), opt.max_pixels_by_slice_of_rasters)
-            mosaic_manager.build_raster()
+    if opt.pipeline and not opt.streaming:
+        print("*\t Tiling, inference and mosaic of consecutive rasters are overlapped.")
+        rasters_fail = SchedulerManager(opt, tile_manager, model_manager).run(list_rasters)
+    else:
+        for i, raster_path in enumerate(list_rasters):
+            # Filter all files who are not rasters files
+            if not raster_path.is_file() or raster_path.suffix != ".tif": continue
+
+            print(f"\n\n--- {i+1}/{len(list_rasters)} - Working with {raster_path.stem}")        
+            t_start = datetime.now()
+            path_manager = PathRasterManager(opt.path_output, raster_path)
+
+            # Clean if needed
+            if opt.streaming:
+                path_manager.create_final_path()
+            else:
+                path_manager.clean() if opt.clean else path_manager.create_path()
+
+            perf_report = PerfReport(raster_path.name)
+            try:
+                if opt.streaming:
+                    # Tiles, predictions and votes stay in memory until the final raster.
+                    with perf_report.stage("streaming"):
+                        if opt.window_size > 0:
+                            # Window cores don't overlap, one vote by pixel.
+                            mosaic_manager = StreamMosaicManager(path_manager, model_manager.get_id2label(), opt.window_size, BLENDING_VOTE, WINDOW_NONE, 1)
+                            model_manager.inference_windows(tile_manager.get_window_strips(path_manager, model_manager.batch_size), tile_manager.read_window_strip, mosaic_manager)
+                        else:
+                            mosaic_manager = StreamMosaicManager(path_manager, model_manager.get_id2label(), opt.tile_size, opt.blending, opt.blending_window, tile_manager.get_max_tiles_by_pixel(), model_manager.get_logits_size())
+                            model_manager.inference_stream(tile_manager.get_strips(path_manager, model_manager.batch_size), tile_manager.read_strip, mosaic_manager)
+                    perf_report.add_input_files("streaming", model_manager.get_num_predicted())
+                    perf_report.add_metrics("streaming", model_manager.get_dedup_stats())
+                else:
+                    # A restarted raster continues from the tiles recorded in its journal, a cleaned raster has no journal.
+                    journal = JournalManager(path_manager.journal_file)
+
+                    if not journal.is_stage_done(JOURNAL_TILES):
+                        with perf_report.stage("tiling", path_manager.cropped_ortho_folder):
+                            tile_manager.split_ortho_into_tiles(path_manager, journal)
+
+                    if not journal.is_stage_done(JOURNAL_PNG):
+                        with perf_report.stage("conversion", path_manager.cropped_ortho_img_folder):
+                            tile_manager.convert_tiff_tiles_into_png(path_manager, journal)
+
+                    if not journal.is_stage_done(JOURNAL_PREDICTIONS):
+                        with perf_report.stage("inference", path_manager.predictions_tiff_folder):
+                            model_manager.inference(path_manager, journal)
+                        perf_report.add_metrics("inference", model_manager.get_dedup_stats())
+
+                    # Files of the mosaic stage are the prediction tiles voted into the final raster, it writes none in their folder.
+                    with perf_report.stage("mosaic"):
+                        mosaic_manager = MosaicManager(path_manager, model_manager.get_id2label(), opt.max_pixels_by_slice_of_rasters, opt.blending, opt.blending_window, opt.memmap_vote_buffer, opt.num_mosaic_workers)
+                        mosaic_manager.build_raster()
+                    perf_report.add_input_files("mosaic", len(mosaic_manager.predictions_tiff_files))
             
-        except Exception as e:
-            print(traceback.format_exc(), end="\n\n")
-            rasters_fail.append(raster_path.name)
-        finally:
-            if opt.clean:
-                path_manager.disk_optimize() 
-
-        print(f"\n*\t Running time {datetime.now() - t_start}")
+            except Exception as e:
+                print(traceback.format_exc(), end="\n\n")
+                rasters_fail.append(raster_path.name)
+            finally:
+                perf_report.save(path_manager.perf_report_file)
+                if opt.clean:
+                    path_manager.disk_optimize() 
+
+            print(f"\n*\t Running time {datetime.now() - t_start}")
 
     # Stat
     print(f"\nEnd of process. On {len(list_rasters)} rasters, {len(rasters_fail)} fails.")
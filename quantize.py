@@ -0,0 +1,69 @@
+import random
+from pathlib import Path
+from argparse import Namespace, ArgumentParser
+
+from src.ConfigParser import ConfigParser
+from src.PathManager import PathManager
+from src.training.dataset import DatasetManager
+from src.inference.EngineManager import ENGINE_ONNX_INT8_DYNAMIC, ENGINE_ONNX_INT8_STATIC
+from src.inference.QuantizationManager import QuantizationManager
+
+MODE_DYNAMIC = "dynamic"
+MODE_STATIC = "static"
+MODE_BOTH = "both"
+
+def parse_args() -> Namespace:
+
+    parser = ArgumentParser(prog="Segmentation quantization", description="Create INT8 ONNX versions of the segmentation model and report their accuracy against the float model.")
+
+    # Config.
+    parser.add_argument("-cp", "--config_path", default="./configs/config_base.json", help="Path to the config file.")
+    parser.add_argument("-ep", "--env_path", default="./.env", help="Path to the env file.")
+
+    # Model arguments.
+    parser.add_argument("-psm", "--path_segmentation_model", default=None, help="Path to the segmentation model, default is the coarse model of the config.")
+    parser.add_argument("-m", "--mode", choices=[MODE_DYNAMIC, MODE_STATIC, MODE_BOTH], default=MODE_BOTH, help="Dynamic quantization of the matmuls, static quantization calibrated on the training tiles, or both.")
+    parser.add_argument("-bs", "--batch_size", type=int, default=8, help="Number of tiles by forward pass.")
+    parser.add_argument("--num_threads", type=int, default=0, help="Number of intra-op threads of ONNX Runtime, 0 keeps the default.")
+    parser.add_argument("--num_calibration_tiles", type=int, default=256, help="Number of tiles drawn from tiles_coarse/train/images to calibrate the static quantization.")
+    parser.add_argument("--max_validation_tiles", type=int, default=0, help="Max number of tiles of the validation split in the report, 0 to use all of them.")
+    parser.add_argument("--seed", type=int, default=42, help="Seed of the calibration tiles.")
+
+    return parser.parse_args()
+
+
+def main(opt: Namespace) -> None:
+
+    cp = ConfigParser(opt)
+    pm = PathManager(cp.output_path)
+
+    model_path = Path(opt.path_segmentation_model) if opt.path_segmentation_model != None else cp.model_path_coarse
+    if model_path == None or not model_path.is_dir():
+        raise FileNotFoundError(f"Cannot find the segmentation model at {model_path}")
+
+    print("\n\n------ [QUANTIZATION - Create INT8 models] ------\n")
+    quantization_manager = QuantizationManager(model_path, opt.batch_size, opt.num_threads)
+
+    engines = []
+    if opt.mode in [MODE_DYNAMIC, MODE_BOTH]:
+        quantization_manager.quantize_dynamic()
+        engines.append(ENGINE_ONNX_INT8_DYNAMIC)
+
+    if opt.mode in [MODE_STATIC, MODE_BOTH]:
+        images = sorted(f for f in pm.coarse_train_images_folder.iterdir() if f.suffix.lower() == ".png")
+        calibration_images = random.Random(opt.seed).sample(images, min(opt.num_calibration_tiles, len(images)))
+        quantization_manager.quantize_static(calibration_images)
+        engines.append(ENGINE_ONNX_INT8_STATIC)
+
+    print("\n\n------ [QUANTIZATION - Accuracy report on the validation split] ------\n")
+    dataset_manager = DatasetManager(cp, pm.coarse_train_folder)
+    dataset_manager.load_datasets()
+    dataset_manager.attach_transforms()
+
+    report_path = Path(model_path.parent, f"{model_path.name}.quantization_report.json")
+    quantization_manager.evaluate(dataset_manager.validation_ds, dataset_manager.num_labels, engines, report_path, opt.max_validation_tiles)
+
+
+if __name__ == "__main__":
+    opt = parse_args()
+    main(opt)
@@ -4,14 +4,17 @@ from pathlib import Path
 
 from .ConfigParser import ConfigParser
 from .PathManager import PathManager
+from .utils.perf_tools import PerfReport
 from .utils.tiles_tools import clip_raster_to_polygons, incremental_merge_tifs_windowed
 from .utils.zenodo_downloader import file_downloader, extract_7z_parts
 
 class IGNManager:
 
-    def __init__(self, cp: ConfigParser, pm: PathManager):
+    def __init__(self, cp: ConfigParser, pm: PathManager, perf_report: PerfReport | None = None):
         self.cp = cp
         self.pm = pm
+        # Download and clip are timed as separate stages of the report of the caller.
+        self.perf_report = perf_report if perf_report != None else PerfReport("ign")
 
         self.setup()
 
@@ -19,8 +22,10 @@ class IGNManager:
     def setup(self) -> None:
         
         if not self.pm.ign_useful_data.exists() or len(list(self.pm.ign_useful_data.iterdir())) == 0:
-            self.download_and_uncompress()
-            self.convert_and_cut_ign_data()
+            with self.perf_report.stage("ign_download", self.pm.ign_raw_data):
+                self.download_and_uncompress()
+            with self.perf_report.stage("ign_clip", self.pm.ign_useful_data):
+                self.convert_and_cut_ign_data()
 
 
     def get_orthophoto_by_place(self, place: str) -> list[Path]:
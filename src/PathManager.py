@@ -36,6 +36,7 @@ class PathManager:
         self.refine_train_annotation_folder = Path(self.refine_train_folder, "annotations")
 
         self.ign_prediction_inference_raster_folder = Path(self.output_path, "final_predictions_raster")
+        self.perf_report_file = Path(self.output_path, "train_perf_report.json")
 
 
 
@@ -1,11 +1,12 @@
 
+import shapely
 import numpy as np
 import pandas as pd
 from tqdm import tqdm
 from PIL import Image
 import geopandas as gpd
 from pathlib import Path
-from shapely.geometry import box, mapping
+from shapely.geometry import box, mapping, Polygon
 from multiprocessing import Pool, cpu_count
 
 import rasterio
@@ -17,11 +18,116 @@ from .ConfigParser import ConfigParser
 from .PathManager import PathManager
 from .UAVManager import UAVManager
 from .IGNManager import IGNManager
-from .utils.tiles_tools import convert_one_tiff_to_png
+from .utils.tiles_tools import convert_one_tiff_to_png, get_ortho_tiles_keep_mask
 
 
 NUM_WORKERS = max(1, cpu_count() - 2)  # Use available CPU cores, leaving some free
 
+# State of a tiling worker, set once by init_tile_worker.
+worker_state = {}
+
+
+def init_tile_worker(session_name: str, orthophoto_path: Path, annotation_path: Path, boundary_ign, zone_test, tile_size: int, ortho_output_folder: Path, annotation_output_folder: Path) -> None:
+    """ Pool initializer, open the ortho and the annotation once by worker and prepare the geometries. """
+    shapely.prepare(boundary_ign)
+    shapely.prepare(zone_test)
+
+    worker_state.update({
+        "session_name": session_name,
+        "year": orthophoto_path.name.split("-")[1],
+        "ortho": rasterio.open(orthophoto_path),
+        "annotation": rasterio.open(annotation_path),
+        "boundary_ign": boundary_ign,
+        "zone_test": zone_test,
+        "tile_size": tile_size,
+        "ortho_output_folder": ortho_output_folder,
+        "annotation_output_folder": annotation_output_folder,
+    })
+
+
+def process_strip(strip: tuple[int, list[int]]) -> None:
+    """ Read the window covering the tiles of the strip inside the boundary once, then write each tile and its annotation. """
+    tile_y, tiles_x = strip
+    ortho, tile_size = worker_state["ortho"], worker_state["tile_size"]
+
+    tiles_bounds = {}
+    for tile_x in tiles_x:
+        tile_bounds = box(*rasterio.windows.bounds(Window(tile_x, tile_y, tile_size, tile_size), ortho.transform))
+
+        # Require tile to be fully inside the detailed boundary and skip if intersects test zone
+        if worker_state["boundary_ign"].contains(tile_bounds) and not tile_bounds.intersects(worker_state["zone_test"]):
+            tiles_bounds[tile_x] = tile_bounds
+
+    if len(tiles_bounds) == 0: return
+
+    strip_col_off = min(tiles_bounds)
+    strip_ortho = ortho.read(window=Window(strip_col_off, tile_y, max(tiles_bounds) + tile_size - strip_col_off, tile_size))
+
+    for tile_x, tile_bounds in tiles_bounds.items():
+        process_tile(tile_x, tile_y, tile_bounds, strip_ortho[:, :, tile_x - strip_col_off:tile_x - strip_col_off + tile_size])
+
+
+def process_tile(tile_x: int, tile_y: int, tile_bounds: Polygon, tile_data: np.ndarray) -> None:
+    ortho, annotation = worker_state["ortho"], worker_state["annotation"]
+    tile_size = worker_state["tile_size"]
+    window = Window(tile_x, tile_y, tile_size, tile_size)
+
+    tile_transform = rasterio.windows.transform(window, ortho.transform)
+
+    tile_filename = f"{worker_state['session_name']}_{worker_state['year']}_{tile_x}_{tile_y}.tif"
+    tile_output_path = Path(worker_state["ortho_output_folder"], tile_filename)
+    
+    meta = ortho.meta.copy()
+    meta.update({
+        "height": tile_size, 
+        "width": tile_size, 
+        "transform": tile_transform
+    })
+
+    with rasterio.open(tile_output_path, "w", **meta) as dest:
+        dest.write(tile_data)
+
+
+    tile_geom = mapping(tile_bounds)
+    output_path = Path(worker_state["annotation_output_folder"], tile_filename)
+
+    try:
+        cropped, cropped_transform = mask(annotation, [tile_geom], crop=True)
+
+        resampled = np.zeros((annotation.count, tile_size, tile_size), dtype=cropped.dtype)
+
+        for i in range(annotation.count):
+            reproject(
+                source=cropped[i],
+                destination=resampled[i],
+                src_transform=cropped_transform,
+                src_crs=annotation.crs,
+                dst_transform=cropped_transform * annotation.transform.scale(
+                    cropped.shape[2] / tile_size,
+                    cropped.shape[1] / tile_size
+                ),
+                dst_crs=annotation.crs,
+                resampling=Resampling.nearest
+            )
+
+        out_meta = annotation.meta.copy()
+        out_meta.update({
+            "height": tile_size,
+            "width": tile_size,
+            "transform": cropped_transform * annotation.transform.scale(
+                cropped.shape[2] / tile_size,
+                cropped.shape[1] / tile_size
+            ),
+            "dtype": resampled.dtype
+        })
+
+        with rasterio.open(output_path, "w", **out_meta) as dest:
+            dest.write(resampled)
+
+    except Exception as e:
+        print(f"❌ Failed to process {tile_filename}: {e}")
+
+
 class TileManager:
 
     def __init__(self, cp: ConfigParser, pm: PathManager):
@@ -68,13 +174,18 @@ class TileManager:
                     boundary_ign = self.load_geojson_with_crs(ortho.crs, self.cp.list_boundary_ign_geojson)
                     zone_test = self.load_geojson_with_crs(ortho.crs, self.cp.list_drone_test_geojson)
  
-                    tile_coords = [
-                        (session_name, x, y, ortho_path, annotation_path, boundary_ign, zone_test)
-                        for x in range(0, ortho.width - self.cp.tile_size + 1, self.cp.horizontal_step)
-                        for y in range(0, ortho.height - self.cp.tile_size + 1, self.cp.vertical_step)
-                    ]
-                with Pool(NUM_WORKERS) as pool:
-                    list(tqdm(pool.imap_unordered(self.process_tile, tile_coords), total=len(tile_coords)))
+                    xs = list(range(0, ortho.width - self.cp.tile_size + 1, self.cp.horizontal_step))
+                    ys = list(range(0, ortho.height - self.cp.tile_size + 1, self.cp.vertical_step))
+
+                    # Filter out mostly black or white tiles in one pass over the ortho.
+                    keep_mask = get_ortho_tiles_keep_mask(ortho, xs, ys, self.cp.tile_size)
+
+                    strips = [(y, [x for j, x in enumerate(xs) if keep_mask[i, j]]) for i, y in enumerate(ys) if keep_mask[i].any()]
+
+                # Workers open the rasters and get the geometries once, tasks only carry the strip row and its tiles columns.
+                initargs = (session_name, ortho_path, annotation_path, boundary_ign, zone_test, self.cp.tile_size, self.pm.coarse_cropped_ortho_tif_folder, self.pm.coarse_annotation_tif_folder)
+                with Pool(NUM_WORKERS, initializer=init_tile_worker, initargs=initargs) as pool:
+                    list(tqdm(pool.imap_unordered(process_strip, strips), total=len(strips), unit="strip"))
 
 
     def convert_tiff_to_png(self, input_dir: Path, output_dir: Path) -> None:
@@ -133,93 +244,3 @@ class TileManager:
                 continue
 
         print(f"We have delete {cpt} annotations")
-
-
-    def process_tile(self, args: tuple[str, int, int, Path, Path]) -> None:
-        session_name, tile_x, tile_y, orthophoto_path, annotation_path, boundary_ign, zone_test = args
-        tile_size = self.cp.tile_size
-        year = orthophoto_path.name.split("-")[1]
-
-        with rasterio.open(orthophoto_path) as ortho:
-            
-            window = Window(tile_x, tile_y, tile_size, tile_size)
-            tile_bounds = box(*rasterio.windows.bounds(window, ortho.transform))
-            
-            # Require tile to be fully inside the detailed boundary
-            if not boundary_ign.contains(tile_bounds):
-                return
-            
-            # Skip if intersects test zone
-            if tile_bounds.intersects(zone_test): return
-
-            tile_data = ortho.read(window=window)
-            tile_transform = rasterio.windows.transform(window, ortho.transform)
-
-            # Apply threshold to filter out mostly black or white tiles
-            greyscale_tile = np.sum(tile_data, axis=0) / 3
-            
-            # Black threshold.
-            percentage_black_pixel = np.sum(greyscale_tile == 0) * 100 / tile_size**2
-            if percentage_black_pixel > 5: 
-                return
-            
-            # White threshold.
-            percentage_white_pixel = np.sum(greyscale_tile == 255) * 100 / tile_size**2
-            if percentage_white_pixel > 10: 
-                return
-
-
-            tile_filename = f"{session_name}_{year}_{tile_x}_{tile_y}.tif"
-            tile_output_path = Path(self.pm.coarse_cropped_ortho_tif_folder, tile_filename)
-            
-            meta = ortho.meta.copy()
-            meta.update({
-                "height": tile_size, 
-                "width": tile_size, 
-                "transform": tile_transform
-            })
-
-            with rasterio.open(tile_output_path, "w", **meta) as dest:
-                dest.write(tile_data)
-
-
-            tile_geom = mapping(box(*rasterio.windows.bounds(window, ortho.transform)))
-            tile_filename = f"{session_name}_{year}_{tile_x}_{tile_y}.tif"
-            output_path = Path(self.pm.coarse_annotation_tif_folder, tile_filename)
-
-            with rasterio.open(annotation_path) as annotation:
-                try:
-                    cropped, cropped_transform = mask(annotation, [tile_geom], crop=True)
-
-                    resampled = np.zeros((annotation.count, tile_size, tile_size), dtype=cropped.dtype)
-
-                    for i in range(annotation.count):
-                        reproject(
-                            source=cropped[i],
-                            destination=resampled[i],
-                            src_transform=cropped_transform,
-                            src_crs=annotation.crs,
-                            dst_transform=cropped_transform * annotation.transform.scale(
-                                cropped.shape[2] / tile_size,
-                                cropped.shape[1] / tile_size
-                            ),
-                            dst_crs=annotation.crs,
-                            resampling=Resampling.nearest
-                        )
-
-                    out_meta = annotation.meta.copy()
-                    out_meta.update({
-                        "height": tile_size,
-                        "width": tile_size,
-                        "transform": cropped_transform * annotation.transform.scale(
-                            cropped.shape[2] / tile_size,
-                            cropped.shape[1] / tile_size
-                        ),
-                        "dtype": resampled.dtype
-                    })
-
-                    with rasterio.open(output_path, "w", **out_meta) as dest:
-                        dest.write(resampled)
-
-                except Exception as e:
-                    print(f"❌ Failed to process {tile_filename}: {e}")
@@ -6,14 +6,17 @@ from pathlib import Path
 
 from .PathManager import PathManager
 from .ConfigParser import ConfigParser
+from .utils.perf_tools import PerfReport
 from .utils.zenodo_downloader import download_manager_without_token, get_version_from_session_name
 
 class UAVManager:
 
-    def __init__(self, cp: ConfigParser, pm: PathManager) -> None:
+    def __init__(self, cp: ConfigParser, pm: PathManager, perf_report: PerfReport | None = None) -> None:
         
         self.cp = cp
         self.pm = pm
+        # Download and remap are timed as separate stages of the report of the caller.
+        self.perf_report = perf_report if perf_report != None else PerfReport("uav")
 
         self.annotations_files = []
         self.setup()
@@ -22,24 +25,30 @@ class UAVManager:
     def setup(self) -> None:
         
         print("\n\n------ [UAV - Download Annotations from Zenodo] ------\n")
-        # Download sessions
-        for session in self.cp.uav_sessions:
-            session_path = Path(self.pm.uav_sessions_folder, session)
-            self.setup_session_uav(session_path)
-
-            session_path_ia = Path(session_path, "PROCESSED_DATA", "IA")
-            if not session_path_ia.exists() or not session_path_ia.is_dir() or len(list(session_path_ia.iterdir())) == 0: 
-                print(f"Cannot find raster folder for session {session_path_ia}")
-                return
-            
-            ia_filepath = Path(session_path_ia, f"{session}_{self.cp.uav_segmentation_model_name}_ortho_predictions.tif")
-            if not ia_filepath.exists() or not ia_filepath.is_file(): 
-                print(f"Cannot find raster for session {ia_filepath}")
-                return
-            
-            
-            ia_filepath_4band = Path(session_path_ia, f"{session}_{self.cp.uav_segmentation_model_name}_ortho_predictions_4band.tif")
-            self.generate_4band_raster(ia_filepath, ia_filepath_4band)
+        # Download sessions, the sessions after a session without raster are skipped.
+        ia_filepaths = []
+        with self.perf_report.stage("uav_download"):
+            for session in self.cp.uav_sessions:
+                session_path = Path(self.pm.uav_sessions_folder, session)
+                self.setup_session_uav(session_path)
+
+                session_path_ia = Path(session_path, "PROCESSED_DATA", "IA")
+                if not session_path_ia.exists() or not session_path_ia.is_dir() or len(list(session_path_ia.iterdir())) == 0: 
+                    print(f"Cannot find raster folder for session {session_path_ia}")
+                    break
+                
+                ia_filepath = Path(session_path_ia, f"{session}_{self.cp.uav_segmentation_model_name}_ortho_predictions.tif")
+                if not ia_filepath.exists() or not ia_filepath.is_file(): 
+                    print(f"Cannot find raster for session {ia_filepath}")
+                    break
+                
+                ia_filepath_4band = Path(session_path_ia, f"{session}_{self.cp.uav_segmentation_model_name}_ortho_predictions_4band.tif")
+                ia_filepaths.append((ia_filepath, ia_filepath_4band))
+
+        # Rasters are in the folder of each session, the stage counts the rasters remapped.
+        with self.perf_report.stage("uav_remap"):
+            num_remapped = sum(self.generate_4band_raster(ia_filepath, ia_filepath_4band) for ia_filepath, ia_filepath_4band in ia_filepaths)
+        self.perf_report.add_input_files("uav_remap", num_remapped)
 
 
     def setup_session_uav(self, session_path: Path) -> None:
@@ -67,8 +76,8 @@ class UAVManager:
         download_manager_without_token(list_files, session_path, doi)
     
 
-    def generate_4band_raster(self, ia_filepath: Path, ia_filepath_4band: Path) -> None:
-        """ Transform the SegForcoral output into a 4 values raster."""
+    def generate_4band_raster(self, ia_filepath: Path, ia_filepath_4band: Path) -> bool:
+        """ Transform the SegForcoral output into a 4 values raster. Return False if it was already transformed. """
 
         print("Transform the raster into a 4 values raster without tabular. ")
 
@@ -76,7 +85,7 @@ class UAVManager:
 
         if ia_filepath_4band.exists():
             print("File has been already transform")
-            return
+            return False
         
         # Transform Tabular into other corals and shift index.
         with rasterio.open(ia_filepath) as src:
@@ -105,4 +114,6 @@ class UAVManager:
         }
 
         with rasterio.open(ia_filepath_4band, "w+", **new_profile) as dst:
-            dst.write(new_data, 1)
\ No newline at end of file
+            dst.write(new_data, 1)
+
+        return True
\ No newline at end of file
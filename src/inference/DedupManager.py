@@ -0,0 +1,107 @@
+import torch
+import hashlib
+import numpy as np
+from typing import Callable
+from collections import OrderedDict
+
+
+class DedupManager:
+    """
+        Predict identical tiles once. A tile is uniform if the range of each band is at most tolerance levels, its
+        fingerprint is its size and its mid color by buckets of tolerance + 1 levels. The fingerprint of the other
+        tiles is a hash of their uint8 pixels, only exact duplicates share it. Fingerprints are computed by the
+        readers before the preprocessing. Predictions are cached for the current raster, the least recently used
+        ones are evicted over cache_bytes.
+    """
+
+    def __init__(self, tolerance: int, cache_bytes: int):
+        self.tolerance = tolerance
+        self.cache_bytes = cache_bytes
+
+        self.cache: OrderedDict[tuple, np.ndarray] = OrderedDict()
+        self.cached_bytes = 0
+        self.num_tiles, self.num_uniform_tiles, self.num_forward_saved = 0, 0, 0
+
+
+    def reset(self) -> None:
+        self.cache = OrderedDict()
+        self.cached_bytes = 0
+        self.num_tiles, self.num_uniform_tiles, self.num_forward_saved = 0, 0, 0
+
+
+    def get_uniform_fingerprint(self, tile: np.ndarray) -> tuple | None:
+        """ Return the fingerprint of a (3, H, W) uint8 tile by its color, None if it isn't uniform. """
+        bands = tile.reshape(tile.shape[0], -1)
+        min_levels, max_levels = bands.min(axis=1).astype(int), bands.max(axis=1).astype(int)
+        if (max_levels - min_levels).max() > self.tolerance:
+            return None
+
+        mid_levels = (min_levels + max_levels) // 2 // (self.tolerance + 1)
+        return (*tile.shape[1:], *mid_levels.tolist())
+
+
+    def get_fingerprint(self, tile: np.ndarray) -> tuple:
+        """ Return the color fingerprint of a uniform (3, H, W) uint8 tile, else the hash of its pixels. """
+        fingerprint = self.get_uniform_fingerprint(tile)
+        if fingerprint != None:
+            return ("uniform", *fingerprint)
+
+        digest = hashlib.blake2b(np.ascontiguousarray(tile).tobytes(), digest_size=16).digest()
+        return ("content", *tile.shape[1:], digest)
+
+
+    def add_to_cache(self, fingerprint: tuple, prediction: np.ndarray) -> None:
+        """ Cache a copy of the prediction, then evict the least recently used predictions over the cache size. """
+        if prediction.nbytes > self.cache_bytes: return
+
+        self.cache[fingerprint] = prediction.copy()
+        self.cached_bytes += prediction.nbytes
+        while self.cached_bytes > self.cache_bytes:
+            _, evicted = self.cache.popitem(last=False)
+            self.cached_bytes -= evicted.nbytes
+
+
+    def predict(self, tiles: list[tuple[torch.Tensor, tuple]], predict_fn: Callable[[list[torch.Tensor]], np.ndarray]) -> np.ndarray:
+        """
+            tiles are (pixel_values, fingerprint) pairs. Run predict_fn on one tile by fingerprint missing in the
+            cache, then fan out the predictions.
+        """
+        pixel_values, fingerprints = [values for values, _ in tiles], [fingerprint for _, fingerprint in tiles]
+
+        # Index in the batch of the tile predicted for each fingerprint of the batch missing in the cache.
+        to_predict, predicted_fingerprints = [], {}
+        for i, fingerprint in enumerate(fingerprints):
+            if fingerprint not in self.cache and fingerprint not in predicted_fingerprints:
+                predicted_fingerprints[fingerprint] = len(to_predict)
+                to_predict.append(i)
+
+        # Cached predictions are read before the new ones can evict them.
+        results = []
+        for fingerprint in fingerprints:
+            if fingerprint in predicted_fingerprints:
+                results.append(None)
+            else:
+                self.cache.move_to_end(fingerprint)
+                results.append(self.cache[fingerprint])
+
+        if len(to_predict) != 0:
+            predictions = predict_fn([pixel_values[i] for i in to_predict])
+            for i, fingerprint in enumerate(fingerprints):
+                if results[i] is None:
+                    results[i] = predictions[predicted_fingerprints[fingerprint]]
+            for fingerprint, j in predicted_fingerprints.items():
+                self.add_to_cache(fingerprint, predictions[j])
+
+        self.num_tiles += len(tiles)
+        self.num_uniform_tiles += sum(fingerprint[0] == "uniform" for fingerprint in fingerprints)
+        self.num_forward_saved += len(tiles) - len(to_predict)
+
+        return np.stack(results)
+
+
+    def get_stats(self) -> dict:
+        return {
+            "dedup_tiles": self.num_tiles,
+            "dedup_uniform_tiles": self.num_uniform_tiles,
+            "dedup_forward_passes_saved": self.num_forward_saved,
+        }
@@ -0,0 +1,254 @@
+import time
+import torch
+import numpy as np
+import torch.nn as nn
+from pathlib import Path
+
+ENGINE_EAGER = "eager"
+ENGINE_CHANNELS_LAST = "channels_last"
+ENGINE_BF16 = "bf16"
+ENGINE_COMPILE = "compile"
+ENGINE_COMPILE_BF16 = "compile_bf16"
+ENGINE_ONNX = "onnx"
+ENGINE_ONNX_INT8_DYNAMIC = "onnx_int8_dynamic"
+ENGINE_ONNX_INT8_STATIC = "onnx_int8_static"
+ENGINE_AUTO = "auto"
+
+# Engine name: (channels last layout, bf16 autocast, torch.compile). All engines run under torch.inference_mode.
+ENGINE_OPTIONS = {
+    ENGINE_EAGER: (False, False, False),
+    ENGINE_CHANNELS_LAST: (True, False, False),
+    ENGINE_BF16: (True, True, False),
+    ENGINE_COMPILE: (True, False, True),
+    ENGINE_COMPILE_BF16: (True, True, True),
+}
+# Engine name: suffix of the ONNX file next to the model directory. INT8 files are written by quantize.py.
+ONNX_ENGINES = {
+    ENGINE_ONNX: "",
+    ENGINE_ONNX_INT8_DYNAMIC: ".int8_dynamic",
+    ENGINE_ONNX_INT8_STATIC: ".int8_static",
+}
+ENGINES = list(ENGINE_OPTIONS) + list(ONNX_ENGINES) + [ENGINE_AUTO]
+
+MIN_ENGINE_AGREEMENT = 0.98 # Min share of pixels with the same label as the eager engine to keep a bf16 engine.
+MIN_ONNX_AGREEMENT = 0.999 # Min share of pixels with the same label as PyTorch to keep an ONNX export.
+ONNX_EXPORT_BATCH_SIZE = 2 # Checked on another batch size to catch a batch size fixed in the graph.
+NUM_BENCHMARK_RUNS = 3
+
+
+class LogitsModel(nn.Module):
+    """ Return only the logits tensor of the Segformer output, for the ONNX export. """
+
+    def __init__(self, model: nn.Module):
+        super().__init__()
+        self.model = model
+
+    def forward(self, pixel_values: torch.Tensor) -> torch.Tensor:
+        return self.model(pixel_values=pixel_values).logits
+
+
+def is_onnxruntime_available() -> bool:
+    try:
+        import onnxruntime
+        return True
+    except ImportError:
+        return False
+
+
+def get_onnx_path(model_path: Path, engine: str = ENGINE_ONNX) -> Path:
+    """ The export and its quantized versions are cached next to the model directory. """
+    return Path(model_path.parent, f"{model_path.name}{ONNX_ENGINES[engine]}.onnx")
+
+
+def create_onnx_session(onnx_path: Path, num_threads: int = 0):
+    """ Open an ONNX model with the CPU provider of ONNX Runtime, 0 threads keeps the ONNX Runtime default. """
+    import onnxruntime as ort
+
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    if num_threads > 0:
+        options.intra_op_num_threads = num_threads
+
+    return ort.InferenceSession(str(onnx_path), sess_options=options, providers=["CPUExecutionProvider"])
+
+
+def export_onnx(model: nn.Module, model_path: Path, input_size: tuple[int, int], batch_size: int) -> Path:
+    """
+        Export the model with a dynamic batch size if the export is missing or older than the checkpoint, and return
+        its path. A new export is removed if its labels don't agree with PyTorch.
+    """
+    onnx_path = get_onnx_path(model_path)
+    model_mtime = max(f.stat().st_mtime for f in model_path.iterdir() if f.is_file())
+    if onnx_path.exists() and onnx_path.stat().st_mtime >= model_mtime:
+        return onnx_path
+
+    print(f"*\t Export the model to {onnx_path}.")
+    model.to(memory_format=torch.contiguous_format)
+    logits_model = LogitsModel(model).eval()
+
+    example = torch.randn(ONNX_EXPORT_BATCH_SIZE, 3, *input_size)
+    torch.onnx.export(logits_model, (example,), str(onnx_path), input_names=["pixel_values"], output_names=["logits"],
+                      dynamic_shapes={"pixel_values": {0: torch.export.Dim("batch")}}, dynamo=True, external_data=False)
+
+    pixel_values = torch.randn(max(1, batch_size), 3, *input_size, generator=torch.Generator().manual_seed(0))
+    onnx_logits = create_onnx_session(onnx_path).run(None, {"pixel_values": pixel_values.numpy()})[0]
+    with torch.inference_mode():
+        torch_logits = logits_model(pixel_values).numpy()
+
+    agreement = (onnx_logits.argmax(axis=1) == torch_logits.argmax(axis=1)).mean()
+    print(f"*\t ONNX export agreement with PyTorch {100 * agreement:.3f}%, max logits difference {np.abs(onnx_logits - torch_logits).max():.2e}.")
+    if agreement < MIN_ONNX_AGREEMENT:
+        onnx_path.unlink()
+        raise ValueError(f"The ONNX export agrees with PyTorch on {100 * agreement:.3f}% of the pixels, less than {100 * MIN_ONNX_AGREEMENT}%.")
+
+    return onnx_path
+
+
+def is_bf16_supported() -> bool:
+    """ True if the CPU has native bf16 instructions, bf16 is emulated and slower otherwise. """
+    try:
+        return torch.ops.mkldnn._is_mkldnn_bf16_supported()
+    except (AttributeError, RuntimeError):
+        return False
+
+
+def set_num_threads(num_threads: int, num_interop_threads: int) -> None:
+    """ 0 keeps the torch default. Inter-op threads can only be set before the first parallel work. """
+    if num_threads > 0:
+        torch.set_num_threads(num_threads)
+
+    if num_interop_threads > 0:
+        try:
+            torch.set_num_interop_threads(num_interop_threads)
+        except RuntimeError:
+            print(f"[WARNING] Inter-op threads are already used, keep {torch.get_num_interop_threads()} threads.")
+
+
+class EngineManager:
+    """ Run the forward pass of the model on CPU with the layout, precision and compilation options of an engine. """
+
+    def __init__(self, model: nn.Module, device: torch.device, engine: str, input_size: tuple[int, int], batch_size: int, model_path: Path, num_threads: int = 0, allow_onnx: bool = True):
+        self.model = model
+        self.device = device
+        self.model_path = model_path
+        self.num_threads = num_threads
+        self.input_size = input_size
+        self.batch_size = batch_size
+        self.allow_onnx = allow_onnx
+
+        self.engine = ENGINE_EAGER
+        self.channels_last, self.bf16, self.compile = False, False, False
+        self.compiled_model = None
+        self.onnx_sessions = {}
+
+        # Engines are only CPU options, the GPU keeps the eager model.
+        if self.device.type != "cpu":
+            engine = ENGINE_EAGER
+        elif engine == ENGINE_AUTO:
+            engine = self.benchmark_engines()
+
+        self.setup(engine)
+        print(f"*\t Inference engine: {self.engine}, {torch.get_num_threads()} intra-op threads, {torch.get_num_interop_threads()} inter-op threads.")
+
+
+    def get_available_engines(self) -> list[str]:
+        compile_available = hasattr(torch, "compile")
+        engines = [engine for engine, (_, bf16, compile) in ENGINE_OPTIONS.items() if (not bf16 or is_bf16_supported()) and (not compile or compile_available)]
+        # INT8 engines change the labels, they are only used when chosen after reading their accuracy report.
+        return engines + [ENGINE_ONNX] if self.allow_onnx and is_onnxruntime_available() else engines
+
+
+    def setup(self, engine: str) -> None:
+        if engine in ONNX_ENGINES:
+            if not self.allow_onnx:
+                raise ValueError(f"The {engine} engine only runs the input size of the ONNX export, not {self.input_size}.")
+            self.setup_onnx(engine)
+            self.engine = engine
+            return
+
+        channels_last, bf16, compile = ENGINE_OPTIONS[engine]
+        if bf16 and not is_bf16_supported():
+            print(f"[WARNING] The CPU doesn't support bf16, use the {ENGINE_CHANNELS_LAST} engine.")
+            channels_last, bf16, compile = ENGINE_OPTIONS[ENGINE_CHANNELS_LAST]
+            engine = ENGINE_CHANNELS_LAST
+
+        self.engine, self.channels_last, self.bf16, self.compile = engine, channels_last, bf16, compile
+        self.model.to(memory_format=torch.channels_last if channels_last else torch.contiguous_format)
+
+        # The compiled model is created once, its graphs are cached by layout and precision.
+        if compile and self.compiled_model == None:
+            self.compiled_model = torch.compile(self.model)
+
+
+    def forward(self, pixel_values: torch.Tensor) -> torch.Tensor:
+        """ Return the float32 logits of the model for a (N, 3, H, W) batch. """
+        num_images = pixel_values.shape[0]
+        if self.engine in ONNX_ENGINES:
+            return torch.from_numpy(self.onnx_sessions[self.engine].run(None, {"pixel_values": pixel_values.numpy()})[0])
+
+        pixel_values = pixel_values.to(self.device)
+
+        # The last smaller batch is padded to not compile a graph for its size.
+        if self.compile and num_images < self.batch_size:
+            pixel_values = torch.cat([pixel_values, pixel_values.new_zeros((self.batch_size - num_images, *pixel_values.shape[1:]))])
+
+        if self.channels_last:
+            pixel_values = pixel_values.contiguous(memory_format=torch.channels_last)
+
+        forward_fn = self.compiled_model if self.compile else self.model
+        with torch.inference_mode(), torch.autocast(device_type="cpu", dtype=torch.bfloat16, enabled=self.bf16):
+            logits = forward_fn(pixel_values=pixel_values).logits
+
+        return logits[:num_images].float()
+
+
+    def setup_onnx(self, engine: str) -> None:
+        """ Open the ONNX model of the engine, the float model is exported if needed and the INT8 models must exist. """
+        if engine in self.onnx_sessions: return
+
+        if engine == ENGINE_ONNX:
+            onnx_path = export_onnx(self.model, self.model_path, self.input_size, self.batch_size)
+        else:
+            onnx_path = get_onnx_path(self.model_path, engine)
+            if not onnx_path.exists():
+                raise FileNotFoundError(f"Cannot find the quantized model {onnx_path}, create it with quantize.py.")
+
+        self.onnx_sessions[engine] = create_onnx_session(onnx_path, self.num_threads)
+
+
+    def benchmark_engines(self) -> str:
+        """
+            Time each available engine on a random batch and return the fastest one. Compilation and first runs are
+            not timed. A bf16 engine is kept only if its labels agree with the eager engine, on this random batch.
+        """
+        print("*\t Benchmark the inference engines.")
+        pixel_values = torch.randn(self.batch_size, 3, *self.input_size, generator=torch.Generator().manual_seed(0))
+
+        # Labels of the plain model, every engine is compared to them.
+        self.setup(ENGINE_EAGER)
+        reference_labels = self.forward(pixel_values).argmax(dim=1)
+
+        times = {}
+        for engine in self.get_available_engines():
+            # torch.compile fails on the first forward pass, like on hosts without a C++ toolchain.
+            try:
+                self.setup(engine)
+                agreement = (self.forward(pixel_values).argmax(dim=1) == reference_labels).float().mean().item()
+
+                durations = []
+                for _ in range(NUM_BENCHMARK_RUNS):
+                    t_start = time.perf_counter()
+                    self.forward(pixel_values)
+                    durations.append(time.perf_counter() - t_start)
+            except Exception as e:
+                print(f"[WARNING] Skip the {engine} engine: {e}")
+                continue
+
+            print(f"*\t\t {engine:<14} {1000 * np.median(durations):>8.1f} ms by batch of {self.batch_size}, agreement with eager {100 * agreement:.2f}%.")
+            if agreement >= MIN_ENGINE_AGREEMENT:
+                times[engine] = np.median(durations)
+
+        if len(times) == 0:
+            print(f"[WARNING] No engine could be benchmarked, use the {ENGINE_EAGER} engine.")
+            return ENGINE_EAGER
+        return min(times, key=times.get)
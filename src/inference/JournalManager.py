@@ -0,0 +1,58 @@
+from pathlib import Path
+from threading import Lock
+from collections import defaultdict
+
+JOURNAL_TILES = "tiles"
+JOURNAL_PNG = "png"
+JOURNAL_PREDICTIONS = "predictions"
+JOURNAL_STAGES = "stages"
+
+MAX_BUFFERED_NAMES = 256 # Names appended at once by the stages without batches, a killed run redoes at most these tiles.
+
+
+class JournalManager:
+    """
+        Append-only journal of one raster, each line is "<stage> <tile name>". A tile is written in the journal
+        once its file is complete, a stage is written in JOURNAL_STAGES once all its tiles are done.
+    """
+
+    def __init__(self, journal_file: Path):
+        self.journal_file = journal_file
+        self.lock = Lock()
+        self.done: dict[str, set[str]] = defaultdict(set)
+
+        if self.journal_file.exists():
+            text = self.journal_file.read_text()
+
+            # The last line is incomplete if the run was killed while writing it, it's removed before the next appends.
+            complete_size = text.rfind("\n") + 1
+            if complete_size != len(text):
+                with open(self.journal_file, "r+") as f:
+                    f.truncate(complete_size)
+
+            for line in text[:complete_size].splitlines():
+                stage, _, name = line.partition(" ")
+                self.done[stage].add(name)
+
+
+    def is_done(self, stage: str, name: str) -> bool:
+        return name in self.done[stage]
+
+
+    def is_stage_done(self, stage: str) -> bool:
+        return stage in self.done[JOURNAL_STAGES]
+
+
+    def add(self, stage: str, names: list[str]) -> None:
+        """ Append the names, lines are flushed at once so a killed run loses at most the tiles in progress. """
+        if len(names) == 0: return
+
+        with self.lock:
+            self.journal_file.parent.mkdir(exist_ok=True, parents=True)
+            with open(self.journal_file, "a") as f:
+                f.write("".join(f"{stage} {name}\n" for name in names))
+            self.done[stage].update(names)
+
+
+    def add_stage(self, stage: str) -> None:
+        self.add(JOURNAL_STAGES, [stage])
@@ -1,73 +1,338 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 import rasterio
 import numpy as np
 from tqdm import tqdm
 from PIL import Image
 from pathlib import Path
+from typing import Any, Callable
 from argparse import Namespace
-from transformers import AutoImageProcessor, SegformerForSemanticSegmentation
+from transformers import AutoImageProcessor, SegformerImageProcessor, SegformerForSemanticSegmentation
 
+from .PipelineManager import PipelineManager
+from .EngineManager import EngineManager, set_num_threads
 from .PathRasterManager import PathRasterManager
+from .JournalManager import JournalManager, JOURNAL_PNG, JOURNAL_PREDICTIONS
+from .DedupManager import DedupManager
+from .StreamMosaicManager import StreamMosaicManager
+from ..utils.mosaic_tools import BLENDING_SOFT, BLENDING_LOGITS, PROBABILITIES_TILE_DTYPE, encode_tile_probabilities
 from ..utils.raster_constants import NO_DATA_VALUE
 
 
+def preprocess_tiles(tiles: torch.Tensor, processor: SegformerImageProcessor, size: tuple[int, int] | None = None) -> torch.Tensor:
+    """
+        Resize, rescale and normalize a (N, 3, H, W) uint8 batch with the processor settings in batched tensor ops.
+        The uint8 bilinear resize of torch rounds like PIL, so the output matches the slow processor. size replaces
+        the processor size, for windows larger than the tiles.
+    """
+    height, width = (processor.size["height"], processor.size["width"]) if size == None else size
+    if processor.do_resize and tiles.shape[-2:] != (height, width):
+        # The uint8 resize runs on channels last tensors.
+        tiles = F.interpolate(tiles.contiguous(memory_format=torch.channels_last), size=(height, width), mode="bilinear", align_corners=False, antialias=True)
+
+    pixel_values = torch.empty(tiles.shape, dtype=torch.float32)
+    pixel_values.copy_(tiles)
+
+    # (x * rescale_factor - mean) / std in two in place ops.
+    scale = processor.rescale_factor if processor.do_rescale else 1.0
+    mean = torch.tensor(processor.image_mean if processor.do_normalize else [0.0] * 3).view(1, 3, 1, 1)
+    std = torch.tensor(processor.image_std if processor.do_normalize else [1.0] * 3).view(1, 3, 1, 1)
+
+    return pixel_values.mul_(scale / std).sub_(mean / std)
+
+
+def get_window_core(key: tuple, mask: np.ndarray) -> tuple[tuple[int, int], np.ndarray]:
+    """ Return the core origin and the core of a (H, W) window mask, NO_DATA outside the coverage of the kept tiles. """
+    core_origin, (rows, cols), coverage = key
+    return core_origin, np.where(coverage, mask[rows, cols], NO_DATA_VALUE).astype(mask.dtype)
+
+
 class ModelManager:
 
     def __init__(self, opt: Namespace) -> None:
         self.opt = opt
+        set_num_threads(self.opt.num_threads, self.opt.num_interop_threads)
 
         self.device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
         self.model = SegformerForSemanticSegmentation.from_pretrained(self.opt.path_segmentation_model).to(self.device)
-        self.processor = AutoImageProcessor.from_pretrained("nvidia/mit-b0", do_reduce_labels=False, use_fast=False)
+        self.processor = AutoImageProcessor.from_pretrained(self.opt.path_processor, do_reduce_labels=False, use_fast=False)
+        # Band i of the logits is the class id global_min + i, like in the mosaic of probabilities and logits.
+        self.global_min = min(self.get_id2label())
+
+        # Windows keep the scale of the tiles seen by the model, their halo is on each side.
+        self.window_input_size = 0
+        if self.opt.window_size > 0:
+            self.window_input_size = self.get_window_input_size(self.opt.window_size + 2 * self.opt.window_halo)
+
+        self.batch_size = self.get_batch_size()
+        print(f"*\t Inference batch size: {self.batch_size}")
+
+        input_size = (self.window_input_size, self.window_input_size) if self.opt.window_size > 0 else (self.processor.size["height"], self.processor.size["width"])
+        # ONNX exports have the input size of the tiles.
+        self.engine = EngineManager(self.model, self.device, self.opt.engine, input_size, self.batch_size, Path(self.opt.path_segmentation_model), self.opt.num_threads, allow_onnx=self.opt.window_size == 0)
+
+        self.predict_fn = {BLENDING_SOFT: self.predict_probabilities, BLENDING_LOGITS: self.predict_low_res_logits}.get(self.opt.blending, self.predict_masks)
+
+        # Identical tiles are predicted once, uniform tiles by color.
+        self.dedup = None
+        if self.opt.dedup_tiles:
+            self.dedup = DedupManager(self.opt.uniform_tolerance, self.opt.dedup_cache_mb * 1024**2)
+            predict_fn = self.predict_fn
+            self.predict_fn = lambda tiles: self.dedup.predict(tiles, predict_fn)
+        self.pipeline = PipelineManager(self.opt.num_reader_workers, self.opt.num_writer_workers, self.opt.queue_depth, self.batch_size)
+
+
+    def get_batch_size(self) -> int:
+        """
+            Use the user batch size, or fit the batch into the memory budget if batch size is 0. Windows are much
+            larger than tiles, their batch size is also capped by the memory budget.
+        """
+        memory_by_tile = self.estimate_memory_by_tile()
+        if self.opt.window_size > 0 and memory_by_tile > self.opt.memory_budget_mb * 1024**2:
+            print(f"Warning: one window of {self.window_input_size}x{self.window_input_size} model input pixels needs about {memory_by_tile / 1024**2:.0f} MB, more than --memory_budget_mb {self.opt.memory_budget_mb}. Lower --window_size.")
+
+        budget_batch_size = max(1, self.opt.memory_budget_mb * 1024**2 // memory_by_tile)
+        if self.opt.batch_size > 0:
+            return min(self.opt.batch_size, budget_batch_size) if self.opt.window_size > 0 else self.opt.batch_size
+
+        return budget_batch_size
+
+
+    def get_window_input_size(self, window_size: int) -> int:
+        """ Model input size of a window, resized like a tile by the processor. """
+        return round(window_size * self.processor.size["height"] / self.opt.tile_size)
+
+
+    def estimate_memory_by_tile(self) -> int:
+        """ Rough peak memory in bytes of the forward pass for one tile, or one window, float32 activations. """
+        config = self.model.config
+        input_height, input_width = self.processor.size["height"], self.processor.size["width"]
+        output_size = self.opt.tile_size
+        if self.opt.window_size > 0:
+            input_height = input_width = self.window_input_size
+            output_size = self.opt.window_size + 2 * self.opt.window_halo
         
-    def preprocess_image(self, image_path: Path):
+        nb_floats = 3 * input_height * input_width
+        for i, hidden_size in enumerate(config.hidden_sizes):
+            seq_len = (input_height // (4 * 2**i)) * (input_width // (4 * 2**i))
+            nb_floats += seq_len * hidden_size * (1 + config.mlp_ratios[i]) # Hidden states and mlp expansion.
+            nb_floats += config.num_attention_heads[i] * seq_len * (seq_len // config.sr_ratios[i]**2) # Attention scores.
+
+        decoder_seq_len = (input_height // 4) * (input_width // 4)
+        nb_floats += decoder_seq_len * config.decoder_hidden_size * (len(config.hidden_sizes) + 1) # Concatenated and fused features.
+        nb_floats += config.num_labels * output_size**2 # Upsampled logits.
+
+        return nb_floats * 4
+
+
+    def load_image(self, image_path: Path) -> np.ndarray:
         with Image.open(image_path) as image:
-            image = image.convert("RGB")
-            inputs = self.processor(image, return_tensors="pt").to(self.device)
-            size = image.size
-        return size, inputs
+            return np.asarray(image.convert("RGB"))
 
 
-    def predict_mask(self, image_path: Path):
-        size, inputs = self.preprocess_image(image_path)
-        
-        with torch.no_grad():
-            outputs = self.model(**inputs)
+    def preprocess_images(self, keys: list, tiles: torch.Tensor) -> list[tuple[object, Any]]:
+        """
+            Preprocess a (N, 3, H, W) uint8 batch at once and return (key, pixel_values) for each tile. With
+            deduplication, the value is (pixel_values, fingerprint) and the fingerprint is taken on the uint8 tile.
+        """
+        if len(keys) == 0: return []
+
+        pixel_values = preprocess_tiles(tiles, self.processor)
+        if self.dedup == None:
+            return list(zip(keys, pixel_values))
+
+        fingerprints = [self.dedup.get_fingerprint(tile) for tile in tiles.numpy()]
+        return list(zip(keys, zip(pixel_values, fingerprints)))
+
+
+    def read_images(self, image_paths: list[Path]) -> list[tuple[Path, torch.Tensor]]:
+        # (N, H, W, 3) images to a (N, 3, H, W) channels last view without copy.
+        images = np.stack([self.load_image(img_path) for img_path in image_paths])
+        return self.preprocess_images(image_paths, torch.from_numpy(images).permute(0, 3, 1, 2))
+
+
+    def read_windows(self, windows: list[tuple[tuple, np.ndarray]]) -> list[tuple[tuple, torch.Tensor]]:
+        """ Preprocess (bands, H, W) windows of the raster at the scale of the tiles, all windows of a raster have the same size. """
+        if len(windows) == 0: return []
+
+        height, width = windows[0][1].shape[-2:]
+        input_size = (self.get_window_input_size(height), self.get_window_input_size(width))
+        pixel_values = preprocess_tiles(torch.from_numpy(np.stack([window[:3] for _, window in windows])), self.processor, input_size)
+
+        # The window size goes with the pixel values to upsample the logits back.
+        return [(key, (pixel_value, (height, width))) for (key, _), pixel_value in zip(windows, pixel_values)]
+
+
+    def read_tiles(self, tiles: list[tuple[tuple[int, int], np.ndarray]]) -> list[tuple[tuple[int, int], torch.Tensor]]:
+        if len(tiles) == 0: return []
+
+        # Tiles are already (bands, H, W) windows of the raster.
+        return self.preprocess_images([tile_origin for tile_origin, _ in tiles], torch.from_numpy(np.stack([tile[:3] for _, tile in tiles])))
+
 
-        logits = outputs.logits  # Shape: (1, num_labels, height, width)
-        mask_resized_bilinear = nn.functional.interpolate( # Segformer size is 1/4 need to resize to get mask on image
+    def predict_logits(self, pixel_values: list[torch.Tensor]) -> torch.Tensor:
+        """ One forward pass for a batch of preprocessed tiles. Return (N, num_labels, tile_size, tile_size) logits. """
+
+        logits = self.engine.forward(torch.stack(pixel_values))  # Shape: (N, num_labels, height, width)
+        return nn.functional.interpolate( # Segformer size is 1/4 need to resize to get mask on image
                 logits,  
-                size=size, 
+                size=(self.opt.tile_size, self.opt.tile_size), 
                 mode='bilinear',
                 align_corners=False
             )
-        mask_resized_bilinear = mask_resized_bilinear.argmax(dim=1)[0].cpu().numpy().astype(np.uint8)
-        return mask_resized_bilinear + 1 # Add one to get value between 1 and 5
+
+
+    def predict_masks(self, pixel_values: list[torch.Tensor]) -> np.ndarray:
+        """ Return (N, tile_size, tile_size) masks. """
+        mask_resized_bilinear = self.predict_logits(pixel_values).argmax(dim=1).cpu().numpy().astype(np.uint8)
+        return mask_resized_bilinear + self.global_min
+
+
+    def predict_probabilities(self, pixel_values: list[torch.Tensor]) -> np.ndarray:
+        """ Return (N, num_labels, tile_size, tile_size) float16 class probabilities. """
+        return self.predict_logits(pixel_values).softmax(dim=1).cpu().numpy().astype(np.float16)
+
+
+    def predict_window_masks(self, windows: list[tuple[torch.Tensor, tuple[int, int]]]) -> np.ndarray:
+        """ Return (N, H, W) masks of windows of the same (H, W) size. """
+        logits = self.engine.forward(torch.stack([pixel_values for pixel_values, _ in windows]))
+        logits = F.interpolate(logits, size=windows[0][1], mode="bilinear", align_corners=False)
+        return logits.argmax(dim=1).cpu().numpy().astype(np.uint8) + self.global_min
+
+
+    def predict_low_res_logits(self, pixel_values: list[torch.Tensor]) -> np.ndarray:
+        """ Return (N, num_labels, logits_size, logits_size) float16 logits, not upsampled to the tile size. """
+        return self.engine.forward(torch.stack(pixel_values)).cpu().numpy().astype(np.float16)
+
+
+    def get_logits_size(self) -> int:
+        """ Size of the logits of the model, 1/4 of its input size. """
+        return -(-self.processor.size["height"] // 4)
     
 
-    def inference(self, path_manager: PathRasterManager):
+    def inference(self, path_manager: PathRasterManager, journal: JournalManager):
+        """ Tiles already predicted in the journal are skipped, a prediction is in the journal once its file is written. """
         print("*\t Perform inference.")
-        session_images = sorted(list(path_manager.cropped_ortho_img_folder.iterdir()))
-        
-        for img_path in tqdm(session_images, desc="Performing inference on images"):
-            mask = self.predict_mask(img_path)
+        self.reset_dedup()
+        session_images = sorted(img_path for img_path in path_manager.cropped_ortho_img_folder.iterdir() if not journal.is_done(JOURNAL_PREDICTIONS, img_path.stem))
+        batches_images = [session_images[i:i + self.batch_size] for i in range(0, len(session_images), self.batch_size)]
+
+        # Tiles whose prediction was written are appended to the journal once by batch.
+        def write_prediction(img_path: Path, prediction: np.ndarray) -> str | None:
+            return img_path.stem if self.save_prediction(path_manager, img_path, prediction) else None
+
+        self.pipeline.run(
+            tqdm(batches_images, desc="Performing inference on images", unit="batch"),
+            self.read_images,
+            self.predict_fn,
+            write_prediction,
+            flush_fn=lambda names: journal.add(JOURNAL_PREDICTIONS, [name for name in names if name != None])
+        )
 
-            corresponding_tiff = Path(path_manager.cropped_ortho_folder, f"{img_path.stem}.tif")
-            if not corresponding_tiff.exists():
-                print(f"Warning: No matching TIFF file found for {img_path.name}, skipping...")
-                continue
+        self.print_dedup_stats()
+        if journal.is_stage_done(JOURNAL_PNG):
+            journal.add_stage(JOURNAL_PREDICTIONS)
 
-            with rasterio.open(corresponding_tiff) as src:
-                meta = src.meta.copy()
-                meta.update({"dtype": 'uint8', "count": 1, "nodata": 255}) 
 
+    def save_prediction(self, path_manager: PathRasterManager, img_path: Path, prediction: np.ndarray) -> bool:
+        """
+            Masks are saved as one band, probabilities as one LZW compressed band by class of their float16 bits,
+            unquantized like in streaming. Return False if the prediction isn't written, when the TIFF tile is missing.
+        """
+        corresponding_tiff = Path(path_manager.cropped_ortho_folder, f"{img_path.stem}.tif")
+        if not corresponding_tiff.exists():
+            print(f"Warning: No matching TIFF file found for {img_path.name}, skipping...")
+            return False
 
-            output_tiff_path = Path(path_manager.predictions_tiff_folder, f"{img_path.stem}_prediction.tif")
+        with rasterio.open(corresponding_tiff) as src:
+            meta = src.meta.copy()
+            meta.update({"dtype": 'uint8', "count": 1, "nodata": 255}) 
+
+        output_tiff_path = Path(path_manager.predictions_tiff_folder, f"{img_path.stem}_prediction.tif")
+        if prediction.ndim == 3:
+            meta.update({"count": prediction.shape[0], "dtype": PROBABILITIES_TILE_DTYPE, "nodata": None, "compress": "LZW", "predictor": 2})
             with rasterio.open(output_tiff_path, 'w', **meta) as dst:
-                mask = np.where(mask == NO_DATA_VALUE, 255, mask)
-                dst.write(mask, 1)    
+                dst.write(encode_tile_probabilities(prediction))
+            return True
+
+        with rasterio.open(output_tiff_path, 'w', **meta) as dst:
+            mask = np.where(prediction == NO_DATA_VALUE, 255, prediction)
+            dst.write(mask, 1)    
+
+        return True
+
+
+    def inference_stream(self, strips: list, read_strip: Callable[[Any], list[tuple[tuple[int, int], np.ndarray]]], mosaic_manager: StreamMosaicManager) -> None:
+        """ Predict the tiles of each row strip and vote them directly into the mosaic, nothing is written on disk. """
+        print("*\t Perform streaming inference.")
+        self.reset_dedup()
+
+        mosaic_manager.create_raster()
+        try:
+            # Only one writer to keep the strips order needed by the mosaic.
+            self.pipeline.run(
+                tqdm(strips, desc="Streaming row strips", unit="strip"),
+                lambda strip: self.read_tiles(read_strip(strip)),
+                self.predict_fn,
+                mosaic_manager.add_prediction,
+                num_writers=1
+            )
+        except Exception:
+            mosaic_manager.close_raster(complete=False)
+            raise
+
+        mosaic_manager.close_raster()
+        self.print_dedup_stats()
+
+
+    def inference_windows(self, strips: list, read_strip: Callable[[Any], list[tuple[tuple, np.ndarray]]], mosaic_manager: StreamMosaicManager) -> None:
+        """
+            Predict large windows with a halo in one forward pass each and write their core into the mosaic. Cores
+            don't overlap, so each pixel is predicted once. Core pixels outside the kept tiles stay NO_DATA.
+        """
+        print("*\t Perform window inference.")
+
+        def write_core(key: tuple, mask: np.ndarray) -> None:
+            mosaic_manager.add_prediction(*get_window_core(key, mask))
+
+        mosaic_manager.create_raster()
+        try:
+            # Only one writer to keep the strips order needed by the mosaic.
+            self.pipeline.run(
+                tqdm(strips, desc="Streaming window strips", unit="strip"),
+                lambda strip: self.read_windows(read_strip(strip)),
+                self.predict_window_masks,
+                write_core,
+                num_writers=1
+            )
+        except Exception:
+            mosaic_manager.close_raster(complete=False)
+            raise
+
+        mosaic_manager.close_raster()
+
+
+    def get_num_predicted(self) -> int:
+        """ Number of tiles, or windows, sent to the model for the last raster. """
+        return self.pipeline.num_values
+
+
+    def reset_dedup(self) -> None:
+        if self.dedup != None:
+            self.dedup.reset()
+
+
+    def get_dedup_stats(self) -> dict:
+        """ Counters of the deduplicated tiles of the last raster, empty without deduplication. """
+        return self.dedup.get_stats() if self.dedup != None else {}
+
+
+    def print_dedup_stats(self) -> None:
+        if self.dedup == None: return
+        stats = self.dedup.get_stats()
+        print(f"*\t {stats['dedup_forward_passes_saved']} forward passes saved on {stats['dedup_tiles']} tiles, {stats['dedup_uniform_tiles']} uniform tiles.")
 
 
     def get_id2label(self) -> dict:
@@ -1,22 +1,55 @@
 import math
 import numpy as np
+from itertools import groupby
 from tqdm import tqdm
 from pathlib import Path
+from collections import deque
+from typing import Iterator
+from multiprocessing import get_context
+from multiprocessing.context import BaseContext
+from concurrent.futures import ProcessPoolExecutor
 
 import rasterio
-from rasterio.merge import merge
 from rasterio.transform import Affine
-from rasterio.windows import from_bounds
+from rasterio.windows import Window, from_bounds
 
+from .TileIndex import TileIndex
 from .PathRasterManager import PathRasterManager
-from ..utils.raster_constants import RASTER_CLASS_ID2COLOR, NO_DATA_VALUE
+from ..utils.raster_constants import RASTER_CLASS_ID2COLOR, NO_DATA_VALUE, RASTER_BLOCK_SIZE
+from ..utils.mosaic_tools import add_tiles_votes, add_tile_probabilities, create_mosaic_buffer, get_mosaic_buffer_dtype, get_window_weights, decode_tile_probabilities
+from ..utils.mosaic_tools import get_most_common_values, get_most_probable_values, BLENDING_SOFT, BLENDING_VOTE, WINDOW_NONE
+
+# State of a mosaic worker, set once by init_mosaic_worker.
+worker_state = {}
+
+
+def init_mosaic_worker(mosaic_manager: "MosaicManager") -> None:
+    """ Pool initializer, the manager with the tiles files and their index is sent once by worker, not once by slice. """
+    worker_state["mosaic_manager"] = mosaic_manager
+
+
+def populate_worker_subraster(args: tuple[int, Window]) -> np.ndarray | Path:
+    """ Vote one slice with the manager of the worker. """
+    return worker_state["mosaic_manager"].populate_one_subraster(args)
+
 
 class MosaicManager:
-    def __init__(self, path_manager: PathRasterManager, id2label: dict, max_pixels_by_slice: int = 800000000):
-        self.tmp_rasters_slice: list[Path] = []
+    def __init__(self, path_manager: PathRasterManager, id2label: dict, max_pixels_by_slice: int = 800000000, blending: str = BLENDING_VOTE, blending_window: str = WINDOW_NONE, memmap_vote_buffer: bool = False, num_workers: int = 1, mp_context: BaseContext | None = None, max_votes: int = 0):
         self.path_manager = path_manager
         self.max_pixels_by_slice = max_pixels_by_slice
         self.id2label = id2label
+        self.blending = blending
+        self.memmap_vote_buffer = memmap_vote_buffer
+        self.num_workers = max(1, num_workers)
+        # Start method of the pool, the scheduler passes its forkserver context to not fork its threads.
+        self.mp_context = mp_context if mp_context != None else get_context()
+        self.window_weights = None
+
+        self.tiles_bounds, self.res, self.nb_bands = [], (0.0, 0.0), 1
+        self.width, self.height, self.transform = 0, 0, Affine.identity()
+        self.tile_index = TileIndex([])
+        # Max tiles covering one pixel, computed by the caller for its memory budget, else from the tiles.
+        self.max_votes, self.resolve_rows = max_votes, 0
 
         self.predictions_tiff_files = sorted([f for f in list(self.path_manager.predictions_tiff_folder.iterdir()) if f.suffix.lower() in [".tif"]])
         
@@ -26,138 +59,180 @@ class MosaicManager:
         self.global_min, self.global_max, self.num_classes = min(id2label), max(id2label), len(id2label)
         print(f"✅ Detected class range: {self.global_min} to {self.global_max} ({self.num_classes} classes)")
 
+        if self.blending == BLENDING_SOFT:
+            with rasterio.open(self.predictions_tiff_files[0]) as src:
+                self.window_weights = get_window_weights(src.height, src.width, blending_window)
+
 
     def build_raster(self):
-        tiles_with_transforms = self.create_intermediate_subraster()
-        self.populate_and_save_subraster(tiles_with_transforms)
-        self.create_final_rasters()
+        slices_windows = self.create_intermediate_subraster()
 
+        print("*\t Create the final raster.")
+        with rasterio.open(
+            self.path_manager.final_merged_tiff_file,
+            "w",
+            driver="GTiff",
+            height=self.height,
+            width=self.width,
+            count=1,
+            dtype=np.uint8,
+            crs=self.crs,
+            transform=self.transform,
+            compress="LZW",
+            tiled=True,
+            blockxsize=RASTER_BLOCK_SIZE,
+            blockysize=RASTER_BLOCK_SIZE,
+            nodata=NO_DATA_VALUE
+        ) as dst:
+            # The colormap sets the photometric tag, it can't be changed once data is written.
+            dst.write_colormap(1, RASTER_CLASS_ID2COLOR)
 
-    def create_intermediate_subraster(self) -> list:
-          
-        # Merge only the currently opened files
-        origin_mosaic, origin_transform = merge(self.predictions_tiff_files, method="first")
-        
-        # Get the total size of the mosaic
-        nb_class, height, width = origin_mosaic.shape[0], origin_mosaic.shape[1], origin_mosaic.shape[2]
-        intermediate_tile_height = self.max_pixels_by_slice // (width * nb_class)
-        nb_slice = math.ceil(height / intermediate_tile_height)
+            # Each slice is written into its window when it is voted.
+            for window, most_common_values in self.populate_subraster(slices_windows):
+                dst.write(most_common_values, 1, window=window)
 
-        print(f"The final raster size is {origin_mosaic.shape}. It will be cut by {nb_slice} slice of {intermediate_tile_height} pixels.")
 
-        # Loop through and extract tiles
-        mosaic_tiles = []
-        for i in range(0, height, intermediate_tile_height):
-            # Define the window, making sure it doesn't exceed bounds
-            win_height = min(intermediate_tile_height, height - i)
+    def compute_mosaic_grid(self) -> None:
+        """ Compute the mosaic size and transform from the tiles bounds, only the headers of the tiles are read. """
 
-            # Extract the tile
-            tile = origin_mosaic[:, i:i+win_height, :]
-            new_transform = origin_transform * Affine.translation(1, i)
+        self.tiles_bounds, self.nb_bands = [], 1
+        for src_path in tqdm(self.predictions_tiff_files, desc="Reading tiles bounds", unit="file"):
+            with rasterio.open(src_path) as src:
+                self.tiles_bounds.append(src.bounds)
+                self.res, self.nb_bands = src.res, src.count
+
+        # Same grid as rasterio.merge.merge.
+        left = min(b.left for b in self.tiles_bounds)
+        bottom = min(b.bottom for b in self.tiles_bounds)
+        right = max(b.right for b in self.tiles_bounds)
+        top = max(b.top for b in self.tiles_bounds)
+
+        self.width = int(round((right - left) / self.res[0]))
+        self.height = int(round((top - bottom) / self.res[1]))
+        self.transform = Affine.translation(left, top) * Affine.scale(self.res[0], -self.res[1])
+
+        # Index the tiles footprints on the grid, so a slice only reads the tiles intersecting it.
+        tiles_windows = [from_bounds(*b, transform=self.transform).round_offsets().round_lengths() for b in self.tiles_bounds]
+        self.tile_index = TileIndex(tiles_windows, max(int(tiles_windows[0].height), 1))
+        max_votes = self.tile_index.get_max_tiles_by_pixel()
+        if max_votes > self.max_votes:
+            if self.max_votes > 0:
+                print(f"[WARNING] Up to {max_votes} tiles cover one pixel, more than the {self.max_votes} expected, the vote buffers are sized for {max_votes}.")
+            self.max_votes = max_votes
 
-            mosaic_tiles.append((tile, new_transform))  # Store tile with position
-        
-        return mosaic_tiles
 
+    def create_intermediate_subraster(self) -> list[Window]:
+        """ Cut the mosaic grid into slices of max_pixels_by_slice pixels, slices are only windows on the grid. """
 
-    def populate_and_save_subraster(self, tiles_with_transforms: list):
+        self.compute_mosaic_grid()
 
-        for i, (mosaic, out_trans) in enumerate(tiles_with_transforms):
-            tmp_path = Path(self.path_manager.merged_predictions_folder, f"{i}_{self.path_manager.final_merged_tiff_file.name}") 
+        # Workers share max_pixels_by_slice. Memory mapped buffers hold one slice by worker, max_pixels_by_slice then bounds the rows resolved at once.
+        self.resolve_rows = max(1, self.max_pixels_by_slice // (self.width * self.nb_bands * self.num_workers))
+        intermediate_tile_height = math.ceil(self.height / self.num_workers) if self.memmap_vote_buffer else self.resolve_rows
+        if intermediate_tile_height > RASTER_BLOCK_SIZE:
+            # Slices end on the blocks of the final raster.
+            intermediate_tile_height = intermediate_tile_height // RASTER_BLOCK_SIZE * RASTER_BLOCK_SIZE
+        nb_slice = math.ceil(self.height / intermediate_tile_height)
 
-            # Optimized Argmax Calculation
-            most_common_values = np.full(mosaic.shape[1:], NO_DATA_VALUE, dtype=np.uint8)  # Default to NO_DATA_VALUE
+        print(f"The final raster size is {(self.nb_bands, self.height, self.width)}. It will be cut by {nb_slice} slice of {min(intermediate_tile_height, self.height)} rows.")
 
-            count_buffer = np.zeros((self.num_classes, *mosaic.shape[1:]), dtype=np.uint16)  # Avoid large int types
+        slices_windows = []
+        for i in range(0, self.height, intermediate_tile_height):
+            # Define the window, making sure it doesn't exceed bounds
+            slices_windows.append(Window(0, i, self.width, min(intermediate_tile_height, self.height - i)))
+        
+        return slices_windows
 
-            for src_path in tqdm(self.predictions_tiff_files, desc=f"Processing tiles for subraster {i}", unit="file"):
-                with rasterio.open(src_path) as src:
-                    tile_data = src.read(1)
-                    window = from_bounds(*src.bounds, transform=out_trans).round_offsets().round_lengths()
-                
-                # Get offsets
-                row_off, col_off = int(window.row_off), int(window.col_off)
 
-                # Handle Negative Offsets (for overlapping images)
-                row_start_tile = max(0, -row_off)  
-                col_start_tile = max(0, -col_off)
+    def populate_subraster(self, slices_windows: list[Window]) -> Iterator[tuple[Window, np.ndarray]]:
+        """
+            Slices are voted by a pool of num_workers processes and yielded in order, by blocks of resolve_rows
+            rows. At most two slices by worker are in flight, tasks only carry the slice.
+        """
 
-                row_off = max(0, row_off)  # Adjust offset to fit inside mosaic
-                col_off = max(0, col_off)
+        slices = list(enumerate(slices_windows))
+        if self.num_workers == 1 or len(slices) == 1:
+            for args in slices:
+                yield from self.get_subraster_blocks(args[1], self.populate_one_subraster(args))
+            return
 
-                row_end = min(row_off + tile_data.shape[0] - row_start_tile, most_common_values.shape[0])
-                col_end = min(col_off + tile_data.shape[1] - col_start_tile, most_common_values.shape[1])
+        with ProcessPoolExecutor(max_workers=min(self.num_workers, len(slices)), mp_context=self.mp_context, initializer=init_mosaic_worker, initargs=(self,)) as executor, tqdm(total=len(slices), desc="Processing subrasters", unit="slice") as progress:
+            pending = deque()
+            for args in slices:
+                pending.append((args[1], executor.submit(populate_worker_subraster, args)))
+                if len(pending) < 2 * self.num_workers: continue
 
-                tile_height = row_end - row_off
-                tile_width = col_end - col_off
+                slice_window, future = pending.popleft()
+                yield from self.get_subraster_blocks(slice_window, future.result())
+                progress.update(1)
 
-                if tile_height <= 0 or tile_width <= 0:
-                    continue  # Skip tiles that are completely outside
+            while len(pending) != 0:
+                slice_window, future = pending.popleft()
+                yield from self.get_subraster_blocks(slice_window, future.result())
+                progress.update(1)
 
-                # **Crop tile_data properly for out-of-bounds cases**
-                tile_data = tile_data[row_start_tile:row_start_tile + tile_height, col_start_tile:col_start_tile + tile_width]
 
-                # Update class frequencies, ensuring bounds are correct
-                for v in range(self.global_min, self.global_max + 1):
-                    mask = (tile_data == v)  
-                    count_buffer[v - self.global_min, row_off:row_end, col_off:col_end] += mask
+    def populate_one_subraster(self, args: tuple[int, Window]) -> np.ndarray | Path:
+        """ Vote the tiles of one slice. Return the most common values, or the path of the buffer if memory mapped. """
+        i, slice_window = args
 
-            # Faster argmax using efficient NumPy operations
-            valid_pixel_mask = count_buffer.sum(axis=0) > 0  # Avoid unnecessary computation
-            most_common_values[valid_pixel_mask] = count_buffer[:, valid_pixel_mask].argmax(axis=0) + self.global_min
+        memmap_path = self.get_vote_buffer_path(i) if self.memmap_vote_buffer else None
+        count_buffer = create_mosaic_buffer(self.blending, self.num_classes, int(slice_window.height), int(slice_window.width), self.max_votes, memmap_path)
 
-            # Save merged raster
-            with rasterio.open(
-                tmp_path,
-                "w",
-                driver="GTiff",
-                height=most_common_values.shape[0],
-                width=most_common_values.shape[1],
-                count=1,
-                dtype=np.uint8,
-                crs=self.crs,
-                transform=out_trans,
-                compress="LZW",
-                nodata=NO_DATA_VALUE,
-            ) as dst:
-                dst.write(most_common_values, 1)
+        # Tiles are sorted by row, the tiles of a row band are added together.
+        tiles_by_row = groupby(self.tile_index.query(slice_window), key=lambda tile_id: int(self.tile_index.tiles_windows[tile_id].row_off))
+        with tqdm(desc=f"Processing tiles for subraster {i}", unit="file", disable=self.num_workers > 1) as progress:
+            for tile_row_off, tiles_ids in tiles_by_row:
+                tiles_ids = list(tiles_ids)
 
-            self.tmp_rasters_slice.append(tmp_path)
+                tiles_data = []
+                for tile_id in tiles_ids:
+                    with rasterio.open(self.predictions_tiff_files[tile_id]) as src:
+                        tiles_data.append(src.read() if self.blending == BLENDING_SOFT else src.read(1))
 
+                cols_off = [int(self.tile_index.tiles_windows[tile_id].col_off - slice_window.col_off) for tile_id in tiles_ids]
+                self.add_to_buffer(count_buffer, tiles_data, int(tile_row_off - slice_window.row_off), cols_off)
+                progress.update(len(tiles_ids))
 
-    def create_final_rasters(self):
-        print("*\t Create the final raster.")
+        if memmap_path != None:
+            count_buffer.flush()
+            return memmap_path
 
-        if len(self.tmp_rasters_slice) == 1:
-            Path.rename(self.tmp_rasters_slice[0], self.path_manager.final_merged_tiff_file)
+        return self.resolve_buffer(count_buffer)
 
-            with rasterio.open(self.path_manager.final_merged_tiff_file, 'r+') as src:
-                
-                # Apply the colormap to band 1
-                src.write_colormap(1, RASTER_CLASS_ID2COLOR)
+
+    def get_subraster_blocks(self, slice_window: Window, subraster: np.ndarray | Path) -> Iterator[tuple[Window, np.ndarray]]:
+        """ Yield the most common values of a slice by blocks of resolve_rows rows, a memory mapped buffer is read sequentially then removed. """
+        row_off, height, width = int(slice_window.row_off), int(slice_window.height), int(slice_window.width)
+
+        if isinstance(subraster, np.ndarray):
+            yield Window(0, row_off, width, height), subraster
             return
-        
-        
-        mosaic, out_trans = merge(self.tmp_rasters_slice, method="first")
 
-        # Save the final merged raster
-        with rasterio.open(
-            self.path_manager.final_merged_tiff_file,
-            "w",
-            driver="GTiff",
-            height=mosaic.shape[1],
-            width=mosaic.shape[2],
-            count=1,
-            dtype=np.uint8,
-            crs=self.crs,
-            transform=out_trans,
-            compress="LZW",
-            nodata=NO_DATA_VALUE
-        ) as dst:
-            dst.write(mosaic[0, :], 1)
-         
-            dst.write_colormap(1, RASTER_CLASS_ID2COLOR)
+        dtype = get_mosaic_buffer_dtype(self.blending, self.max_votes)
+        count_buffer = np.memmap(subraster, dtype=dtype, mode="r", shape=(self.num_classes, height, width))
+        for row in range(0, height, self.resolve_rows):
+            most_common_values = self.resolve_buffer(count_buffer[:, row:row + self.resolve_rows])
+            yield Window(0, row_off + row, width, most_common_values.shape[0]), most_common_values
+
+        del count_buffer
+        subraster.unlink()
+
+
+    def get_vote_buffer_path(self, i: int) -> Path:
+        return Path(self.path_manager.vote_buffer_folder, f"{i}_vote_buffer.dat")
+
+
+    def add_to_buffer(self, count_buffer: np.ndarray, tiles_data: list[np.ndarray], row_off: int, cols_off: list[int]) -> None:
+        """ Add the tiles of one row band into the buffer. """
+        if self.blending == BLENDING_SOFT:
+            for tile_data, col_off in zip(tiles_data, cols_off):
+                add_tile_probabilities(count_buffer, decode_tile_probabilities(tile_data), self.window_weights, row_off, col_off)
+        else:
+            add_tiles_votes(count_buffer, tiles_data, row_off, cols_off, self.global_min, self.global_max)
+
 
-        # Clean up temporary files
-        for temp_tiff in self.tmp_rasters_slice:
-            temp_tiff.unlink()
\ No newline at end of file
+    def resolve_buffer(self, count_buffer: np.ndarray) -> np.ndarray:
+        if self.blending == BLENDING_SOFT:
+            return get_most_probable_values(count_buffer, self.global_min)
+        return get_most_common_values(count_buffer, self.global_min)
@@ -6,6 +6,8 @@ CROPPED_ORTHO_IMG = "cropped_ortho_img"
 PREDICTIONS_TIFF = "predictions_tiff"
 PREDICTIONS_PNG = "predictions_png"
 MERGED_PREDICTIONS = "final_predictions_raster"
+VOTE_BUFFER = "vote_buffer"
+JOURNAL = "journal"
 
 
 class PathRasterManager:
@@ -20,8 +22,11 @@ class PathRasterManager:
         self.cropped_ortho_img_folder = Path(self.tmp_folder, CROPPED_ORTHO_IMG, self.raster_name)
         self.predictions_tiff_folder = Path(self.tmp_folder, PREDICTIONS_TIFF, self.raster_name)
         self.predictions_png_folder = Path(self.tmp_folder, PREDICTIONS_PNG, self.raster_name)
+        self.vote_buffer_folder = Path(self.tmp_folder, VOTE_BUFFER, self.raster_name)
+        self.journal_file = Path(self.tmp_folder, JOURNAL, f"{self.raster_name}.journal")
         self.merged_predictions_folder = Path(output_folder, MERGED_PREDICTIONS)
         self.final_merged_tiff_file = Path(self.merged_predictions_folder, f"{self.raster_name}_merged_predictions.tif")
+        self.perf_report_file = Path(self.merged_predictions_folder, f"{self.raster_name}_perf_report.json")
 
     def is_empty_cropped_folder(self) -> bool:
         return len(list(self.cropped_ortho_folder.iterdir())) == 0
@@ -44,8 +49,33 @@ class PathRasterManager:
         self.cropped_ortho_img_folder.mkdir(exist_ok=True, parents=True)
         self.predictions_tiff_folder.mkdir(exist_ok=True, parents=True)
         self.predictions_png_folder.mkdir(exist_ok=True, parents=True)
+        self.vote_buffer_folder.mkdir(exist_ok=True, parents=True)
         self.merged_predictions_folder.mkdir(exist_ok=True, parents=True)
 
+    def create_final_path(self) -> None:
+        """ Create only the final folder, streaming inference doesn't write intermediate files. """
+        self.merged_predictions_folder.mkdir(exist_ok=True, parents=True)
+
+    def get_raster_tmp_folders(self) -> list[Path]:
+        """ Intermediate folders of this raster only, the tmp folder is shared by all rasters. """
+        return [self.cropped_ortho_folder, self.cropped_ortho_img_folder, self.predictions_tiff_folder, self.predictions_png_folder, self.vote_buffer_folder]
+
+    def get_raster_tmp_size(self) -> int:
+        """ Size in bytes of the intermediate files of this raster. """
+        return sum(f.stat().st_size for folder in self.get_raster_tmp_folders() if folder.exists() for f in folder.rglob("*") if f.is_file())
+
+    def clean_raster(self) -> None:
+        """ Remove previous intermediate files of this raster only and create path. """
+        self.raster_disk_optimize()
+        self.create_path()
+
+    def raster_disk_optimize(self) -> None:
+        """ Remove the intermediate files of this raster only, other rasters can be in progress. """
+        for folder in self.get_raster_tmp_folders():
+            if folder.exists():
+                shutil.rmtree(folder)
+        self.journal_file.unlink(missing_ok=True)
+
     def disk_optimize(self) -> None:
         """ Remove all intermediate files"""
         print("*\t Remove all folder if exists. ")
@@ -0,0 +1,114 @@
+import time
+from queue import Queue
+from threading import Lock, Thread
+from collections import deque
+from typing import Any, Callable, Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+
+
+class PipelineManager:
+    """ Readers fill a bounded queue of read tasks, the model consumes them by batch and writers drain the predictions. """
+
+    def __init__(self, num_readers: int, num_writers: int, queue_depth: int, batch_size: int) -> None:
+        self.num_readers = max(1, num_readers)
+        self.num_writers = max(1, num_writers)
+        self.queue_depth = max(1, queue_depth)
+        self.batch_size = batch_size
+
+        self.lock = Lock()
+        self.busy_time = {"read": 0.0, "model": 0.0, "write": 0.0}
+        self.writer_errors = []
+        self.num_values = 0 # Values read by the last run.
+
+
+    def run(self, tasks: Iterable, read_fn: Callable[[Any], list[tuple[Any, Any]]], predict_fn: Callable[[list], Iterable], write_fn: Callable[[Any, Any], Any], num_writers: int | None = None, flush_fn: Callable[[list], None] | None = None) -> None:
+        """
+            read_fn turns one task into a list of (key, value), predict_fn turns a batch of values into predictions
+            and write_fn(key, prediction) is called in the task order if there is only one writer. flush_fn, if
+            given, is called once by batch with the results of write_fn on the batch.
+        """
+        self.busy_time = {"read": 0.0, "model": 0.0, "write": 0.0}
+        self.writer_errors = []
+        self.num_values = 0
+        num_writers = self.num_writers if num_writers == None else max(1, num_writers)
+        t_start = time.perf_counter()
+
+        write_queue = Queue(maxsize=self.queue_depth)
+        writers = [Thread(target=self.write_loop, args=(write_queue, write_fn, flush_fn), daemon=True) for _ in range(num_writers)]
+        for writer in writers: writer.start()
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.num_readers) as executor:
+                batch = []
+                for key, value in self.prefetch(executor, tasks, read_fn):
+                    batch.append((key, value))
+                    self.num_values += 1
+                    if len(batch) < self.batch_size: continue
+
+                    self.predict_batch(batch, predict_fn, write_queue)
+                    batch = []
+
+                self.predict_batch(batch, predict_fn, write_queue)
+        finally:
+            for _ in writers: write_queue.put(None)
+            for writer in writers: writer.join()
+
+        self.print_utilisation(time.perf_counter() - t_start, num_writers)
+        if len(self.writer_errors) != 0:
+            raise self.writer_errors[0]
+
+
+    def prefetch(self, executor: ThreadPoolExecutor, tasks: Iterable, read_fn: Callable) -> Iterator[tuple[Any, Any]]:
+        """
+            Keep queue_depth read tasks in flight and yield their results in the task order. Tasks are bounded by
+            count, callers keep each task under batch_size values to bound the memory in tiles.
+        """
+        pending = deque()
+        for task in tasks:
+            pending.append(executor.submit(self.timed, "read", read_fn, task))
+            if len(pending) < self.queue_depth: continue
+
+            yield from pending.popleft().result()
+
+        while len(pending) != 0:
+            yield from pending.popleft().result()
+
+
+    def predict_batch(self, batch: list[tuple[Any, Any]], predict_fn: Callable, write_queue: Queue) -> None:
+        if len(batch) == 0: return
+        if len(self.writer_errors) != 0:
+            raise self.writer_errors[0]
+
+        predictions = self.timed("model", predict_fn, [value for _, value in batch])
+        write_queue.put(list(zip([key for key, _ in batch], predictions)))
+
+
+    def write_loop(self, write_queue: Queue, write_fn: Callable, flush_fn: Callable | None) -> None:
+        while (items := write_queue.get()) != None:
+            if len(self.writer_errors) != 0: continue # Keep draining the queue to not block the model.
+
+            try:
+                results = [self.timed("write", write_fn, key, prediction) for key, prediction in items]
+                if flush_fn != None:
+                    self.timed("write", flush_fn, results)
+            except Exception as e:
+                self.writer_errors.append(e)
+
+
+    def timed(self, stage: str, fn: Callable, *args) -> Any:
+        t_start = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            with self.lock:
+                self.busy_time[stage] += time.perf_counter() - t_start
+
+
+    def print_utilisation(self, wall_time: float, num_writers: int) -> None:
+        wall_time = max(wall_time, 1e-9)
+        print(
+            f"*\t Pipeline utilisation over {wall_time:.1f}s: "
+            f"readers {100 * self.busy_time['read'] / (wall_time * self.num_readers):.1f}% ({self.num_readers} workers), "
+            f"model {100 * self.busy_time['model'] / wall_time:.1f}%, "
+            f"writers {100 * self.busy_time['write'] / (wall_time * num_writers):.1f}% ({num_writers} workers)."
+        )
@@ -0,0 +1,129 @@
+import json
+import time
+import torch
+import numpy as np
+from tqdm import tqdm
+from PIL import Image
+from pathlib import Path
+import torch.nn.functional as F
+from transformers import AutoImageProcessor, SegformerForSemanticSegmentation
+from transformers.trainer_utils import PredictionOutput
+
+from onnxruntime.quantization import CalibrationDataReader, QuantFormat, QuantType, quantize_dynamic, quantize_static
+from onnxruntime.quantization.shape_inference import quant_pre_process
+
+from .ModelManager import preprocess_tiles
+from .EngineManager import ENGINE_ONNX, ENGINE_ONNX_INT8_DYNAMIC, ENGINE_ONNX_INT8_STATIC, create_onnx_session, export_onnx, get_onnx_path
+from ..training.evaluate import save_evaluation_to_text
+
+
+class TilesCalibrationReader(CalibrationDataReader):
+    """ Give the preprocessed calibration tiles to the static quantization, by batch. """
+
+    def __init__(self, processor: AutoImageProcessor, image_paths: list[Path], batch_size: int):
+        self.processor = processor
+        self.batches = [image_paths[i:i + batch_size] for i in range(0, len(image_paths), batch_size)]
+        self.index = 0
+
+    def get_next(self) -> dict | None:
+        if self.index == len(self.batches): return None
+
+        images = []
+        for image_path in self.batches[self.index]:
+            with Image.open(image_path) as image:
+                images.append(np.asarray(image.convert("RGB")))
+        self.index += 1
+
+        return {"pixel_values": preprocess_tiles(torch.from_numpy(np.stack(images)).permute(0, 3, 1, 2), self.processor).numpy()}
+
+
+class QuantizationManager:
+    """ Create INT8 versions of the ONNX export of a Segformer and compare their labels with the float model. """
+
+    def __init__(self, model_path: Path, batch_size: int, num_threads: int = 0):
+        self.model_path = model_path
+        self.batch_size = batch_size
+        self.num_threads = num_threads
+
+        # Same processor as the inference.
+        self.processor = AutoImageProcessor.from_pretrained("nvidia/mit-b0", do_reduce_labels=False, use_fast=False)
+        self.input_size = (self.processor.size["height"], self.processor.size["width"])
+
+        model = SegformerForSemanticSegmentation.from_pretrained(self.model_path).eval()
+        self.onnx_path = export_onnx(model, self.model_path, self.input_size, self.batch_size)
+
+
+    def quantize_dynamic(self) -> Path:
+        """ INT8 weights and activations quantized at run time, only for the matmuls of the attention and the MLP. """
+        output_path = get_onnx_path(self.model_path, ENGINE_ONNX_INT8_DYNAMIC)
+        print(f"*\t Dynamic quantization into {output_path}.")
+
+        quantize_dynamic(self.onnx_path, output_path, op_types_to_quantize=["MatMul"], weight_type=QuantType.QInt8)
+        return output_path
+
+
+    def quantize_static(self, calibration_images: list[Path]) -> Path:
+        """ INT8 weights and activations with ranges calibrated on the tiles, per channel weights. """
+        output_path = get_onnx_path(self.model_path, ENGINE_ONNX_INT8_STATIC)
+        print(f"*\t Static quantization into {output_path}, calibrated on {len(calibration_images)} tiles.")
+
+        preprocessed_path = Path(output_path.parent, f"{output_path.stem}.preprocessed.onnx")
+        quant_pre_process(self.onnx_path, preprocessed_path)
+
+        try:
+            calibration_reader = TilesCalibrationReader(self.processor, calibration_images, self.batch_size)
+            quantize_static(preprocessed_path, output_path, calibration_reader, quant_format=QuantFormat.QDQ, per_channel=True,
+                            activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8)
+        finally:
+            preprocessed_path.unlink(missing_ok=True)
+
+        return output_path
+
+
+    def predict_validation(self, engine: str, validation_ds, num_tiles: int) -> tuple[np.ndarray, float]:
+        """ Return the (N, num_labels, H/4, W/4) logits of the validation tiles and the time by tile in ms. """
+        session = create_onnx_session(get_onnx_path(self.model_path, engine), self.num_threads)
+
+        logits, duration = [], 0.0
+        for i in tqdm(range(0, num_tiles, self.batch_size), desc=f"Validation with {engine}", unit="batch"):
+            pixel_values = np.stack([validation_ds[j]["pixel_values"].numpy() for j in range(i, min(i + self.batch_size, num_tiles))])
+
+            t_start = time.perf_counter()
+            logits.append(session.run(None, {"pixel_values": pixel_values})[0])
+            duration += time.perf_counter() - t_start
+
+        return np.concatenate(logits), 1000 * duration / max(1, num_tiles)
+
+
+    def evaluate(self, validation_ds, num_labels: int, engines: list[str], report_path: Path, max_tiles: int = 0) -> None:
+        """
+            Write the pixel accuracy and the IoU by class of the float and INT8 models against the annotations, and of
+            the INT8 models against the float labels, with the time by tile of each model.
+        """
+        num_tiles = len(validation_ds) if max_tiles <= 0 else min(max_tiles, len(validation_ds))
+        labels = np.stack([validation_ds[i]["labels"].numpy() for i in range(num_tiles)])
+        report_path.unlink(missing_ok=True)
+
+        ms_by_tile = {}
+        float_logits, ms_by_tile[ENGINE_ONNX] = self.predict_validation(ENGINE_ONNX, validation_ds, num_tiles)
+        save_evaluation_to_text(PredictionOutput(float_logits, labels, None), num_labels, report_path, ENGINE_ONNX)
+
+        # Float labels at the annotation size, as in save_evaluation_to_text.
+        float_labels = F.interpolate(torch.from_numpy(float_logits), size=labels.shape[-2:], mode="bilinear", align_corners=False).argmax(dim=1).numpy()
+
+        for engine in engines:
+            int8_logits, ms_by_tile[engine] = self.predict_validation(engine, validation_ds, num_tiles)
+            save_evaluation_to_text(PredictionOutput(int8_logits, labels, None), num_labels, report_path, engine)
+            save_evaluation_to_text(PredictionOutput(int8_logits, float_labels, None), num_labels, report_path, f"{engine}_vs_{ENGINE_ONNX}")
+
+        with open(report_path) as f:
+            report = json.load(f)
+
+        for engine, ms in ms_by_tile.items():
+            report[engine]["ms_by_tile"] = round(ms, 2)
+            report[engine]["num_tiles"] = num_tiles
+
+        with open(report_path, "w") as f:
+            json.dump(report, f, indent=4)
+
+        print(f"*\t Time by tile: {', '.join(f'{engine} {ms:.1f} ms' for engine, ms in ms_by_tile.items())}.")
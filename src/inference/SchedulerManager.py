@@ -0,0 +1,208 @@
+import traceback
+import numpy as np
+from pathlib import Path
+from queue import Queue, Empty
+from datetime import datetime
+from argparse import Namespace
+from multiprocessing import get_context
+from threading import Condition, Event, Thread
+
+from .TileManager import TileManager
+from .ModelManager import ModelManager
+from .MosaicManager import MosaicManager
+from .PathRasterManager import PathRasterManager
+from ..utils.perf_tools import PerfReport
+from ..utils.mosaic_tools import get_mosaic_buffer_dtype
+from .JournalManager import JournalManager, JOURNAL_TILES, JOURNAL_PNG, JOURNAL_PREDICTIONS
+
+# Workers are started from a clean server process, forking threads running torch or holding GDAL handles can deadlock.
+MP_START_METHOD = "forkserver"
+
+# Imported once by the server, the workers then import the main module from their cache. The server only
+# imports __main__ itself on the Python versions passing it the main path.
+MP_PRELOAD = [
+    "__main__", "torch", "transformers", "transformers.models.segformer.modeling_segformer",
+    "transformers.models.segformer.image_processing_segformer", "rasterio", "geopandas", "shapely"
+]
+
+
+class SchedulerManager:
+    """
+        Overlap the tiling of raster N+1, the inference of raster N and the mosaic of raster N-1. Tiling and mosaic
+        run in their own thread with their process pools, the model runs in the main thread.
+    """
+
+    def __init__(self, opt: Namespace, tile_manager: TileManager, model_manager: ModelManager):
+        self.opt = opt
+        self.tile_manager = tile_manager
+        self.model_manager = model_manager
+        self.mp_context = get_context(MP_START_METHOD)
+        self.mp_context.set_forkserver_preload(MP_PRELOAD)
+        self.tile_manager.mp_context = self.mp_context
+        # Forkserver workers are children of the server, the perf reports can't count their CPU time and I/O.
+        self.workers_counted = self.mp_context.get_start_method() == "fork"
+
+        # Tiling waits while the intermediate files of the rasters in progress are over the disk budget.
+        self.disk_budget = int(opt.disk_budget_gb * 1024**3)
+
+        # The mosaic buffers have one band by class, in the dtype of the blending and of the max votes by pixel.
+        # The same max votes sizes the buffers of the mosaic, so they fit in the budget.
+        num_classes = len(self.model_manager.get_id2label())
+        self.max_votes = self.tile_manager.get_max_tiles_by_pixel()
+        bytes_by_pixel = num_classes * np.dtype(get_mosaic_buffer_dtype(opt.blending, self.max_votes)).itemsize
+        self.max_pixels_by_slice = min(opt.max_pixels_by_slice_of_rasters, opt.mosaic_memory_budget_mb * 1024**2 // bytes_by_pixel)
+
+        self.condition = Condition()
+        self.stop = Event()
+        self.rasters_in_progress: dict[str, PathRasterManager] = {}
+        # Number of released rasters, the disk usage only drops when one is released.
+        self.num_released = 0
+        self.rasters_fail: list[str] = []
+        self.t_starts: dict[str, datetime] = {}
+        self.perf_reports: dict[str, PerfReport] = {}
+
+
+    def run(self, list_rasters: list[Path]) -> list[str]:
+        """ Return the name of the failed rasters. """
+        self.rasters_fail = []
+        self.stop.clear()
+
+        # One raster waits between two stages, so each stage works on its own raster.
+        tiled_queue, inferred_queue = Queue(maxsize=1), Queue(maxsize=1)
+        tiling = Thread(target=self.tiling_loop, args=(list_rasters, tiled_queue), daemon=True)
+        mosaic = Thread(target=self.mosaic_loop, args=(inferred_queue,), daemon=True)
+        tiling.start()
+        mosaic.start()
+
+        try:
+            while (path_manager := tiled_queue.get()) != None:
+                if self.run_stage("inference", path_manager, self.inference_stage):
+                    inferred_queue.put(path_manager)
+        finally:
+            # On an early exit, the tiling thread can be waiting for the disk budget or blocked on the full queue.
+            self.stop.set()
+            with self.condition:
+                self.condition.notify_all()
+            while tiling.is_alive():
+                try:
+                    tiled_queue.get(timeout=0.1)
+                except Empty:
+                    pass
+            tiling.join()
+
+            inferred_queue.put(None)
+            mosaic.join()
+
+        return self.rasters_fail
+
+
+    def tiling_loop(self, list_rasters: list[Path], tiled_queue: Queue) -> None:
+        try:
+            for i, raster_path in enumerate(list_rasters):
+                # Filter all files who are not rasters files
+                if not raster_path.is_file() or raster_path.suffix != ".tif": continue
+
+                path_manager = PathRasterManager(self.opt.path_output, raster_path)
+                self.wait_disk_budget()
+                if self.stop.is_set(): break
+
+                print(f"\n\n--- {i+1}/{len(list_rasters)} - Tiling {raster_path.stem}")
+                with self.condition:
+                    self.rasters_in_progress[raster_path.name] = path_manager
+                    self.t_starts[raster_path.name] = datetime.now()
+                    self.perf_reports[raster_path.name] = PerfReport(raster_path.name, overlapped=True)
+
+                if self.run_stage("tiling", path_manager, self.tiling_stage):
+                    tiled_queue.put(path_manager)
+        finally:
+            tiled_queue.put(None)
+
+
+    def mosaic_loop(self, inferred_queue: Queue) -> None:
+        while (path_manager := inferred_queue.get()) != None:
+            if self.run_stage("mosaic", path_manager, self.mosaic_stage):
+                self.release(path_manager)
+
+
+    def tiling_stage(self, path_manager: PathRasterManager) -> None:
+        # Only the intermediate files of this raster are removed, the previous ones can be in progress.
+        path_manager.clean_raster() if self.opt.clean else path_manager.create_path()
+        journal = JournalManager(path_manager.journal_file)
+        perf_report = self.perf_reports[path_manager.raster_path.name]
+
+        if not journal.is_stage_done(JOURNAL_TILES):
+            with perf_report.stage("tiling", path_manager.cropped_ortho_folder, self.workers_counted):
+                self.tile_manager.split_ortho_into_tiles(path_manager, journal)
+
+        if not journal.is_stage_done(JOURNAL_PNG):
+            with perf_report.stage("conversion", path_manager.cropped_ortho_img_folder, self.workers_counted):
+                self.tile_manager.convert_tiff_tiles_into_png(path_manager, journal)
+
+
+    def inference_stage(self, path_manager: PathRasterManager) -> None:
+        journal = JournalManager(path_manager.journal_file)
+
+        if not journal.is_stage_done(JOURNAL_PREDICTIONS):
+            with self.perf_reports[path_manager.raster_path.name].stage("inference", path_manager.predictions_tiff_folder):
+                self.model_manager.inference(path_manager, journal)
+            self.perf_reports[path_manager.raster_path.name].add_metrics("inference", self.model_manager.get_dedup_stats())
+
+
+    def mosaic_stage(self, path_manager: PathRasterManager) -> None:
+        # Files of the mosaic stage are the prediction tiles voted into the final raster.
+        perf_report = self.perf_reports[path_manager.raster_path.name]
+        with perf_report.stage("mosaic", workers_counted=self.workers_counted):
+            mosaic_manager = MosaicManager(path_manager, self.model_manager.get_id2label(), self.max_pixels_by_slice, self.opt.blending, self.opt.blending_window, self.opt.memmap_vote_buffer, self.opt.num_mosaic_workers, self.mp_context, self.max_votes)
+            mosaic_manager.build_raster()
+        perf_report.add_input_files("mosaic", len(mosaic_manager.predictions_tiff_files))
+
+
+    def run_stage(self, stage: str, path_manager: PathRasterManager, stage_fn) -> bool:
+        """ Run one stage of a raster, a failed raster is released and doesn't go to the next stages. """
+        try:
+            stage_fn(path_manager)
+            return True
+        except Exception:
+            print(f"[ERROR] {stage} of {path_manager.raster_path.name} failed.")
+            print(traceback.format_exc(), end="\n\n")
+            self.rasters_fail.append(path_manager.raster_path.name)
+            self.release(path_manager)
+            return False
+
+
+    def release(self, path_manager: PathRasterManager) -> None:
+        if self.opt.clean:
+            path_manager.raster_disk_optimize()
+
+        with self.condition:
+            self.rasters_in_progress.pop(path_manager.raster_path.name, None)
+            t_start = self.t_starts.pop(path_manager.raster_path.name, datetime.now())
+            perf_report = self.perf_reports.pop(path_manager.raster_path.name, None)
+            self.num_released += 1
+            self.condition.notify_all()
+
+        # Stages of the other rasters run at the same time, the report counters are shared by the process.
+        if perf_report != None:
+            perf_report.save(path_manager.perf_report_file)
+
+        print(f"\n*\t {path_manager.raster_path.stem} done, running time {datetime.now() - t_start}")
+
+
+    def wait_disk_budget(self) -> None:
+        """
+            Wait until the rasters in progress use less than the disk budget, a single raster is never blocked.
+            Folders are scanned outside the lock, the usage is sampled again after each release.
+        """
+        while True:
+            with self.condition:
+                if self.stop.is_set() or len(self.rasters_in_progress) == 0: return
+                path_managers, num_released = list(self.rasters_in_progress.values()), self.num_released
+
+            if self.get_disk_usage(path_managers) < self.disk_budget: return
+
+            with self.condition:
+                self.condition.wait_for(lambda: self.stop.is_set() or self.num_released != num_released)
+
+
+    def get_disk_usage(self, path_managers: list[PathRasterManager]) -> int:
+        return sum(path_manager.get_raster_tmp_size() for path_manager in path_managers)
@@ -0,0 +1,195 @@
+import torch
+import numpy as np
+import torch.nn.functional as F
+
+import rasterio
+from rasterio.windows import Window
+
+from .PathRasterManager import PathRasterManager
+from ..utils.mosaic_tools import add_tiles_votes, add_tile_probabilities, add_tile_logits, create_mosaic_buffer, get_window_weights
+from ..utils.mosaic_tools import get_most_common_values, get_most_probable_values, BLENDING_SOFT, BLENDING_VOTE, BLENDING_LOGITS, WINDOW_NONE, MAX_VOTES_UINT16
+from ..utils.raster_constants import RASTER_CLASS_ID2COLOR, NO_DATA_VALUE, RASTER_BLOCK_SIZE
+
+class StreamMosaicManager:
+    """ Build the final raster from predictions streamed row strip by row strip, without intermediate files. """
+
+    def __init__(self, path_manager: PathRasterManager, id2label: dict, tile_size: int, blending: str = BLENDING_VOTE, blending_window: str = WINDOW_NONE, max_votes: int = MAX_VOTES_UINT16, logits_size: int = 0):
+        self.path_manager = path_manager
+        self.tile_size = tile_size
+        self.blending = blending
+        self.max_votes = max_votes
+        self.window_weights = get_window_weights(tile_size, tile_size, blending_window)
+
+        # Logits blending: tiles are (num_classes, logits_size, logits_size) logits, one low resolution pixel is scale x scale pixels.
+        if self.blending == BLENDING_LOGITS:
+            if logits_size <= 0 or tile_size % logits_size != 0 or RASTER_BLOCK_SIZE % (tile_size // logits_size) != 0:
+                raise ValueError(f"Logits blending needs a tile size multiple of the logits size {logits_size}, with a scale dividing {RASTER_BLOCK_SIZE}, got tile size {tile_size}.")
+            self.logits_size, self.scale = logits_size, tile_size // logits_size
+            self.window_weights = get_window_weights(logits_size, logits_size, blending_window)
+
+        with rasterio.open(self.path_manager.raster_path) as src:
+            self.crs, self.transform = src.crs, src.transform
+            self.height, self.width = src.height, src.width
+
+        self.global_min, self.global_max, self.num_classes = min(id2label), max(id2label), len(id2label)
+        print(f"✅ Detected class range: {self.global_min} to {self.global_max} ({self.num_classes} classes)")
+
+        # Rolling buffer: rows above the current strip are final and flushed by blocks of RASTER_BLOCK_SIZE rows.
+        self.buffer_rows = self.tile_size + RASTER_BLOCK_SIZE
+        self.buffer_top = 0
+        self.count_buffer, self.dst = None, None
+
+        # Low resolution buffers of the logits blending, low_top is the first raster row of the buffers at low resolution.
+        if self.blending == BLENDING_LOGITS:
+            self.low_height, self.low_width = -(-self.height // self.scale), -(-self.width // self.scale)
+            self.low_rows = self.buffer_rows // self.scale + 2
+            self.low_top = 0
+            self.logits_buffer, self.weights_buffer = None, None
+
+        # Masks of the current row band, voted together when the row changes.
+        self.pending_row, self.pending_tiles = 0, []
+
+
+    def create_raster(self) -> None:
+        """ Open the final raster, predictions must then be added sorted by tile_y. """
+
+        if self.blending == BLENDING_LOGITS:
+            self.logits_buffer = np.zeros((self.num_classes, self.low_rows, self.low_width), dtype=np.float32)
+            self.weights_buffer = np.zeros((self.low_rows, self.low_width), dtype=np.float32)
+            self.low_top = 0
+        else:
+            self.count_buffer = create_mosaic_buffer(self.blending, self.num_classes, self.buffer_rows, self.width, self.max_votes)
+        self.buffer_top = 0
+        self.pending_row, self.pending_tiles = 0, []
+
+        self.dst = rasterio.open(
+            self.path_manager.final_merged_tiff_file,
+            "w",
+            driver="GTiff",
+            height=self.height,
+            width=self.width,
+            count=1,
+            dtype=np.uint8,
+            crs=self.crs,
+            transform=self.transform,
+            compress="LZW",
+            tiled=True,
+            blockxsize=RASTER_BLOCK_SIZE,
+            blockysize=RASTER_BLOCK_SIZE,
+            nodata=NO_DATA_VALUE,
+        )
+        # The colormap sets the photometric tag, it can't be changed once blocks are written.
+        self.dst.write_colormap(1, RASTER_CLASS_ID2COLOR)
+
+
+    def add_prediction(self, tile_origin: tuple[int, int], prediction: np.ndarray) -> None:
+        """
+            prediction is a (H, W) mask in vote blending, (num_classes, H, W) probabilities in soft blending and
+            (num_classes, logits_size, logits_size) logits in logits blending.
+        """
+        tile_x, tile_y = tile_origin
+        if tile_y < max(self.buffer_top, self.pending_row):
+            raise ValueError(f"Predictions must be sorted by row, got row {tile_y} after row {max(self.buffer_top, self.pending_row)}.")
+
+        if self.blending == BLENDING_LOGITS:
+            self.add_logits(tile_x, tile_y, prediction)
+            return
+
+        if tile_y != self.pending_row:
+            self.add_pending_tiles()
+
+        if tile_y + prediction.shape[-2] > self.buffer_top + self.buffer_rows:
+            # All rows above tile_y are final.
+            self.flush_rows((tile_y - self.buffer_top) // RASTER_BLOCK_SIZE * RASTER_BLOCK_SIZE)
+
+        if self.blending == BLENDING_SOFT:
+            add_tile_probabilities(self.count_buffer, prediction, self.window_weights, tile_y - self.buffer_top, tile_x)
+        else:
+            self.pending_row = tile_y
+            self.pending_tiles.append((tile_x, prediction))
+
+
+    def add_logits(self, tile_x: int, tile_y: int, logits: np.ndarray) -> None:
+        """ Accumulate the weighted logits of a tile on the low resolution grid. Shifted edge tiles are rounded to the grid. """
+        low_row, low_col = round(tile_y / self.scale), round(tile_x / self.scale)
+
+        if low_row + logits.shape[-2] > self.low_top + self.low_rows:
+            # Rows read by the upsampling of the flushed rows are above the tile, blocks are flushed up to them.
+            self.flush_logits_rows(self.buffer_top + ((low_row - 1) * self.scale - self.buffer_top) // RASTER_BLOCK_SIZE * RASTER_BLOCK_SIZE)
+
+        add_tile_logits(self.logits_buffer, self.weights_buffer, logits, self.window_weights, low_row - self.low_top, low_col)
+
+
+    def flush_logits_rows(self, row_end: int) -> None:
+        """
+            Write the raster rows up to row_end, block by block. Each block is normalized, upsampled and reduced to
+            labels at once, with one low resolution row of margin on each side for the bilinear upsampling.
+        """
+        row_end = min(row_end, self.height)
+        while self.buffer_top < row_end:
+            block_end = min(row_end, self.buffer_top + RASTER_BLOCK_SIZE)
+            low_start = max(0, self.buffer_top // self.scale - 1)
+            low_end = min(self.low_height, -(-block_end // self.scale) + 1)
+
+            weights = self.weights_buffer[low_start - self.low_top:low_end - self.low_top]
+            if weights.any():
+                logits = self.logits_buffer[:, low_start - self.low_top:low_end - self.low_top] / np.maximum(weights, 1e-6)
+                logits = F.interpolate(torch.from_numpy(logits)[None], scale_factor=self.scale, mode="bilinear", align_corners=False)[0]
+
+                rows = slice(self.buffer_top - low_start * self.scale, block_end - low_start * self.scale)
+                labels = logits[:, rows, :self.width].argmax(dim=0).numpy().astype(np.uint8) + self.global_min
+
+                # Pixels without tiles, from the low resolution pixel they are in.
+                valid_pixel_mask = np.repeat(np.repeat(weights > 0, self.scale, axis=0), self.scale, axis=1)[rows, :self.width]
+                labels[~valid_pixel_mask] = NO_DATA_VALUE
+                self.dst.write(labels, 1, window=Window(0, self.buffer_top, self.width, block_end - self.buffer_top))
+
+            # Keep the low resolution row above the next block as its upsampling margin.
+            self.buffer_top = block_end
+            shift = min(max(0, self.buffer_top // self.scale - 1) - self.low_top, self.low_rows)
+            self.logits_buffer[:, :self.low_rows - shift] = self.logits_buffer[:, shift:]
+            self.logits_buffer[:, self.low_rows - shift:] = 0
+            self.weights_buffer[:self.low_rows - shift] = self.weights_buffer[shift:]
+            self.weights_buffer[self.low_rows - shift:] = 0
+            self.low_top += shift
+
+
+    def add_pending_tiles(self) -> None:
+        """ Vote the masks of the current row band in one call. """
+        if len(self.pending_tiles) == 0: return
+
+        cols_off = [tile_x for tile_x, _ in self.pending_tiles]
+        tiles_data = [prediction for _, prediction in self.pending_tiles]
+        add_tiles_votes(self.count_buffer, tiles_data, self.pending_row - self.buffer_top, cols_off, self.global_min, self.global_max)
+        self.pending_tiles = []
+
+
+    def close_raster(self, complete: bool = True) -> None:
+        """ Flush the remaining rows if complete, else only release the raster. """
+        try:
+            if complete:
+                if self.blending == BLENDING_LOGITS:
+                    self.flush_logits_rows(self.height)
+                else:
+                    self.add_pending_tiles()
+                    self.flush_rows(self.height - self.buffer_top)
+        finally:
+            self.dst.close()
+            self.count_buffer, self.logits_buffer, self.weights_buffer = None, None, None
+
+
+    def flush_rows(self, nb_rows: int) -> None:
+        """ Write the first nb_rows rows of the buffer into the final raster and shift the buffer. """
+
+        nb_rows_in_buffer = min(nb_rows, self.buffer_rows, self.height - self.buffer_top)
+        if nb_rows_in_buffer > 0 and self.count_buffer[:, :nb_rows_in_buffer].any():
+            if self.blending == BLENDING_SOFT:
+                most_common_values = get_most_probable_values(self.count_buffer[:, :nb_rows_in_buffer], self.global_min)
+            else:
+                most_common_values = get_most_common_values(self.count_buffer[:, :nb_rows_in_buffer], self.global_min)
+            self.dst.write(most_common_values, 1, window=Window(0, self.buffer_top, self.width, nb_rows_in_buffer))
+
+        nb_rows_in_buffer = min(nb_rows, self.buffer_rows)
+        self.count_buffer[:, :self.buffer_rows - nb_rows_in_buffer] = self.count_buffer[:, nb_rows_in_buffer:]
+        self.count_buffer[:, self.buffer_rows - nb_rows_in_buffer:] = 0
+        self.buffer_top += nb_rows
@@ -0,0 +1,60 @@
+from bisect import bisect_left
+from collections import Counter, defaultdict
+
+from rasterio.windows import Window
+
+
+class TileIndex:
+    """ Grid bucket index of the tiles footprints in mosaic pixels, buckets are keyed by the tile origin. """
+
+    def __init__(self, tiles_windows: list[Window], bucket_size: int = 256):
+        self.tiles_windows = tiles_windows
+        self.bucket_size = max(1, bucket_size)
+
+        self.max_height = max((int(w.height) for w in tiles_windows), default=0)
+        self.max_width = max((int(w.width) for w in tiles_windows), default=0)
+
+        self.buckets: dict[tuple[int, int], list[int]] = defaultdict(list)
+        for i, window in enumerate(tiles_windows):
+            self.buckets[(int(window.row_off) // self.bucket_size, int(window.col_off) // self.bucket_size)].append(i)
+
+
+    def query(self, window: Window) -> list[int]:
+        """ Return the index of the tiles intersecting the window, sorted by row then column of the tiles. """
+        row_start, col_start = int(window.row_off), int(window.col_off)
+        row_end, col_end = row_start + int(window.height), col_start + int(window.width)
+
+        # A tile intersects the window only if its origin is less than its size before the window.
+        candidates = []
+        for bucket_row in range((row_start - self.max_height + 1) // self.bucket_size, (row_end - 1) // self.bucket_size + 1):
+            for bucket_col in range((col_start - self.max_width + 1) // self.bucket_size, (col_end - 1) // self.bucket_size + 1):
+                candidates += self.buckets.get((bucket_row, bucket_col), [])
+
+        intersecting = [i for i in candidates if self.intersects(self.tiles_windows[i], row_start, col_start, row_end, col_end)]
+        return sorted(intersecting, key=lambda i: (self.tiles_windows[i].row_off, self.tiles_windows[i].col_off))
+
+
+    def get_max_tiles_by_pixel(self) -> int:
+        """
+            Upper bound of the number of tiles covering one pixel. The tiles covering a pixel have their row origin in
+            the max_height rows before it and their column origin in the max_width columns before it, the bound is
+            the product of the max number of distinct origins in such a span by axis, exact on a grid of tiles.
+        """
+        if len(self.tiles_windows) == 0: return 0
+
+        origins = Counter((int(w.row_off), int(w.col_off)) for w in self.tiles_windows)
+        nb_rows = self.get_max_origins_in_span(sorted({row for row, _ in origins}), self.max_height)
+        nb_cols = self.get_max_origins_in_span(sorted({col for _, col in origins}), self.max_width)
+        return nb_rows * nb_cols * max(origins.values())
+
+
+    @staticmethod
+    def get_max_origins_in_span(origins: list[int], span: int) -> int:
+        """ Max number of the sorted origins in [origin, origin + span), the span starting at one of them is enough. """
+        return max(bisect_left(origins, origin + span) - i for i, origin in enumerate(origins))
+
+
+    @staticmethod
+    def intersects(tile_window: Window, row_start: int, col_start: int, row_end: int, col_end: int) -> bool:
+        return tile_window.row_off < row_end and tile_window.row_off + tile_window.height > row_start \
+            and tile_window.col_off < col_end and tile_window.col_off + tile_window.width > col_start
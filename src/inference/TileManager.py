@@ -1,27 +1,94 @@
+import shapely
 import numpy as np
 from tqdm import tqdm
 import geopandas as gpd
 from pathlib import Path
 from argparse import Namespace
-from shapely.geometry import box
-from multiprocessing import Pool, cpu_count
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import cpu_count, get_context
+from concurrent.futures import ProcessPoolExecutor
 
 import rasterio
 from rasterio.windows import Window
-from rasterio.transform import array_bounds
+from rasterio.io import DatasetReader
 
-from ..utils.tiles_tools import convert_one_tiff_to_png
+from ..utils.tiles_tools import convert_one_tiff_to_png, get_tiles_keep_mask, get_ortho_tiles_keep_mask
 from .PathRasterManager import PathRasterManager
+from .JournalManager import JournalManager, JOURNAL_TILES, JOURNAL_PNG, MAX_BUFFERED_NAMES
 
 NUM_WORKERS = max(1, cpu_count() - 2)  # Use available CPU cores, leaving some free
 
+# State of a tiling worker, set once by init_tile_worker.
+worker_state = {}
+
+
+def get_tile_name(raster_path: Path, tile_x: int, tile_y: int) -> str:
+    return f"{raster_path.stem.replace('_ortho', '')}_{tile_x}_{tile_y}"
+
+
+def split_list(values: list, max_length: int) -> list[list]:
+    """ Consecutive chunks of at most max_length values, one chunk if max_length is 0, none if values is empty. """
+    if max_length <= 0:
+        return [values] if len(values) != 0 else []
+    return [values[i:i + max_length] for i in range(0, len(values), max_length)]
+
+
+def init_tile_worker(raster_path: Path, output_folder: Path, tile_size: int) -> None:
+    """ Pool initializer, open the ortho once by worker. It's closed with the worker. """
+    worker_state["ortho"] = rasterio.open(raster_path)
+    worker_state["raster_path"] = raster_path
+    worker_state["output_folder"] = output_folder
+    worker_state["tile_size"] = tile_size
+
+
+def extract_one_strip(strip: tuple[int, list[int]]) -> list[tuple[str, bool, str | None]]:
+    """ Read the window covering the tiles of the strip once and write each tile, return (tile name, success, error) by tile. """
+    tile_y, tiles_x = strip
+    ortho, tile_size = worker_state["ortho"], worker_state["tile_size"]
+    strip_col_off = min(tiles_x)
+
+    try:
+        strip_ortho = ortho.read(window=Window(strip_col_off, tile_y, max(tiles_x) + tile_size - strip_col_off, tile_size))
+    except Exception as e:
+        return [(get_tile_name(worker_state["raster_path"], tile_x, tile_y), False, str(e)) for tile_x in tiles_x]
+
+    return [write_one_tile(tile_x, tile_y, strip_ortho[:, :, tile_x - strip_col_off:tile_x - strip_col_off + tile_size]) for tile_x in tiles_x]
+
+
+def write_one_tile(tile_x: int, tile_y: int, tile_ortho: np.ndarray) -> tuple[str, bool, str | None]:
+    """ Write the tile at (tile_x, tile_y) of the worker ortho, return (tile name, success, error). """
+    ortho, tile_size = worker_state["ortho"], worker_state["tile_size"]
+    tile_name = get_tile_name(worker_state["raster_path"], tile_x, tile_y)
+
+    try:
+        window = Window(tile_x, tile_y, tile_size, tile_size)
+        tile_transform = rasterio.windows.transform(window, ortho.transform)
+
+        tile_output_path = Path(worker_state["output_folder"], f"{tile_name}.tif")
+
+        tile_meta = ortho.meta.copy()
+        tile_meta.update({
+            "height": tile_size,
+            "width": tile_size,
+            "transform": tile_transform
+        })
+
+        with rasterio.open(tile_output_path, "w", **tile_meta) as dest:
+            dest.write(tile_ortho)
+
+        return (tile_name, True, None)
+
+    except Exception as e:
+        return (tile_name, False, str(e))
+
+
 class TileManager:
 
     def __init__(self, opt: Namespace):
         self.opt = opt
         self.tile_size, self.hs, self.vs = 0, 0, 0
         self.geojson_datas = []
+        # Start method of the process pools, the scheduler avoids forking its threads.
+        self.mp_context = get_context()
 
         self.setup()
 
@@ -39,84 +106,194 @@ class TileManager:
             print("[WARNING] GeoJSON data - We don't crop the ortho with the geojson data due to no data.")
 
 
-    def split_ortho_into_tiles(self, path_manager: PathRasterManager) -> None:
+    def get_tiles_origins(self, width: int, height: int) -> tuple[list[int], list[int]]:
+        """ Return the sorted x and y origins of the tiles, last tiles are shifted to stay inside the ortho. """
+        xs = sorted({width - self.tile_size if x + self.tile_size >= width else x for x in range(0, width, self.hs)})
+        ys = sorted({height - self.tile_size if y + self.tile_size >= height else y for y in range(0, height, self.vs)})
+        return xs, ys
+
+
+    def get_max_tiles_by_pixel(self) -> int:
+        """ Upper bound of the number of tiles covering one pixel, the shifted last tiles add one by axis. """
+        return (-(-self.tile_size // self.hs) + 1) * (-(-self.tile_size // self.vs) + 1)
+
+
+    def get_aoi_tiles_mask(self, ortho: DatasetReader, xs: list[int], ys: list[int], tile_size: int = 0) -> np.ndarray:
+        """
+            Return a (len(ys), len(xs)) mask, True for the tiles intersecting the geojson areas. Areas are reprojected
+            once by raster and tested against all the tiles boxes at once. tile_size replaces the size of the tiles.
+        """
+        tile_size = tile_size if tile_size > 0 else self.tile_size
+        if len(self.geojson_datas) == 0:
+            return np.ones((len(ys), len(xs)), dtype=bool)
+
+        raster_crs = ortho.crs.to_string()
+        geojson_datas = [poly_gdf.to_crs(raster_crs) if poly_gdf.crs != raster_crs else poly_gdf for poly_gdf in self.geojson_datas]
+        aoi = shapely.union_all(np.concatenate([poly_gdf.geometry.to_numpy() for poly_gdf in geojson_datas]))
+        shapely.prepare(aoi)
+
+        tiles_x, tiles_y = np.meshgrid(np.asarray(xs), np.asarray(ys))
+        x_start, y_start = ortho.transform * (tiles_x, tiles_y)
+        x_end, y_end = ortho.transform * (tiles_x + tile_size, tiles_y + tile_size)
+        tiles_boxes = shapely.box(np.minimum(x_start, x_end), np.minimum(y_start, y_end), np.maximum(x_start, x_end), np.maximum(y_start, y_end))
+
+        return shapely.intersects(aoi, tiles_boxes)
+
+
+    def split_ortho_into_tiles(self, path_manager: PathRasterManager, journal: JournalManager) -> None:
+        """ Tiles already in the journal are skipped, the stage is done in the journal only if no tile failed. """
         print("*\t Splitting ortho into tiles.")
 
         with rasterio.open(path_manager.raster_path) as ortho:
-            
-            tile_coords = [
-                (
-                    path_manager, 
-                    ortho.width - self.tile_size if x + self.tile_size >= ortho.width else x, 
-                    ortho.height - self.tile_size if y + self.tile_size >= ortho.height else y
-                )
-                for x in range(0, ortho.width, self.hs) 
-                for y in range(0, ortho.height, self.vs)
-            ]
-            
-        with ProcessPoolExecutor(max_workers=cpu_count()) as executor:
-            futures = {executor.submit(self.extract_one_tile, arg): arg for arg in tile_coords}
-            for future in tqdm(as_completed(futures), total=len(futures)):
-                try:
-                    future.result()
-                except Exception as e:
-                    print(f" Worker crashed on {futures[future]}: {e}")
+            xs, ys = self.get_tiles_origins(ortho.width, ortho.height)
+            aoi_mask = self.get_aoi_tiles_mask(ortho, xs, ys)
+            keep_mask = get_ortho_tiles_keep_mask(ortho, xs, ys, self.tile_size, aoi_mask)
 
+        # Only tiles inside the geojson areas, not mostly black or white and not written by a previous run are sent to the workers, by row strip.
+        strips = []
+        for i, tile_y in enumerate(ys):
+            tiles_x = [tile_x for j, tile_x in enumerate(xs) if keep_mask[i, j] and not journal.is_done(JOURNAL_TILES, get_tile_name(path_manager.raster_path, tile_x, tile_y))]
+            if len(tiles_x) != 0:
+                strips.append((tile_y, tiles_x))
 
-    def extract_one_tile(self, args: tuple[PathRasterManager, int, int]) -> tuple[str, bool, str | None]:
-        path_manager, tile_x, tile_y = args
-        orthoname = path_manager.raster_path.stem.replace("_ortho", "")
+        num_tiles = sum(len(tiles_x) for _, tiles_x in strips)
+        print(f"*\t {keep_mask.sum()} tiles on {aoi_mask.size} kept, {num_tiles} to write in {len(strips)} strips, {aoi_mask.sum()} intersect the geojson areas.")
+
+        # Workers open the ortho once, tasks only carry the strip row and its tiles columns.
+        num_fails = 0
+        initargs = (path_manager.raster_path, path_manager.cropped_ortho_folder, self.tile_size)
+        with ProcessPoolExecutor(max_workers=cpu_count(), initializer=init_tile_worker, initargs=initargs, mp_context=self.mp_context) as executor:
+            for strip_results in tqdm(executor.map(extract_one_strip, strips), total=len(strips), unit="strip"):
+                for tile_name, success, error in strip_results:
+                    if not success:
+                        num_fails += 1
+                        print(f" Worker crashed on {tile_name}: {error}")
+
+                journal.add(JOURNAL_TILES, [tile_name for tile_name, success, _ in strip_results if success])
+
+        if num_fails == 0:
+            journal.add_stage(JOURNAL_TILES)
+
+
+    def get_strips(self, path_manager: PathRasterManager, max_tiles_by_strip: int = 0) -> list[tuple[PathRasterManager, int, list[int]]]:
+        """
+            Return (path_manager, tile_y, tiles_x) for each row strip, tiles outside the geojson areas are removed.
+            Rows are split into strips of at most max_tiles_by_strip tiles, so the memory of a strip doesn't grow
+            with the ortho width.
+        """
+
+        with rasterio.open(path_manager.raster_path) as ortho:
+            xs, ys = self.get_tiles_origins(ortho.width, ortho.height)
+            aoi_mask = self.get_aoi_tiles_mask(ortho, xs, ys)
+
+        strips = []
+        for i, tile_y in enumerate(ys):
+            tiles_x = [tile_x for j, tile_x in enumerate(xs) if aoi_mask[i, j]]
+            strips.extend((path_manager, tile_y, chunk) for chunk in split_list(tiles_x, max_tiles_by_strip))
+
+        return strips
 
-        try:
-            with rasterio.open(path_manager.raster_path) as ortho:
-                raster_crs = ortho.crs.to_string()
-                window = Window(tile_x, tile_y, self.tile_size, self.tile_size)
-                tile_transform = rasterio.windows.transform(window, ortho.transform)
 
-                if len(self.geojson_datas) != 0:
-                    tile_bounds = box(*array_bounds(self.tile_size, self.tile_size, tile_transform))
-                    for poly_gdf in self.geojson_datas:
-                        if poly_gdf.crs != raster_crs:
-                            poly_gdf = poly_gdf.to_crs(raster_crs)
-                        if poly_gdf.intersects(tile_bounds).any():
-                            break
-                    else:
-                        return (f"{orthoname}_{tile_x}_{tile_y}", True, "No intersection")
+    def read_strip(self, strip: tuple[PathRasterManager, int, list[int]]) -> list[tuple[tuple[int, int], np.ndarray]]:
+        """ Read the columns of the strip tiles once and return ((tile_x, tile_y), tile) for kept tiles, tiles are views on the strip. """
+        path_manager, tile_y, tiles_x = strip
+        strip_col_off = min(tiles_x)
 
-                tile_ortho = ortho.read(window=window)
-                greyscale_tile = np.sum(tile_ortho, axis=0) / 3
+        with rasterio.open(path_manager.raster_path) as ortho:
+            strip_ortho = ortho.read(window=Window(strip_col_off, tile_y, max(tiles_x) + self.tile_size - strip_col_off, self.tile_size))
+
+        cols_off = [tile_x - strip_col_off for tile_x in tiles_x]
+        keep_mask = get_tiles_keep_mask(strip_ortho, cols_off, [0], self.tile_size)[0]
+        return [((tile_x, tile_y), strip_ortho[:, :, col_off:col_off + self.tile_size]) for tile_x, col_off, keep in zip(tiles_x, cols_off, keep_mask) if keep]
+
+
+    def get_window_strips(self, path_manager: PathRasterManager, max_windows_by_strip: int = 0) -> list[tuple[PathRasterManager, int, list[int], list[list[tuple[int, int]]]]]:
+        """
+            Return (path_manager, window_y, windows_x, windows_tiles) for each row strip of windows, windows are
+            cores of window_size pixels side by side, without overlap. windows_tiles are the origins of the tiles
+            kept by the tiled mode intersecting each core, windows without kept tiles are removed. Rows are split
+            into strips of at most max_windows_by_strip windows.
+        """
+        window_size = self.opt.window_size
+
+        # Tiles of the tiled mode are tested once on the whole ortho, they may overlap two rows of windows.
+        with rasterio.open(path_manager.raster_path) as ortho:
+            width, height = ortho.width, ortho.height
+            xs, ys = self.get_tiles_origins(width, height)
+            keep_mask = get_ortho_tiles_keep_mask(ortho, xs, ys, self.tile_size, self.get_aoi_tiles_mask(ortho, xs, ys))
+
+        kept_rows, kept_cols = np.nonzero(keep_mask)
+        kept_y, kept_x = np.asarray(ys)[kept_rows], np.asarray(xs)[kept_cols]
 
-                percentage_black_pixel = np.sum(greyscale_tile == 0) * 100 / self.tile_size**2
-                if percentage_black_pixel > 5:
-                    return (f"{orthoname}_{tile_x}_{tile_y}", True, "Too black")
+        strips = []
+        for window_y in range(0, height, window_size):
+            in_row = (kept_y > window_y - self.tile_size) & (kept_y < window_y + window_size)
+            row_y, row_x = kept_y[in_row], kept_x[in_row]
 
-                percentage_white_pixel = np.sum(greyscale_tile == 255) * 100 / self.tile_size**2
-                if percentage_white_pixel > 10:
-                    return (f"{orthoname}_{tile_x}_{tile_y}", True, "Too white")
+            windows = []
+            for window_x in range(0, width, window_size):
+                in_window = (row_x > window_x - self.tile_size) & (row_x < window_x + window_size)
+                if in_window.any():
+                    windows.append((window_x, list(zip(row_x[in_window].tolist(), row_y[in_window].tolist()))))
 
-                tile_filename = f"{orthoname}_{tile_x}_{tile_y}.tif"
-                tile_output_path = Path(path_manager.cropped_ortho_folder, tile_filename)
+            strips.extend(
+                (path_manager, window_y, [window_x for window_x, _ in chunk], [tiles for _, tiles in chunk])
+                for chunk in split_list(windows, max_windows_by_strip)
+            )
 
-                tile_meta = ortho.meta.copy()
-                tile_meta.update({
-                    "height": self.tile_size,
-                    "width": self.tile_size,
-                    "transform": tile_transform
-                })
+        return strips
 
-                with rasterio.open(tile_output_path, "w", **tile_meta) as dest:
-                    dest.write(tile_ortho)
 
-            return (f"{orthoname}_{tile_x}_{tile_y}", True, None)
+    def read_window_strip(self, strip: tuple[PathRasterManager, int, list[int], list[list[tuple[int, int]]]]) -> list[tuple[tuple, np.ndarray]]:
+        """
+            Read the columns of the strip windows with their halo once and return (((core_x, core_y), core slices,
+            coverage), window) for each window. Halos are shifted inside the ortho at its edges, so all windows have
+            the same size. coverage is True on the core pixels covered by the kept tiles of the window, the others
+            are left to NO_DATA like in the tiled mode.
+        """
+        path_manager, window_y, windows_x, windows_tiles = strip
+        window_size, halo = self.opt.window_size, self.opt.window_halo
 
-        except Exception as e:
-            return (f"{orthoname}_{tile_x}_{tile_y}", False, str(e))
+        with rasterio.open(path_manager.raster_path) as ortho:
+            width, height = ortho.width, ortho.height
+            input_width, input_height = min(window_size + 2 * halo, width), min(window_size + 2 * halo, height)
+            input_y = min(max(0, window_y - halo), height - input_height)
+            inputs_x = [min(max(0, window_x - halo), width - input_width) for window_x in windows_x]
+            strip_col_off = min(inputs_x)
+            strip_ortho = ortho.read(window=Window(strip_col_off, input_y, max(inputs_x) + input_width - strip_col_off, input_height))
+
+        core_height = min(window_size, height - window_y)
+        core_y = window_y - input_y
+
+        windows = []
+        for window_x, input_x, tiles in zip(windows_x, inputs_x, windows_tiles):
+            core_width = min(window_size, width - window_x)
+            coverage = np.zeros((core_height, core_width), dtype=bool)
+            for tile_x, tile_y in tiles:
+                coverage[max(0, tile_y - window_y):tile_y - window_y + self.tile_size, max(0, tile_x - window_x):tile_x - window_x + self.tile_size] = True
+
+            core = (slice(core_y, core_y + core_height), slice(window_x - input_x, window_x - input_x + core_width))
+            windows.append((((window_x, window_y), core, coverage), strip_ortho[:, :, input_x - strip_col_off:input_x - strip_col_off + input_width]))
 
+        return windows
 
-    
-    def convert_tiff_tiles_into_png(self, path_manager: PathRasterManager) -> None:
+
+    def convert_tiff_tiles_into_png(self, path_manager: PathRasterManager, journal: JournalManager) -> None:
+        """ Tiles already converted in the journal are skipped, the stage is done once all the tiles are written. """
         print("*\t Convert ortho tiff tiles into png files.")
-        filepaths = [(filepath, path_manager.cropped_ortho_img_folder) for filepath in path_manager.cropped_ortho_folder.iterdir()]
+        filepaths = [(filepath, path_manager.cropped_ortho_img_folder) for filepath in path_manager.cropped_ortho_folder.iterdir() if not journal.is_done(JOURNAL_PNG, filepath.stem)]
+
+        # Converted tiles are appended to the journal by chunks of MAX_BUFFERED_NAMES.
+        converted = []
+        try:
+            with self.mp_context.Pool(processes=cpu_count()) as pool:
+                for (filepath, _), _ in zip(filepaths, tqdm(pool.imap(convert_one_tiff_to_png, filepaths), total=len(filepaths), desc=f"Processing {path_manager.cropped_ortho_folder.name}")):
+                    converted.append(filepath.stem)
+                    if len(converted) >= MAX_BUFFERED_NAMES:
+                        journal.add(JOURNAL_PNG, converted)
+                        converted = []
+        finally:
+            journal.add(JOURNAL_PNG, converted)
 
-        with Pool(processes=cpu_count()) as pool:
-            list(tqdm(pool.imap(convert_one_tiff_to_png, filepaths, ), total=len(filepaths), desc=f"Processing {path_manager.cropped_ortho_folder.name}"))
+        if journal.is_stage_done(JOURNAL_TILES):
+            journal.add_stage(JOURNAL_PNG)
@@ -0,0 +1,175 @@
+import numpy as np
+from pathlib import Path
+
+from .raster_constants import NO_DATA_VALUE
+
+BLENDING_VOTE = "vote"
+BLENDING_SOFT = "soft"
+BLENDING_LOGITS = "logits"
+
+WINDOW_NONE = "none"
+WINDOW_GAUSSIAN = "gaussian"
+WINDOW_COSINE = "cosine"
+
+MAX_VOTES_UINT8 = np.iinfo(np.uint8).max
+MAX_VOTES_UINT16 = np.iinfo(np.uint16).max
+
+# GDAL has no float16 type, probability tiles store the bits of the float16 probabilities in uint16 bands.
+PROBABILITIES_TILE_DTYPE = np.uint16
+
+
+def get_tile_crop(tile_shape: tuple[int, int], row_off: int, col_off: int, buffer_shape: tuple[int, int]) -> tuple[tuple[slice, slice], tuple[slice, slice]] | None:
+    """ Return (buffer slices, tile slices) of the part of a tile at (row_off, col_off) inside the buffer, None if outside. """
+
+    # Handle Negative Offsets (for overlapping images)
+    row_start_tile = max(0, -row_off)
+    col_start_tile = max(0, -col_off)
+
+    row_off = max(0, row_off)  # Adjust offset to fit inside mosaic
+    col_off = max(0, col_off)
+
+    row_end = min(row_off + tile_shape[0] - row_start_tile, buffer_shape[0])
+    col_end = min(col_off + tile_shape[1] - col_start_tile, buffer_shape[1])
+
+    tile_height = row_end - row_off
+    tile_width = col_end - col_off
+
+    if tile_height <= 0 or tile_width <= 0:
+        return None  # Skip tiles that are completely outside
+
+    return (
+        (slice(row_off, row_end), slice(col_off, col_end)),
+        (slice(row_start_tile, row_start_tile + tile_height), slice(col_start_tile, col_start_tile + tile_width))
+    )
+
+
+def get_mosaic_buffer_dtype(blending: str, max_votes: int = MAX_VOTES_UINT16) -> type:
+    if blending == BLENDING_SOFT:
+        return np.float16
+    return np.uint8 if max_votes <= MAX_VOTES_UINT8 else np.uint16
+
+
+def create_mosaic_buffer(blending: str, num_classes: int, height: int, width: int, max_votes: int = MAX_VOTES_UINT16, memmap_path: Path | None = None) -> np.ndarray:
+    """
+        Probabilities are accumulated in float16 to keep the buffer compact. Votes are counted in uint8 when
+        max_votes, the max number of tiles covering one pixel, fits into it, else in uint16.
+        With memmap_path, the buffer is a zero filled scratch file mapped in memory.
+    """
+    dtype = get_mosaic_buffer_dtype(blending, max_votes)
+    if memmap_path != None:
+        return np.memmap(memmap_path, dtype=dtype, mode="w+", shape=(num_classes, height, width))
+    return np.zeros((num_classes, height, width), dtype=dtype)
+
+
+def encode_tile_probabilities(tile_proba: np.ndarray) -> np.ndarray:
+    """ Return the (num_classes, H, W) probabilities as the uint16 bands of a probability tile, without rounding float16 values. """
+    return tile_proba.astype(np.float16).view(PROBABILITIES_TILE_DTYPE)
+
+
+def decode_tile_probabilities(tile_data: np.ndarray) -> np.ndarray:
+    """ Return the float16 probabilities of the bands of a probability tile. """
+    if tile_data.dtype != PROBABILITIES_TILE_DTYPE:
+        raise ValueError(f"Probability tiles must be {np.dtype(PROBABILITIES_TILE_DTYPE).name} bands of float16 bits, got {tile_data.dtype}.")
+    return tile_data.view(np.float16)
+
+
+def add_tiles_votes(count_buffer: np.ndarray, tiles_data: list[np.ndarray], row_off: int, cols_off: list[int], global_min: int, global_max: int) -> None:
+    """
+        Add the votes of tiles sharing the same row band into count_buffer. Each tile is compared to all classes
+        in one pass and its one hot votes are added as uint8. A uint16 count_buffer gets the votes of the band at once.
+    """
+    if len(tiles_data) == 0: return
+
+    classes = np.arange(global_min, global_max + 1, dtype=tiles_data[0].dtype)[:, None, None]
+    band_col_off = min(cols_off)
+    band_height = max(tile_data.shape[0] for tile_data in tiles_data)
+    band_width = max(col_off + tile_data.shape[1] for tile_data, col_off in zip(tiles_data, cols_off)) - band_col_off
+
+    crop = get_tile_crop((band_height, band_width), row_off, band_col_off, count_buffer.shape[1:])
+    if crop == None: return
+    (buffer_rows, buffer_cols), (band_rows, band_cols) = crop
+
+    in_place = count_buffer.dtype == np.uint8
+    if in_place:
+        # Votes are added in place, the buffer has been sized for them.
+        band_buffer, band_size = count_buffer[:, buffer_rows, buffer_cols], len(tiles_data)
+        band_row_off, band_col_off = band_rows.start, band_col_off + band_cols.start
+    else:
+        band_buffer, band_size = np.zeros((len(classes), band_height, band_width), dtype=np.uint8), MAX_VOTES_UINT8
+        band_row_off = 0
+
+    one_hot = np.empty((len(classes), *tiles_data[0].shape), dtype=bool)
+    for i in range(0, len(tiles_data), band_size):
+        for tile_data, col_off in zip(tiles_data[i:i + band_size], cols_off[i:i + band_size]):
+            # Tile part inside the band buffer.
+            tile_crop = get_tile_crop(tile_data.shape, -band_row_off, col_off - band_col_off, band_buffer.shape[1:])
+            if tile_crop == None: continue
+            (view_rows, view_cols), (tile_rows, tile_cols) = tile_crop
+
+            if one_hot.shape[1:] != tile_data.shape:
+                one_hot = np.empty((len(classes), *tile_data.shape), dtype=bool)
+
+            np.equal(tile_data[None], classes, out=one_hot)
+            band_view = band_buffer[:, view_rows, view_cols]
+            np.add(band_view, one_hot[:, tile_rows, tile_cols].view(np.uint8), out=band_view)
+
+        if not in_place:
+            count_buffer[:, buffer_rows, buffer_cols] += band_buffer[:, band_rows, band_cols]
+            band_buffer[:] = 0
+
+
+def add_tile_probabilities(prob_buffer: np.ndarray, tile_proba: np.ndarray, weights: np.ndarray, row_off: int, col_off: int) -> None:
+    """ Add the (num_classes, H, W) probabilities of one tile, weighted by the window, into prob_buffer at (row_off, col_off). """
+
+    crop = get_tile_crop(tile_proba.shape[1:], row_off, col_off, prob_buffer.shape[1:])
+    if crop == None: return
+    (buffer_rows, buffer_cols), (tile_rows, tile_cols) = crop
+
+    prob_buffer[:, buffer_rows, buffer_cols] += tile_proba[:, tile_rows, tile_cols] * weights[tile_rows, tile_cols]
+
+
+def add_tile_logits(logits_buffer: np.ndarray, weights_buffer: np.ndarray, tile_logits: np.ndarray, weights: np.ndarray, row_off: int, col_off: int) -> None:
+    """ Add the (num_classes, h, w) low resolution logits of one tile weighted by the window, and the window into weights_buffer. """
+
+    crop = get_tile_crop(tile_logits.shape[1:], row_off, col_off, logits_buffer.shape[1:])
+    if crop == None: return
+    (buffer_rows, buffer_cols), (tile_rows, tile_cols) = crop
+
+    logits_buffer[:, buffer_rows, buffer_cols] += tile_logits[:, tile_rows, tile_cols] * weights[tile_rows, tile_cols]
+    weights_buffer[buffer_rows, buffer_cols] += weights[tile_rows, tile_cols]
+
+
+def get_window_weights(height: int, width: int, window: str) -> np.ndarray:
+    """ Weights of the pixels of a tile, pixels near the edges have less context and count less. """
+
+    def weights_1d(size: int) -> np.ndarray:
+        if window == WINDOW_GAUSSIAN:
+            return np.exp(-(np.arange(size) - (size - 1) / 2)**2 / (2 * (size / 4)**2))
+        if window == WINDOW_COSINE:
+            return np.sin(np.pi * (np.arange(size) + 0.5) / size)**2 # Never zero, so border pixels of the ortho keep a value.
+        return np.ones(size)
+
+    return np.outer(weights_1d(height), weights_1d(width)).astype(np.float32)
+
+
+def get_most_common_values(count_buffer: np.ndarray, global_min: int) -> np.ndarray:
+    """ Return the most voted class for each pixel, NO_DATA_VALUE where no tile has voted. """
+
+    most_common_values = np.full(count_buffer.shape[1:], NO_DATA_VALUE, dtype=np.uint8)  # Default to NO_DATA_VALUE
+
+    # Faster argmax using efficient NumPy operations
+    valid_pixel_mask = count_buffer.sum(axis=0) > 0  # Avoid unnecessary computation
+    most_common_values[valid_pixel_mask] = count_buffer[:, valid_pixel_mask].argmax(axis=0) + global_min
+
+    return most_common_values
+
+
+def get_most_probable_values(prob_buffer: np.ndarray, global_min: int) -> np.ndarray:
+    """ Return the class with the highest accumulated probability, NO_DATA_VALUE where no tile contributes. """
+
+    most_probable_values = np.full(prob_buffer.shape[1:], NO_DATA_VALUE, dtype=np.uint8)
+
+    valid_pixel_mask = prob_buffer.max(axis=0) > 0
+    most_probable_values[valid_pixel_mask] = prob_buffer[:, valid_pixel_mask].argmax(axis=0) + global_min
+
+    return most_probable_values
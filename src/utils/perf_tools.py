@@ -0,0 +1,149 @@
+import json
+import time
+import resource
+from threading import Lock
+from pathlib import Path
+from datetime import datetime
+from contextlib import contextmanager
+from typing import Iterator
+
+PROC_IO = Path("/proc/self/io")
+PROC_STATUS = Path("/proc/self/status")
+PROC_CLEAR_REFS = Path("/proc/self/clear_refs")
+
+
+def get_cpu_time() -> float:
+    """
+        User and system CPU time in seconds of this process, its threads and its terminated child processes. Workers
+        started by a forkserver are children of the server, they aren't counted.
+    """
+    usage_self, usage_children = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage_self.ru_utime + usage_self.ru_stime + usage_children.ru_utime + usage_children.ru_stime
+
+
+def get_io_bytes() -> tuple[int, int] | None:
+    """
+        Bytes read and written by this process and its terminated child processes, None if /proc is not available.
+        Workers started by a forkserver are children of the server, they aren't counted.
+    """
+    try:
+        io = dict(line.split(": ") for line in PROC_IO.read_text().splitlines())
+        return int(io["rchar"]), int(io["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def reset_peak_rss() -> bool:
+    """ Reset the peak RSS of this process to its current RSS, only on Linux. """
+    try:
+        PROC_CLEAR_REFS.write_text("5")
+        return True
+    except OSError:
+        return False
+
+
+def get_peak_rss_mb() -> float:
+    """ Peak RSS of this process since the last reset, or since its start if the peak can't be reset. """
+    try:
+        for line in PROC_STATUS.read_text().splitlines():
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def count_files(folder: Path | None) -> int | None:
+    """ Number of files in folder, None if there is no folder. """
+    if folder == None:
+        return None
+    return len([f for f in folder.iterdir() if f.is_file()]) if folder.exists() else 0
+
+
+def get_peak_rss_children_mb() -> float:
+    """ Peak RSS of the largest terminated child process since the start of the process, forkserver workers excluded. """
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+
+
+class PerfReport:
+    """
+        Record the wall time, CPU time, bytes read and written, file count and peak RSS of named stages, then save
+        them as JSON. Counters are by process, when stages overlap in threads they also count the other stages.
+        The peak RSS is only reset by the outermost stage, a nested stage reports the peak of its enclosing stage.
+    """
+
+    active_stages = 0 # Stages running in this process, across all reports.
+    active_stages_lock = Lock()
+
+    def __init__(self, name: str, overlapped: bool = False):
+        self.name = name
+        self.overlapped = overlapped
+        self.date = datetime.now().isoformat(timespec="seconds")
+        self.stages: dict[str, dict] = {}
+
+
+    @contextmanager
+    def stage(self, name: str, folder: Path | None = None, workers_counted: bool = True) -> Iterator[None]:
+        """
+            Time the block, the files created in folder during the stage give the file count and the tiles/s. If the
+            stage runs workers outside the children of this process, like forkserver workers, workers_counted is False
+            and the CPU time, bytes and children peak RSS are None instead of only the share of this process.
+        """
+        with PerfReport.active_stages_lock:
+            can_reset_rss = not self.overlapped and PerfReport.active_stages == 0 and reset_peak_rss()
+            PerfReport.active_stages += 1
+
+        files_start = count_files(folder)
+        io_start, cpu_start, t_start = get_io_bytes(), get_cpu_time(), time.perf_counter()
+        success = False
+
+        try:
+            yield
+            success = True
+        finally:
+            wall_time = max(time.perf_counter() - t_start, 1e-9)
+            io_end = get_io_bytes()
+            files_end = count_files(folder)
+            num_files = files_end - files_start if files_start != None and files_end != None else None
+            with PerfReport.active_stages_lock:
+                PerfReport.active_stages -= 1
+
+            self.stages[name] = {
+                "success": success,
+                "wall_time_s": round(wall_time, 3),
+                "cpu_time_s": round(get_cpu_time() - cpu_start, 3) if workers_counted else None,
+                "bytes_read": io_end[0] - io_start[0] if workers_counted and io_start != None and io_end != None else None,
+                "bytes_written": io_end[1] - io_start[1] if workers_counted and io_start != None and io_end != None else None,
+                "files": num_files,
+                "tiles_by_s": round(num_files / wall_time, 2) if num_files != None else None,
+                "peak_rss_mb": round(get_peak_rss_mb(), 1),
+                "peak_rss_is_stage": can_reset_rss,
+                "peak_rss_children_mb": round(get_peak_rss_children_mb(), 1) if workers_counted else None,
+                "workers_counted": workers_counted,
+            }
+
+
+    def add_metrics(self, name: str, metrics: dict) -> None:
+        """ Add counters of the stage, like the forward passes saved by the deduplication. """
+        if name in self.stages:
+            self.stages[name].update(metrics)
+
+
+    def add_input_files(self, name: str, num_files: int) -> None:
+        """ Count the files read by the stage, or the tiles streamed, for stages that write no file into their folder. """
+        if name in self.stages:
+            self.stages[name].update({"files": num_files, "tiles_by_s": round(num_files / max(self.stages[name]["wall_time_s"], 1e-9), 2)})
+
+
+    def save(self, report_file: Path) -> None:
+        report = {
+            "name": self.name,
+            "date": self.date,
+            "overlapped": self.overlapped,
+            "total_wall_time_s": round(sum(stage["wall_time_s"] for stage in self.stages.values()), 3),
+            "stages": self.stages,
+        }
+
+        report_file.parent.mkdir(exist_ok=True, parents=True)
+        with open(report_file, "w") as f:
+            json.dump(report, f, indent=4)
@@ -14,4 +14,6 @@ RASTER_CLASS_ID2LABEL = {
     5: "Syringodium Isoetifolium"
 }
 
-NO_DATA_VALUE = 0
\ No newline at end of file
+NO_DATA_VALUE = 0
+
+RASTER_BLOCK_SIZE = 256
@@ -7,10 +7,13 @@ from pathlib import Path
 
 import rasterio
 from rasterio.mask import mask
+from rasterio.io import DatasetReader
 from rasterio.warp import transform_geom
 from rasterio.transform import from_origin
 from rasterio.windows import from_bounds, Window
 
+QUALITY_BAND_ROWS = 1024 # Rows of tiles origins read at once by the quality filter.
+
 
 def convert_one_tiff_to_png(args: tuple[Path, Path]) -> None:
     """Convert an image or annotation from TIFF to PNG without using GDAL."""
@@ -36,6 +39,58 @@ def convert_one_tiff_to_png(args: tuple[Path, Path]) -> None:
     image.save(png_output_path)
 
 
+def get_tiles_keep_mask(band_data: np.ndarray, xs: list[int], ys: list[int], tile_size: int) -> np.ndarray:
+    """
+        Return a (len(ys), len(xs)) mask of the tiles at (x, y) in band_data to keep, tiles are skipped if the
+        greyscale is more than 5% black or 10% white. Counts come from summed-area tables of the band.
+    """
+
+    # Integer greyscale sum, black is 0 and white is 3 * 255.
+    greyscale_sum = np.sum(band_data, axis=0, dtype=np.uint16)
+    ys, xs = np.asarray(ys), np.asarray(xs)
+
+    def get_tiles_count(indicator: np.ndarray) -> np.ndarray:
+        # Summed by column then by row, the column sums stay in uint16.
+        columns_table = np.zeros((indicator.shape[0] + 1, indicator.shape[1]), dtype=np.uint16)
+        np.cumsum(indicator, axis=0, dtype=np.uint16, out=columns_table[1:])
+
+        tiles_columns = (columns_table[ys + tile_size] - columns_table[ys]).astype(np.int64)
+        rows_table = np.zeros((len(ys), indicator.shape[1] + 1), dtype=np.int64)
+        np.cumsum(tiles_columns, axis=1, out=rows_table[:, 1:])
+
+        return rows_table[:, xs + tile_size] - rows_table[:, xs]
+
+    percentage_black_pixel = get_tiles_count(greyscale_sum == 0) * 100 / tile_size**2
+    percentage_white_pixel = get_tiles_count(greyscale_sum == 3 * 255) * 100 / tile_size**2
+
+    return (percentage_black_pixel <= 5) & (percentage_white_pixel <= 10)
+
+
+def get_ortho_tiles_keep_mask(ortho: DatasetReader, xs: list[int], ys: list[int], tile_size: int, candidates: np.ndarray | None = None) -> np.ndarray:
+    """
+        Return the keep mask of get_tiles_keep_mask for all the tiles of the ortho, read once by row bands.
+        Only the rows with candidates tiles are read, other tiles are not kept.
+    """
+    candidates = np.ones((len(ys), len(xs)), dtype=bool) if candidates is None else candidates
+    keep_mask = np.zeros((len(ys), len(xs)), dtype=bool)
+
+    i = 0
+    while i < len(ys):
+        # Band of the tiles rows starting less than QUALITY_BAND_ROWS rows after the first one.
+        j = i
+        while j < len(ys) and ys[j] - ys[i] < QUALITY_BAND_ROWS: j += 1
+
+        band_rows = [k for k in range(i, j) if candidates[k].any()]
+        if len(band_rows) != 0:
+            band_start = ys[band_rows[0]]
+            band_data = ortho.read(window=Window(0, band_start, ortho.width, ys[band_rows[-1]] - band_start + tile_size))
+            keep_mask[band_rows] = get_tiles_keep_mask(band_data, xs, [ys[k] - band_start for k in band_rows], tile_size)
+
+        i = j
+
+    return keep_mask & candidates
+
+
 def incremental_merge_tifs_windowed(tif_files: list[Path], output_path: Path, tile_size:int=512):
 
     # Reference metadata
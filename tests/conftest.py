@@ -0,0 +1,76 @@
+import torch
+import numpy as np
+from pathlib import Path
+from argparse import Namespace
+
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+from transformers import SegformerConfig, SegformerForSemanticSegmentation
+
+ID2LABEL = {i: f"class_{i}" for i in range(1, 6)}
+
+
+def write_synthetic_ortho(ortho_path: Path, width: int, height: int, nodata_fraction: float = 0.1, seed: int = 0) -> Path:
+    """ Write a 3 bands uint8 ortho of random texture, the left columns are black nodata. """
+    rng = np.random.default_rng(seed)
+    data = rng.integers(20, 200, size=(3, height, width), dtype=np.uint8)
+    data[:, :, :int(width * nodata_fraction)] = 0
+
+    profile = {
+        "driver": "GTiff", "width": width, "height": height, "count": 3, "dtype": "uint8",
+        "crs": "EPSG:2975", "transform": from_origin(340000, 7670000, 0.2, 0.2)
+    }
+    with rasterio.open(ortho_path, "w", **profile) as dst:
+        dst.write(data)
+
+    return ortho_path
+
+
+@pytest.fixture
+def synthetic_ortho(tmp_path: Path):
+    """ Factory of synthetic orthos in the test folder. """
+    return lambda width=1100, height=1000, nodata_fraction=0.1, seed=0: write_synthetic_ortho(Path(tmp_path, f"ortho_{width}_{height}_{seed}.tif"), width, height, nodata_fraction, seed)
+
+
+@pytest.fixture
+def inference_opt(tmp_path: Path) -> Namespace:
+    """ Options of inference.py used by the tiling and the mosaic, without geojson areas. """
+    return Namespace(
+        path_geojson=[], path_output=str(Path(tmp_path, "output")), tile_size=256, horizontal_overlap=0.75, vertical_overlap=0.75,
+        window_size=0, window_halo=64, blending="vote", blending_window="none"
+    )
+
+
+def predict_tile(tile: np.ndarray) -> np.ndarray:
+    """ Deterministic mask of a (bands, H, W) tile, class ids 1 to 5 from the first band. """
+    return (tile[0] // 40 % 5 + 1).astype(np.uint8)
+
+
+def write_prediction_tiles(ortho_path: Path, predictions_folder: Path, tiles: list[tuple[tuple[int, int], np.ndarray]]) -> None:
+    """ Write the (H, W) masks or (num_classes, H, W) probability bands of tiles at (tile_x, tile_y) like ModelManager.save_prediction. """
+    with rasterio.open(ortho_path) as ortho:
+        meta = ortho.meta.copy()
+        ortho_transform = ortho.transform
+
+    for (tile_x, tile_y), prediction in tiles:
+        bands = prediction if prediction.ndim == 3 else prediction[None]
+        meta.update({
+            "count": bands.shape[0], "dtype": bands.dtype, "nodata": None, "height": bands.shape[1], "width": bands.shape[2],
+            "transform": rasterio.windows.transform(rasterio.windows.Window(tile_x, tile_y, bands.shape[2], bands.shape[1]), ortho_transform)
+        })
+        with rasterio.open(Path(predictions_folder, f"ortho_{tile_x}_{tile_y}_prediction.tif"), "w", **meta) as dst:
+            dst.write(bands)
+
+
+@pytest.fixture
+def tiny_model_path(tmp_path: Path) -> Path:
+    """ Randomly initialised Segformer much smaller than mit-b0, with the classes of the models. """
+    torch.manual_seed(0)
+    config = SegformerConfig(
+        num_labels=len(ID2LABEL), id2label=ID2LABEL, label2id={label: i for i, label in ID2LABEL.items()},
+        hidden_sizes=[16, 32, 64, 128], num_attention_heads=[1, 2, 2, 4], depths=[1, 1, 1, 1], decoder_hidden_size=64
+    )
+    model_path = Path(tmp_path, "tiny_model")
+    SegformerForSemanticSegmentation(config).save_pretrained(model_path)
+    return model_path
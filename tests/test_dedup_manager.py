@@ -0,0 +1,62 @@
+import torch
+import numpy as np
+from transformers import SegformerImageProcessor
+
+from src.inference.DedupManager import DedupManager
+from src.inference.ModelManager import preprocess_tiles
+
+
+def get_tiles(dedup: DedupManager, tiles: np.ndarray) -> list[tuple[torch.Tensor, tuple]]:
+    """ (pixel_values, fingerprint) of each uint8 tile, like the readers of the ModelManager. """
+    processor = SegformerImageProcessor(size={"height": 32, "width": 32})
+    return list(zip(preprocess_tiles(torch.from_numpy(tiles), processor), [dedup.get_fingerprint(tile) for tile in tiles]))
+
+
+def count_predict_fn(calls: list):
+    """ predict_fn returning (N, 32, 32) masks from the mean of each tile, the tiles of each call are recorded. """
+    def predict_fn(pixel_values: list[torch.Tensor]) -> np.ndarray:
+        calls.append(len(pixel_values))
+        return np.stack([np.full((32, 32), int(tile.mean() * 10) % 5 + 1, dtype=np.uint8) for tile in pixel_values])
+    return predict_fn
+
+
+def test_identical_tiles_are_predicted_once():
+    rng = np.random.default_rng(0)
+    textured = rng.integers(0, 255, size=(2, 3, 32, 32), dtype=np.uint8)
+    uniform = np.full((1, 3, 32, 32), 80, dtype=np.uint8)
+    tiles = np.concatenate([textured, textured[:1], uniform, uniform, textured[1:]])
+
+    calls, dedup = [], DedupManager(0, 1024**2)
+    predict_fn = count_predict_fn(calls)
+    predictions = dedup.predict(get_tiles(dedup, tiles), predict_fn)
+
+    assert calls == [3]
+    assert np.array_equal(predictions, predict_fn([pixel_values for pixel_values, _ in get_tiles(dedup, tiles)]))
+    assert dedup.get_stats() == {"dedup_tiles": 6, "dedup_uniform_tiles": 2, "dedup_forward_passes_saved": 3}
+
+
+def test_cache_is_bounded_in_bytes():
+    rng = np.random.default_rng(0)
+    tiles = rng.integers(0, 255, size=(4, 3, 32, 32), dtype=np.uint8)
+
+    # Room for two (32, 32) uint8 masks, the least recently used ones are evicted.
+    calls, dedup = [], DedupManager(0, 2 * 32 * 32)
+    predict_fn = count_predict_fn(calls)
+    dedup.predict(get_tiles(dedup, tiles), predict_fn)
+
+    assert dedup.cached_bytes <= 2 * 32 * 32
+    assert len(dedup.cache) == 2
+
+    # The last two tiles are still cached, the first two are predicted again.
+    dedup.predict(get_tiles(dedup, tiles), predict_fn)
+    assert calls == [4, 2]
+
+
+def test_uniform_tolerance_buckets_nearly_uniform_tiles():
+    tile = np.full((3, 32, 32), 80, dtype=np.uint8)
+    noisy = tile.copy()
+    noisy[:, 0, 0] = 82
+
+    dedup = DedupManager(3, 1024**2)
+    assert dedup.get_fingerprint(tile) == dedup.get_fingerprint(noisy) == ("uniform", 32, 32, 20, 20, 20)
+    assert DedupManager(0, 1024**2).get_fingerprint(noisy)[0] == "content"
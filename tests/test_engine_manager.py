@@ -0,0 +1,23 @@
+import torch
+from pathlib import Path
+
+from transformers import SegformerForSemanticSegmentation
+
+from src.inference.EngineManager import EngineManager, ENGINE_AUTO, ENGINE_EAGER
+
+
+def test_auto_falls_back_to_eager_when_no_engine_runs(tiny_model_path: Path, monkeypatch):
+    model = SegformerForSemanticSegmentation.from_pretrained(tiny_model_path).eval()
+    setup = EngineManager.setup
+
+    def setup_only_eager(self, engine: str) -> None:
+        if engine != ENGINE_EAGER:
+            raise RuntimeError(f"No {engine} engine on this host.")
+        setup(self, engine)
+
+    # Only failing engines are available, eager still gives the reference labels.
+    monkeypatch.setattr(EngineManager, "get_available_engines", lambda self: ["compile", "bf16"])
+    monkeypatch.setattr(EngineManager, "setup", setup_only_eager)
+
+    engine_manager = EngineManager(model, torch.device("cpu"), ENGINE_AUTO, (32, 32), 2, tiny_model_path, allow_onnx=False)
+    assert engine_manager.engine == ENGINE_EAGER
@@ -0,0 +1,53 @@
+from pathlib import Path
+
+from src.inference.TileManager import TileManager, get_tile_name
+from src.inference.PathRasterManager import PathRasterManager
+from src.inference.JournalManager import JournalManager, JOURNAL_TILES, JOURNAL_PNG
+
+
+def test_journal_resumes_from_a_truncated_line(tmp_path: Path):
+    journal_file = Path(tmp_path, "journal", "ortho.journal")
+    journal = JournalManager(journal_file)
+    journal.add(JOURNAL_TILES, ["ortho_0_0", "ortho_64_0"])
+    journal.add_stage(JOURNAL_TILES)
+
+    # A killed run left half a line.
+    with open(journal_file, "a") as f:
+        f.write(f"{JOURNAL_PNG} ortho_0")
+
+    resumed = JournalManager(journal_file)
+    assert resumed.is_done(JOURNAL_TILES, "ortho_64_0") and resumed.is_stage_done(JOURNAL_TILES)
+    assert not resumed.is_done(JOURNAL_PNG, "ortho_0") and not resumed.is_stage_done(JOURNAL_PNG)
+
+    # The incomplete line is removed, so the next names start on their own line.
+    resumed.add(JOURNAL_PNG, ["ortho_0_0"])
+    assert journal_file.read_text().splitlines()[-1] == f"{JOURNAL_PNG} ortho_0_0"
+    assert JournalManager(journal_file).is_done(JOURNAL_PNG, "ortho_0_0")
+
+
+def test_tiling_skips_the_tiles_of_the_journal(synthetic_ortho, inference_opt):
+    ortho_path = synthetic_ortho(600, 500)
+    tile_manager = TileManager(inference_opt)
+    path_manager = PathRasterManager(inference_opt.path_output, ortho_path)
+    path_manager.create_path()
+
+    journal = JournalManager(path_manager.journal_file)
+    tile_manager.split_ortho_into_tiles(path_manager, journal)
+    tiles_names = sorted(f.stem for f in path_manager.cropped_ortho_folder.iterdir())
+    assert journal.is_stage_done(JOURNAL_TILES)
+
+    # The run is killed after half the tiles, their lines are in the journal but the other files are missing.
+    kept_names = tiles_names[:len(tiles_names) // 2]
+    path_manager.journal_file.write_text("".join(f"{JOURNAL_TILES} {name}\n" for name in kept_names) + f"{JOURNAL_TILES} {tiles_names[-1][:5]}")
+    for name in tiles_names[len(tiles_names) // 2:]:
+        Path(path_manager.cropped_ortho_folder, f"{name}.tif").unlink()
+    kept_mtimes = {name: Path(path_manager.cropped_ortho_folder, f"{name}.tif").stat().st_mtime_ns for name in kept_names}
+
+    resumed = JournalManager(path_manager.journal_file)
+    assert not resumed.is_stage_done(JOURNAL_TILES)
+    tile_manager.split_ortho_into_tiles(path_manager, resumed)
+
+    assert sorted(f.stem for f in path_manager.cropped_ortho_folder.iterdir()) == tiles_names
+    assert all(Path(path_manager.cropped_ortho_folder, f"{name}.tif").stat().st_mtime_ns == mtime for name, mtime in kept_mtimes.items())
+    assert JournalManager(path_manager.journal_file).is_stage_done(JOURNAL_TILES)
+    assert get_tile_name(ortho_path, 0, 0) not in tiles_names # Black columns on the left.
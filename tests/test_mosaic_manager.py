@@ -0,0 +1,56 @@
+import numpy as np
+from pathlib import Path
+
+import rasterio
+
+from src.inference.TileManager import TileManager
+from src.inference.MosaicManager import MosaicManager
+from src.inference.PathRasterManager import PathRasterManager
+
+from conftest import ID2LABEL, predict_tile, write_prediction_tiles
+
+
+def create_predictions(ortho_path: Path, inference_opt, name: str) -> PathRasterManager:
+    """ Write the masks of the kept tiles of the ortho into the predictions folder of a new output. """
+    tile_manager = TileManager(inference_opt)
+    path_manager = PathRasterManager(str(Path(inference_opt.path_output, name)), ortho_path)
+    path_manager.create_path()
+
+    tiles = [tile for strip in tile_manager.get_strips(path_manager) for tile in tile_manager.read_strip(strip)]
+    write_prediction_tiles(ortho_path, path_manager.predictions_tiff_folder, [(tile_origin, predict_tile(tile)) for tile_origin, tile in tiles])
+    return path_manager
+
+
+def build_raster(path_manager: PathRasterManager, **kwargs) -> np.ndarray:
+    MosaicManager(path_manager, ID2LABEL, **kwargs).build_raster()
+    with rasterio.open(path_manager.final_merged_tiff_file) as src:
+        return src.read(1)
+
+
+def test_workers_vote_the_same_raster(synthetic_ortho, inference_opt):
+    path_manager = create_predictions(synthetic_ortho(600, 500), inference_opt, "workers")
+
+    # Small slices, so each worker votes several of them.
+    one_worker = build_raster(path_manager, max_pixels_by_slice=600 * 100)
+    two_workers = build_raster(path_manager, max_pixels_by_slice=600 * 100, num_workers=2)
+
+    assert np.array_equal(one_worker, two_workers)
+
+
+def test_memmap_buffers_vote_the_same_raster(synthetic_ortho, inference_opt):
+    path_manager = create_predictions(synthetic_ortho(600, 500), inference_opt, "memmap")
+
+    in_memory = build_raster(path_manager)
+    memmap = build_raster(path_manager, max_pixels_by_slice=600 * 100, memmap_vote_buffer=True, num_workers=2)
+
+    assert np.array_equal(in_memory, memmap)
+
+
+def test_max_votes_of_the_tile_manager_sizes_the_buffers(synthetic_ortho, inference_opt):
+    path_manager = create_predictions(synthetic_ortho(600, 500), inference_opt, "max_votes")
+    max_votes = TileManager(inference_opt).get_max_tiles_by_pixel()
+
+    mosaic_manager = MosaicManager(path_manager, ID2LABEL, max_votes=max_votes)
+    mosaic_manager.compute_mosaic_grid()
+
+    assert mosaic_manager.max_votes == mosaic_manager.tile_index.get_max_tiles_by_pixel() == max_votes
@@ -0,0 +1,93 @@
+import numpy as np
+from pathlib import Path
+
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+
+from src.utils.mosaic_tools import encode_tile_probabilities, decode_tile_probabilities, add_tiles_votes, add_tile_probabilities, create_mosaic_buffer
+from src.utils.mosaic_tools import get_most_common_values, get_most_probable_values, PROBABILITIES_TILE_DTYPE, BLENDING_VOTE, BLENDING_SOFT, MAX_VOTES_UINT8, MAX_VOTES_UINT16
+from src.utils.raster_constants import NO_DATA_VALUE
+
+GLOBAL_MIN, GLOBAL_MAX = 1, 5
+
+
+def add_tile_votes_reference(count_buffer: np.ndarray, tile_data: np.ndarray, row_off: int, col_off: int) -> None:
+    """ Votes of one tile, class by class, like the mosaic before the one pass kernel. """
+    row_start_tile, col_start_tile = max(0, -row_off), max(0, -col_off)
+    row_off, col_off = max(0, row_off), max(0, col_off)
+    row_end = min(row_off + tile_data.shape[0] - row_start_tile, count_buffer.shape[1])
+    col_end = min(col_off + tile_data.shape[1] - col_start_tile, count_buffer.shape[2])
+    if row_end - row_off <= 0 or col_end - col_off <= 0: return
+
+    tile_data = tile_data[row_start_tile:row_start_tile + row_end - row_off, col_start_tile:col_start_tile + col_end - col_off]
+    for v in range(GLOBAL_MIN, GLOBAL_MAX + 1):
+        count_buffer[v - GLOBAL_MIN, row_off:row_end, col_off:col_end] += tile_data == v
+
+
+@pytest.mark.parametrize("max_votes", [MAX_VOTES_UINT8, MAX_VOTES_UINT16])
+@pytest.mark.parametrize("row_off", [-7, 0, 5, 30])
+def test_band_votes_match_the_votes_by_tile(max_votes: int, row_off: int):
+    rng = np.random.default_rng(abs(row_off))
+    # Class 0 is NO_DATA and 6 is outside the classes, neither is voted. Tiles overlap and cross the buffer edges.
+    tiles_data = [rng.integers(0, GLOBAL_MAX + 2, size=(16, 16), dtype=np.uint8) for _ in range(6)]
+    cols_off = [-5, 0, 4, 8, 24, 40]
+
+    count_buffer = create_mosaic_buffer(BLENDING_VOTE, GLOBAL_MAX - GLOBAL_MIN + 1, 40, 36, max_votes)
+    add_tiles_votes(count_buffer, tiles_data, row_off, cols_off, GLOBAL_MIN, GLOBAL_MAX)
+
+    reference = np.zeros(count_buffer.shape, dtype=np.int64)
+    for tile_data, col_off in zip(tiles_data, cols_off):
+        add_tile_votes_reference(reference, tile_data, row_off, col_off)
+
+    assert np.array_equal(count_buffer, reference)
+    assert np.array_equal(get_most_common_values(count_buffer, GLOBAL_MIN), get_most_common_values(reference, GLOBAL_MIN))
+
+
+def test_uint16_votes_of_more_than_255_tiles():
+    # Same tile more than the uint8 max in one band, the band is added by chunks of 255 tiles.
+    tile_data = np.full((4, 4), 2, dtype=np.uint8)
+    count_buffer = create_mosaic_buffer(BLENDING_VOTE, GLOBAL_MAX - GLOBAL_MIN + 1, 4, 4, MAX_VOTES_UINT16)
+    add_tiles_votes(count_buffer, [tile_data] * 300, 0, [0] * 300, GLOBAL_MIN, GLOBAL_MAX)
+
+    assert count_buffer.dtype == np.uint16
+    assert (count_buffer[1] == 300).all() and count_buffer[[0, 2, 3, 4]].sum() == 0
+
+
+def test_most_common_values_are_nodata_without_votes():
+    count_buffer = np.zeros((5, 2, 2), dtype=np.uint8)
+    count_buffer[3, 0, 0] = 2
+    count_buffer[[1, 2], 1, 1] = 1 # Ties go to the lowest class.
+
+    assert np.array_equal(get_most_common_values(count_buffer, GLOBAL_MIN), [[4, NO_DATA_VALUE], [NO_DATA_VALUE, 2]])
+
+
+def test_tile_probabilities_are_weighted_and_cropped():
+    rng = np.random.default_rng(0)
+    tile_proba = rng.random((5, 8, 8)).astype(np.float16)
+    weights = rng.random((8, 8)).astype(np.float32)
+
+    prob_buffer = create_mosaic_buffer(BLENDING_SOFT, 5, 10, 10)
+    add_tile_probabilities(prob_buffer, tile_proba, weights, -2, 6)
+
+    expected = np.zeros((5, 10, 10), dtype=np.float16)
+    expected[:, 0:6, 6:10] = tile_proba[:, 2:8, 0:4] * weights[2:8, 0:4]
+    assert np.array_equal(prob_buffer, expected)
+
+    labels = get_most_probable_values(prob_buffer, GLOBAL_MIN)
+    assert (labels[6:, :] == NO_DATA_VALUE).all() and (labels[:, :6] == NO_DATA_VALUE).all()
+    assert np.array_equal(labels[0:6, 6:10], expected[:, 0:6, 6:10].argmax(axis=0) + GLOBAL_MIN)
+
+
+def test_probability_tiles_keep_the_float16_probabilities(tmp_path: Path):
+    rng = np.random.default_rng(0)
+    logits = rng.normal(size=(5, 32, 32)).astype(np.float32)
+    probabilities = (np.exp(logits) / np.exp(logits).sum(axis=0)).astype(np.float16)
+
+    tile_path = Path(tmp_path, "tile_prediction.tif")
+    profile = {"driver": "GTiff", "width": 32, "height": 32, "count": 5, "crs": "EPSG:2975", "transform": from_origin(340000, 7670000, 0.2, 0.2)}
+    with rasterio.open(tile_path, "w", dtype=PROBABILITIES_TILE_DTYPE, compress="LZW", predictor=2, **profile) as dst:
+        dst.write(encode_tile_probabilities(probabilities))
+
+    with rasterio.open(tile_path) as src:
+        assert np.array_equal(decode_tile_probabilities(src.read()), probabilities)
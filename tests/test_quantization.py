@@ -0,0 +1,39 @@
+import torch
+import pytest
+from pathlib import Path
+from transformers import SegformerImageProcessor, SegformerForSemanticSegmentation
+
+from src.inference.EngineManager import EngineManager, ENGINE_EAGER, ENGINE_ONNX, ENGINE_ONNX_INT8_DYNAMIC, get_onnx_path
+
+INPUT_SIZE = (128, 128)
+
+
+def test_missing_int8_model_asks_for_quantize(tiny_model_path: Path):
+    model = SegformerForSemanticSegmentation.from_pretrained(tiny_model_path).eval()
+
+    with pytest.raises(FileNotFoundError, match="quantize.py"):
+        EngineManager(model, torch.device("cpu"), ENGINE_ONNX_INT8_DYNAMIC, INPUT_SIZE, 2, tiny_model_path)
+
+
+def test_dynamic_int8_model_runs_like_the_float_model(tiny_model_path: Path, monkeypatch):
+    pytest.importorskip("onnxruntime")
+    pytest.importorskip("onnxscript")
+    pytest.importorskip("sklearn")
+    from src.inference import QuantizationManager as quantization_module
+
+    # The processor of the inference, without downloading mit-b0.
+    monkeypatch.setattr(quantization_module.AutoImageProcessor, "from_pretrained", lambda *args, **kwargs: SegformerImageProcessor(size={"height": INPUT_SIZE[0], "width": INPUT_SIZE[1]}))
+    quantization_manager = quantization_module.QuantizationManager(tiny_model_path, 2)
+    int8_path = quantization_manager.quantize_dynamic()
+
+    assert int8_path == get_onnx_path(tiny_model_path, ENGINE_ONNX_INT8_DYNAMIC)
+    assert int8_path.stat().st_size < get_onnx_path(tiny_model_path, ENGINE_ONNX).stat().st_size
+
+    model = SegformerForSemanticSegmentation.from_pretrained(tiny_model_path).eval()
+    pixel_values = torch.randn(3, 3, *INPUT_SIZE, generator=torch.Generator().manual_seed(0))
+    float_logits = EngineManager(model, torch.device("cpu"), ENGINE_EAGER, INPUT_SIZE, 2, tiny_model_path).forward(pixel_values)
+    int8_logits = EngineManager(model, torch.device("cpu"), ENGINE_ONNX_INT8_DYNAMIC, INPUT_SIZE, 2, tiny_model_path).forward(pixel_values)
+
+    # Batch size isn't fixed in the graph and the quantization only adds a small error to the logits.
+    assert int8_logits.shape == float_logits.shape
+    assert (int8_logits - float_logits).abs().max() < 0.1 * float_logits.abs().max()
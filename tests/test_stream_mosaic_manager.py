@@ -0,0 +1,77 @@
+import numpy as np
+from pathlib import Path
+
+import pytest
+import rasterio
+
+from src.inference.TileManager import TileManager
+from src.inference.MosaicManager import MosaicManager
+from src.inference.PathRasterManager import PathRasterManager
+from src.inference.StreamMosaicManager import StreamMosaicManager
+from src.utils.mosaic_tools import BLENDING_VOTE, BLENDING_SOFT, WINDOW_NONE, encode_tile_probabilities
+from src.utils.raster_constants import NO_DATA_VALUE
+
+from conftest import ID2LABEL, predict_tile, write_prediction_tiles
+
+
+def predict_tile_probabilities(tile: np.ndarray) -> np.ndarray:
+    """ Deterministic (5, H, W) float16 probabilities of a (bands, H, W) tile. """
+    logits = np.stack([np.sin(tile[0] / 20.0 + k) + tile[1] / 255.0 * k for k in range(len(ID2LABEL))])
+    return (np.exp(logits) / np.exp(logits).sum(axis=0)).astype(np.float16)
+
+
+PREDICT_FNS = {BLENDING_VOTE: predict_tile, BLENDING_SOFT: predict_tile_probabilities}
+
+
+def read_in_ortho_grid(raster_path: Path, ortho_path: Path) -> np.ndarray:
+    """ Labels of a raster on the grid of the ortho, NO_DATA outside of the raster. """
+    with rasterio.open(ortho_path) as ortho, rasterio.open(raster_path) as src:
+        labels = np.full((ortho.height, ortho.width), NO_DATA_VALUE, dtype=np.uint8)
+        col_off, row_off = (round(v) for v in ~ortho.transform * (src.transform.c, src.transform.f))
+        labels[row_off:row_off + src.height, col_off:col_off + src.width] = src.read(1)
+    return labels
+
+
+@pytest.mark.parametrize("blending", [BLENDING_VOTE, BLENDING_SOFT])
+def test_streaming_matches_the_file_mosaic(synthetic_ortho, inference_opt, blending: str):
+    # Taller than the rolling buffer, so rows are flushed several times.
+    ortho_path = synthetic_ortho(700, 1100, nodata_fraction=0.1)
+    tile_manager = TileManager(inference_opt)
+    predict_fn = PREDICT_FNS[blending]
+
+    stream_path_manager = PathRasterManager(str(Path(inference_opt.path_output, "stream")), ortho_path)
+    stream_path_manager.create_final_path()
+    stream_manager = StreamMosaicManager(stream_path_manager, ID2LABEL, tile_manager.tile_size, blending, WINDOW_NONE, tile_manager.get_max_tiles_by_pixel())
+    assert stream_manager.height > stream_manager.buffer_rows
+
+    tiles = []
+    stream_manager.create_raster()
+    for strip in tile_manager.get_strips(stream_path_manager, 3):
+        for tile_origin, tile in tile_manager.read_strip(strip):
+            stream_manager.add_prediction(tile_origin, predict_fn(tile))
+            tiles.append((tile_origin, tile))
+    stream_manager.close_raster()
+
+    file_path_manager = PathRasterManager(str(Path(inference_opt.path_output, "file")), ortho_path)
+    file_path_manager.create_path()
+    encode_fn = encode_tile_probabilities if blending == BLENDING_SOFT else lambda prediction: prediction
+    write_prediction_tiles(ortho_path, file_path_manager.predictions_tiff_folder, [(tile_origin, encode_fn(predict_fn(tile))) for tile_origin, tile in tiles])
+    MosaicManager(file_path_manager, ID2LABEL, blending=blending).build_raster()
+
+    stream_labels = read_in_ortho_grid(stream_path_manager.final_merged_tiff_file, ortho_path)
+    file_labels = read_in_ortho_grid(file_path_manager.final_merged_tiff_file, ortho_path)
+
+    assert (stream_labels != NO_DATA_VALUE).any() and (stream_labels[:, :70] == NO_DATA_VALUE).any()
+    assert np.array_equal(stream_labels, file_labels)
+
+
+def test_predictions_must_be_sorted_by_row(synthetic_ortho, inference_opt):
+    path_manager = PathRasterManager(inference_opt.path_output, synthetic_ortho(300, 600))
+    path_manager.create_final_path()
+    stream_manager = StreamMosaicManager(path_manager, ID2LABEL, 256, BLENDING_VOTE, WINDOW_NONE, 16)
+
+    stream_manager.create_raster()
+    stream_manager.add_prediction((0, 300), np.ones((256, 256), dtype=np.uint8))
+    with pytest.raises(ValueError, match="sorted by row"):
+        stream_manager.add_prediction((0, 64), np.ones((256, 256), dtype=np.uint8))
+    stream_manager.close_raster(complete=False)
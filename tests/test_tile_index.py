@@ -0,0 +1,54 @@
+import numpy as np
+from argparse import Namespace
+from rasterio.windows import Window
+
+import pytest
+
+from src.inference.TileIndex import TileIndex
+from src.inference.TileManager import TileManager
+
+
+def create_tiles_windows(seed: int, tile_size: int = 32) -> list[Window]:
+    rng = np.random.default_rng(seed)
+    return [Window(int(col), int(row), tile_size, tile_size) for row, col in rng.integers(0, 300, size=(200, 2))]
+
+
+@pytest.mark.parametrize("bucket_size", [8, 32, 100])
+def test_query_matches_a_scan_of_all_tiles(bucket_size: int):
+    tiles_windows = create_tiles_windows(bucket_size)
+    tile_index = TileIndex(tiles_windows, bucket_size)
+
+    rng = np.random.default_rng(0)
+    for row, col, height, width in rng.integers(1, 330, size=(50, 4)):
+        window = Window(int(col) - 20, int(row) - 20, int(width), int(height))
+        expected = [i for i, tile in enumerate(tiles_windows) if TileIndex.intersects(tile, window.row_off, window.col_off, window.row_off + window.height, window.col_off + window.width)]
+
+        result = tile_index.query(window)
+        assert sorted(result) == expected
+        assert result == sorted(result, key=lambda i: (tiles_windows[i].row_off, tiles_windows[i].col_off))
+
+
+def test_max_tiles_by_pixel_bounds_the_coverage():
+    tiles_windows = create_tiles_windows(0)
+    coverage = np.zeros((340, 340), dtype=int)
+    for tile in tiles_windows:
+        coverage[tile.row_off:tile.row_off + tile.height, tile.col_off:tile.col_off + tile.width] += 1
+
+    assert TileIndex(tiles_windows, 32).get_max_tiles_by_pixel() >= coverage.max()
+
+
+@pytest.mark.parametrize("overlap", [0.5, 0.75, 0.9])
+def test_max_tiles_by_pixel_is_the_coverage_of_a_grid(inference_opt: Namespace, overlap: float):
+    inference_opt.horizontal_overlap, inference_opt.vertical_overlap = overlap, overlap
+    tile_manager = TileManager(inference_opt)
+    width, height = 1000, 700
+    xs, ys = tile_manager.get_tiles_origins(width, height)
+    tiles_windows = [Window(x, y, tile_manager.tile_size, tile_manager.tile_size) for y in ys for x in xs]
+
+    coverage = np.zeros((height, width), dtype=int)
+    for tile in tiles_windows:
+        coverage[tile.row_off:tile.row_off + tile.height, tile.col_off:tile.col_off + tile.width] += 1
+
+    max_tiles = TileIndex(tiles_windows, tile_manager.tile_size).get_max_tiles_by_pixel()
+    assert max_tiles == coverage.max()
+    assert max_tiles <= tile_manager.get_max_tiles_by_pixel()
@@ -0,0 +1,61 @@
+import numpy as np
+
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+
+from src.utils import tiles_tools
+from src.utils.tiles_tools import get_tiles_keep_mask, get_ortho_tiles_keep_mask
+
+TILE_SIZE = 16
+
+
+def keep_tile_reference(tile: np.ndarray) -> bool:
+    """ Keep test of one tile, like the tiling before the summed-area tables. """
+    greyscale_tile = np.sum(tile, axis=0) / 3
+    percentage_black_pixel = np.sum(greyscale_tile == 0) * 100 / TILE_SIZE**2
+    percentage_white_pixel = np.sum(greyscale_tile == 255) * 100 / TILE_SIZE**2
+    return percentage_black_pixel <= 5 and percentage_white_pixel <= 10
+
+
+def create_band(seed: int) -> np.ndarray:
+    """ Random (3, 64, 80) band with black and white blocks of several sizes around the thresholds. """
+    rng = np.random.default_rng(seed)
+    band_data = rng.integers(1, 255, size=(3, 64, 80), dtype=np.uint8)
+    for _ in range(12):
+        y, x, size = rng.integers(0, 60), rng.integers(0, 76), rng.integers(1, 12)
+        band_data[:, y:y + size, x:x + size] = rng.choice([0, 255])
+    # One black pixel in one band only isn't black.
+    band_data[0, 10, 10] = 0
+    return band_data
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_keep_mask_matches_the_test_by_tile(seed: int):
+    band_data = create_band(seed)
+    xs, ys = list(range(0, 80 - TILE_SIZE + 1, 4)), list(range(0, 64 - TILE_SIZE + 1, 4))
+
+    keep_mask = get_tiles_keep_mask(band_data, xs, ys, TILE_SIZE)
+    reference = [[keep_tile_reference(band_data[:, y:y + TILE_SIZE, x:x + TILE_SIZE]) for x in xs] for y in ys]
+
+    assert np.array_equal(keep_mask, reference)
+    assert not keep_mask.all() and keep_mask.any()
+
+
+def test_ortho_keep_mask_reads_rows_of_candidates(tmp_path, monkeypatch):
+    # Several bands of tiles rows on the small ortho.
+    monkeypatch.setattr(tiles_tools, "QUALITY_BAND_ROWS", 16)
+    band_data = create_band(0)
+    ortho_path = tmp_path / "ortho.tif"
+    with rasterio.open(ortho_path, "w", driver="GTiff", width=80, height=64, count=3, dtype="uint8", crs="EPSG:2975", transform=from_origin(340000, 7670000, 0.2, 0.2)) as dst:
+        dst.write(band_data)
+
+    xs, ys = list(range(0, 80 - TILE_SIZE + 1, 8)), list(range(0, 64 - TILE_SIZE + 1, 8))
+    candidates = np.ones((len(ys), len(xs)), dtype=bool)
+    candidates[1] = False
+    candidates[:, 2] = False
+
+    with rasterio.open(ortho_path) as ortho:
+        keep_mask = get_ortho_tiles_keep_mask(ortho, xs, ys, TILE_SIZE, candidates)
+
+    assert np.array_equal(keep_mask, get_tiles_keep_mask(band_data, xs, ys, TILE_SIZE) & candidates)
@@ -0,0 +1,61 @@
+import numpy as np
+from pathlib import Path
+
+import rasterio
+
+from src.inference.TileManager import TileManager
+from src.inference.ModelManager import get_window_core
+from src.inference.PathRasterManager import PathRasterManager
+from src.inference.StreamMosaicManager import StreamMosaicManager
+from src.utils.mosaic_tools import BLENDING_VOTE, WINDOW_NONE
+from src.utils.raster_constants import NO_DATA_VALUE
+
+from conftest import ID2LABEL
+
+CLASS_ID = 3
+
+
+def build_tiles_raster(tile_manager: TileManager, path_manager: PathRasterManager) -> np.ndarray:
+    """ Stream the kept tiles of the tiled mode with a constant mask. """
+    mosaic_manager = StreamMosaicManager(path_manager, ID2LABEL, tile_manager.tile_size, BLENDING_VOTE, WINDOW_NONE, tile_manager.get_max_tiles_by_pixel())
+    mosaic_manager.create_raster()
+    for strip in tile_manager.get_strips(path_manager, 4):
+        for tile_origin, tile in tile_manager.read_strip(strip):
+            mosaic_manager.add_prediction(tile_origin, np.full(tile.shape[1:], CLASS_ID, dtype=np.uint8))
+    mosaic_manager.close_raster()
+
+    with rasterio.open(path_manager.final_merged_tiff_file) as src:
+        return src.read(1)
+
+
+def build_windows_raster(tile_manager: TileManager, path_manager: PathRasterManager) -> np.ndarray:
+    """ Stream the windows with a constant mask, like ModelManager.inference_windows. """
+    mosaic_manager = StreamMosaicManager(path_manager, ID2LABEL, tile_manager.opt.window_size, BLENDING_VOTE, WINDOW_NONE, 1)
+    mosaic_manager.create_raster()
+    for strip in tile_manager.get_window_strips(path_manager, 2):
+        for key, window in tile_manager.read_window_strip(strip):
+            mosaic_manager.add_prediction(*get_window_core(key, np.full(window.shape[1:], CLASS_ID, dtype=np.uint8)))
+    mosaic_manager.close_raster()
+
+    with rasterio.open(path_manager.final_merged_tiff_file) as src:
+        return src.read(1)
+
+
+def test_windows_have_the_nodata_footprint_of_the_tiles(synthetic_ortho, inference_opt):
+    ortho_path = synthetic_ortho(1100, 1000, nodata_fraction=0.1)
+
+    tiles_manager = TileManager(inference_opt)
+    tiles_path_manager = PathRasterManager(str(Path(inference_opt.path_output, "tiles")), ortho_path)
+    tiles_path_manager.create_final_path()
+    tiles_labels = build_tiles_raster(tiles_manager, tiles_path_manager)
+
+    inference_opt.window_size = 512
+    windows_manager = TileManager(inference_opt)
+    windows_path_manager = PathRasterManager(str(Path(inference_opt.path_output, "windows")), ortho_path)
+    windows_path_manager.create_final_path()
+    windows_labels = build_windows_raster(windows_manager, windows_path_manager)
+
+    # Black columns are left to NO_DATA by the tiles, and so by the windows.
+    assert (tiles_labels[:, :110] == NO_DATA_VALUE).any()
+    assert np.array_equal(tiles_labels == NO_DATA_VALUE, windows_labels == NO_DATA_VALUE)
+    assert (windows_labels[windows_labels != NO_DATA_VALUE] == CLASS_ID).all()
@@ -7,9 +7,10 @@ from src.TileManager import TileManager
 from src.IGNManager import IGNManager
 from src.utils.lib_tools import print_header
 from src.utils.training_step import TrainingStep
+from src.utils.perf_tools import PerfReport
 
 from src.training.main import main_launch_training
-from inference import main_raster as inference_main
+from inference import main_raster as inference_main, parse_args as inference_parse_args
 
 def parse_args() -> Namespace:
 
@@ -34,18 +35,25 @@ def main(opt: Namespace) -> None:
     pm = PathManager(cp.output_path)
     pm.setup(cp)
 
-    # Initialize ign tile manager.
-    ign_manager = IGNManager(cp, pm)
+    # Each stage is recorded into a json report next to the outputs.
+    perf_report = PerfReport("train")
 
-    # Download uav orthophoto.
-    uav_manager = UAVManager(cp, pm)
+    # Initialize ign tile manager, the download of the IGN archives and their clip are separate stages.
+    ign_manager = IGNManager(cp, pm, perf_report)
+
+    # Download uav orthophoto, the download of the sessions and the 4-band rasters of their predictions are separate stages.
+    uav_manager = UAVManager(cp, pm, perf_report)
 
     # Extract tiles and annotations.
     tile_manager = TileManager(cp, pm)
-    tile_manager.create_tiles_and_annotations(uav_manager, ign_manager)
-    tile_manager.convert_tiff_to_png(pm.coarse_cropped_ortho_tif_folder, pm.coarse_train_images_folder)
-    tile_manager.convert_tiff_to_png(pm.coarse_annotation_tif_folder, pm.coarse_train_annotation_folder)
-    tile_manager.validate_annotations_pngs()
+    with perf_report.stage("tiling", pm.coarse_cropped_ortho_tif_folder):
+        tile_manager.create_tiles_and_annotations(uav_manager, ign_manager)
+
+    with perf_report.stage("conversion", pm.coarse_train_images_folder):
+        tile_manager.convert_tiff_to_png(pm.coarse_cropped_ortho_tif_folder, pm.coarse_train_images_folder)
+        tile_manager.convert_tiff_to_png(pm.coarse_annotation_tif_folder, pm.coarse_train_annotation_folder)
+        tile_manager.validate_annotations_pngs()
+    perf_report.save(pm.perf_report_file)
 
     # First training.
     if cp.model_path_coarse == None:
@@ -55,26 +63,24 @@ def main(opt: Namespace) -> None:
 
     # Perform inference
     if not pm.ign_prediction_inference_raster_folder.exists() or len(list(pm.ign_prediction_inference_raster_folder.iterdir())) == 0:
-        inference_args = Namespace(
-            enable_folder=True, enable_session=False, enable_csv=False, 
-            path_folder=pm.ign_useful_data, path_session=None, path_csv_file=None, 
-            path_segmentation_model=first_model_path, 
-            path_geojson=['./configs/emprise_lagoon.geojson'], 
-            horizontal_overlap=0.75, 
-            vertical_overlap=0.75, 
-            tile_size=256, 
-            path_output=pm.output_path, 
-            index_start='0', 
-            clean=True, 
-            max_pixels_by_slice_of_rasters=800000000,
-            regroup_all_prediction=True
-        )
-        inference_main(inference_args)
+        # Defaults of inference.py, so new inference options don't need to be copied here.
+        inference_args = inference_parse_args([
+            "--enable_folder", "--path_folder", str(pm.ign_useful_data),
+            "--path_segmentation_model", str(first_model_path),
+            "--path_output", str(pm.output_path),
+            "--clean"
+        ])
+        inference_args.regroup_all_prediction = True
+        with perf_report.stage("inference", pm.ign_prediction_inference_raster_folder):
+            inference_main(inference_args)
+        perf_report.save(pm.perf_report_file)
     else:
         print("\n\n------ [INFERENCE - Predictions rasters already exists] ------\n")
 
     # Regroup all predictions into one big file to apply seagrass annotation.
-    ign_manager.regroup_inference_pred_into_one_file_by_year()
+    with perf_report.stage("regroup", pm.ign_regroup_prediction):
+        ign_manager.regroup_inference_pred_into_one_file_by_year()
+    perf_report.save(pm.perf_report_file)
 
     # Apply Seagrass annotation on bigtile.
 